@@ -1,8 +1,362 @@
+import csv
+import datetime
+import mimetypes
+
+from django import forms
+from django.conf.urls.defaults import patterns, url
 from django.contrib import admin
+from django.contrib.admin.util import unquote
+from django.core.context_processors import csrf
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.urlresolvers import reverse
+from django.db import models
+from django.http import HttpResponse, HttpResponseRedirect
+from django.shortcuts import render_to_response
+from django.utils.translation import ugettext_lazy as _
+
+from feincms.admin import item_editor
+from feincms.utils import copy_model_instance
+
+from pennyblack import settings
+from pennyblack.models import Newsletter, EmailClient, Job, JobHourlyStatistic, JobStatistic, Link, LinkHourlyStatistic, Mail, Sender
+from pennyblack.models.mail import iter_mail_chunks
+from pennyblack.models.newsletter import Attachment
+from pennyblack.statistics import get_job_timelines
+
+try:
+    from django.utils import timezone
+except ImportError:
+    now = datetime.datetime.now
+else:
+    now = timezone.now
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # older versions stream the content of an HttpResponse if it's an iterator
+    StreamingHttpResponse = HttpResponse
+
+
+#-----------------------------------------------------------------------------
+# Newsletter
+#-----------------------------------------------------------------------------
+class AttachmentAdminForm(forms.ModelForm):
+    def clean(self):
+        cleaned_data = super(AttachmentAdminForm, self).clean()
+        if 'file' in cleaned_data and isinstance(cleaned_data['file'], InMemoryUploadedFile):
+            cleaned_data['name'] = cleaned_data['name'] or cleaned_data['file'].name
+        return cleaned_data
+
+    def save(self, **kwargs):
+        filename = self.instance.name
+        mimetype, format = mimetypes.guess_type(filename)
+        if not mimetype:
+            raise forms.ValidationError(_(u'Mimetype of file could not be guessed.'))
+        self.instance.mimetype = mimetype
+        self.instance.size = self.instance.file.size
+        return super(AttachmentAdminForm, self).save(**kwargs)
+
+
+class AttachmentInline(admin.TabularInline):
+    model = Attachment
+    form = AttachmentAdminForm
+    readonly_fields = ('mimetype', 'size')
+    extra = 0
+
+
+def copy_newsletters(modeladmin, request, queryset):
+    for newsletter in queryset:
+        duplicate = copy_model_instance(newsletter, exclude=('id', 'prepared_version'))
+        duplicate.save()
+        duplicate.copy_content_from(newsletter)
+copy_newsletters.short_description = _('Duplicate selected newsletters')
+
+
+class NewsletterAdmin(item_editor.ItemEditor, admin.ModelAdmin):
+    list_display = ('name', 'subject', 'language', 'newsletter_type')
+    raw_id_fields = ('header_image',)
+    fieldsets = (
+        (None, {
+            'fields': ['name', 'subject', 'sender', 'reply_email', 'template_key'],
+        }),
+        (_('Other options'), {
+            'classes': ['collapse'],
+            'fields': ('newsletter_type', 'language', 'utm_source', 'utm_medium', 'header_image', 'header_url', 'site'),
+        }),
+        item_editor.FEINCMS_CONTENT_FIELDSET,
+    )
+    exclude = ('header_url_replaced',)
+    actions = [copy_newsletters]
+    inlines = []
+    if settings.NEWSLETTER_SHOW_ATTACHMENTS:
+        inlines.append(AttachmentInline)
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj:
+            return self.readonly_fields + ('newsletter_type',)
+        return self.readonly_fields
+
+    def queryset(self, request):
+        return self.model.objects.active()
+
+    def save_related(self, request, form, formsets, change):
+        super(NewsletterAdmin, self).save_related(request, form, formsets, change)
+        # the content blocks are saved by now
+        if change:
+            form.instance.content_changed()
+
+    def get_urls(self):
+        urls = super(NewsletterAdmin, self).get_urls()
+        my_urls = patterns('',
+            url(r'^(?P<newsletter_id>\d+)/preview/$', 'pennyblack.views.preview'),
+        )
+        return my_urls + urls
+
+
+#-----------------------------------------------------------------------------
+# Job
+#-----------------------------------------------------------------------------
+class LinkInline(admin.TabularInline):
+    model = Link
+    max_num = 0
+    can_delete = False
+    fields = ('link_target', 'link_hash',)
+    readonly_fields = ('link_hash',)
+
+    def queryset(self, request):
+        """
+        Don't show links with identifier because they aren't changable.
+        """
+        queryset = super(LinkInline, self).queryset(request)
+        return queryset.filter(identifier='')
+
+
+class MailInline(admin.TabularInline):
+    model = Mail
+    max_num = 0
+    can_delete = False
+    fields = ('get_email',)
+    readonly_fields = ('get_email',)
+
+    def queryset(self, request):
+        """
+        Don't display Inlines if there are more than a certain amount
+        """
+        if request._pennyblack_job_obj.mails.count() > settings.JOB_MAIL_INLINE_COUNT:
+            return super(MailInline, self).queryset(request).filter(pk=0)
+        return super(MailInline, self).queryset(request)
+
+
+class JobAdminForm(forms.ModelForm):
+    newsletter = forms.ModelChoiceField(queryset=Newsletter.objects.massmail())
+
+
+class JobAdmin(admin.ModelAdmin):
+    date_hierarchy = 'date_deliver_start'
+    actions = None
+    list_display = ('newsletter', 'group_object', 'status', 'public_slug', 'field_mails_total', 'field_mails_sent', 'date_created')
+    list_filter = ('status', 'newsletter',)
+    fields = ('newsletter', 'collection', 'status', 'group_object', 'field_mails_total', 'field_mails_sent', 'date_deliver_start', 'date_deliver_finished', 'public_slug', 'utm_campaign')
+    readonly_fields = ('collection', 'status', 'group_object', 'field_mails_total', 'field_mails_sent', 'date_deliver_start', 'date_deliver_finished',)
+    inlines = (LinkInline, MailInline,)
+    massmail_form = JobAdminForm
+
+    def get_form(self, request, obj=None, **kwargs):
+        if obj and obj.status in settings.JOB_STATUS_CAN_EDIT:
+            kwargs['form'] = self.massmail_form
+        return super(JobAdmin, self).get_form(request, obj, **kwargs)
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj and obj.status in settings.JOB_STATUS_CAN_EDIT:
+            return self.readonly_fields
+        else:
+            return self.readonly_fields + ('newsletter',)
+
+    def change_view(self, request, object_id, extra_context={}):
+        obj = self.get_object(request, unquote(object_id))
+        extra_context['can_send'] = obj.can_send()
+        request._pennyblack_job_obj = obj  # add object to request for the mail inline
+        return super(JobAdmin, self).change_view(request, object_id, extra_context=extra_context)
+
+    def send_newsletter_view(self, request, object_id):
+        obj = self.get_object(request, unquote(object_id))
+        if request.method == 'POST' and "_send" in request.POST:
+            obj.start_sending()
+            self.message_user(request, _("Newsletter has been marked for delivery."))
+        return HttpResponseRedirect(reverse('admin:%s_%s_changelist' % (self.model._meta.app_label, self.model._meta.module_name)))
+
+    def response_change(self, request, obj):
+        """
+        Determines the HttpResponse for the change_view stage.
+        """
+        if "_send_prepare" in request.POST:
+            context = {
+                'object': obj,
+                'opts': self.model._meta,
+                'app_label': self.model._meta.app_label,
+            }
+            context.update(csrf(request))
+            return render_to_response(
+                'admin/pennyblack/job/send_confirmation.html', context)
+        return super(JobAdmin, self).response_change(request, obj)
+
+    def get_urls(self):
+        urls = super(JobAdmin, self).get_urls()
+        info = self.model._meta.app_label, self.model._meta.module_name
+        my_urls = patterns('',
+            url(r'^(?P<object_id>\d+)/send/$', self.admin_site.admin_view(self.send_newsletter_view), name=('%s_%s_send' % info)),
+        )
+        return my_urls + urls
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class JobStatisticAdmin(admin.ModelAdmin):
+    date_hierarchy = 'date_deliver_start'
+    actions = None
+    list_display = ('newsletter', 'group_object', 'field_mails_total', 'field_mails_sent', 'field_opening_rate', 'date_created')
+    # list_filter   = ('status', 'newsletter',)
+    fields = ('newsletter', 'collection', 'group_object', 'date_deliver_start', 'date_deliver_finished', 'utm_campaign')
+    readonly_fields = ('newsletter', 'collection', 'group_object', 'date_deliver_start', 'date_deliver_finished', 'utm_campaign')
+
+    def queryset(self, request):
+        return self.model.objects.exclude(status=1)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def get_graph_data(self, obj):
+        return get_job_timelines(obj)
+
+    def change_view(self, request, object_id, extra_context={}):
+        obj = self.get_object(request, unquote(object_id))
+        graph_data = self.get_graph_data(obj)
+        extra_context.update(graph_data)
+        return super(JobStatisticAdmin, self).change_view(request, object_id, extra_context=extra_context)
+
+    def get_email_list_mails(self, request, obj):
+        mails = obj.mails.all()
+        if request.GET.get('clicked'):
+            mails = mails.filter(clicked=True)
+        return mails
+
+    def email_list_view(self, request, object_id):
+        """
+        Lists the mails of a job page by page, the next page starts after the
+        id of the last mail of the previous page.
+        """
+        obj = self.get_object(request, unquote(object_id))
+        try:
+            after = int(request.GET.get('after', 0))
+        except ValueError:
+            after = 0
+        page_size = settings.EMAIL_LIST_PAGE_SIZE
+        mails = next(iter_mail_chunks(self.get_email_list_mails(request, obj), page_size + 1, after), [])
+        context = {
+            'object': obj,
+            'mails': mails[:page_size],
+            'next_after': mails[page_size - 1].pk if len(mails) > page_size else None,
+            'clicked': request.GET.get('clicked', ''),
+            'opts': self.model._meta,
+            'app_label': self.model._meta.app_label,
+        }
+
+        return render_to_response('admin/pennyblack/jobstatistic/email_list.html', context)
+
+    def email_list_csv_view(self, request, object_id):
+        """
+        Streams the mails of a job as csv, they are loaded in chunks.
+        """
+        obj = self.get_object(request, unquote(object_id))
+        response = StreamingHttpResponse(self.iter_email_list_csv(self.get_email_list_mails(request, obj)),
+                                         content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename=job-%s-emails.csv' % obj.pk
+        return response
+
+    def iter_email_list_csv(self, mails):
+        class Echo(object):
+            def write(self, value):
+                return value
+        writer = csv.writer(Echo())
+        yield writer.writerow(['email', 'sent', 'bounced', 'viewed', 'clicks'])
+        for chunk in iter_mail_chunks(mails, settings.EMAIL_LIST_CHUNK_SIZE):
+            yield ''.join(writer.writerow([mail.email.encode('utf-8'), int(mail.sent), int(mail.bounced),
+                                           mail.viewed.isoformat() if mail.viewed else '', mail.click_count])
+                          for mail in chunk)
+
+    def user_agents_view(self, request, object_id):
+        obj = self.get_object(request, unquote(object_id))
+        fields = ['agent__family', 'agent__device']
+        if request.GET.get('versions'):
+            fields.insert(1, 'agent__version')
+        user_agents = EmailClient.objects.filter(mail__job__id=obj.id).values(*fields).annotate(count=models.Count('pk')).order_by('-count')
+        context = {
+            'versions': request.GET.get('versions', ''),
+            'object': obj,
+            'opts': self.model._meta,
+            'app_label': self.model._meta.app_label,
+            'user_agents': user_agents
+        }
+
+        return render_to_response('admin/pennyblack/jobstatistic/user_agents.html', context)
+
+    def engagement_view(self, request):
+        """
+        Compares the opens and clicks of all jobs of the last days, read from
+        the hourly statistics.
+        """
+        try:
+            days = int(request.GET.get('days', 30))
+        except ValueError:
+            days = 30
+        since = now() - datetime.timedelta(days=days)
+        job_statistics = list(JobHourlyStatistic.objects.filter(hour__gte=since).values('job').annotate(
+            opens=models.Sum('opens'), clicks=models.Sum('clicks')).order_by('-opens'))
+        jobs = Job.objects.select_related('newsletter').in_bulk([statistic['job'] for statistic in job_statistics])
+        for statistic in job_statistics:
+            statistic['job'] = jobs.get(statistic['job'])
+        newsletter_statistics = JobHourlyStatistic.objects.filter(hour__gte=since).values('job__newsletter__name').annotate(
+            opens=models.Sum('opens'), clicks=models.Sum('clicks')).order_by('-opens')
+        link_statistics = LinkHourlyStatistic.objects.filter(hour__gte=since).values(
+            'link__link_target', 'link__identifier', 'job__newsletter__name').annotate(
+            clicks=models.Sum('clicks')).order_by('-clicks')[:50]
+        context = {
+            'days': days,
+            'job_statistics': job_statistics,
+            'newsletter_statistics': newsletter_statistics,
+            'link_statistics': link_statistics,
+            'opts': self.model._meta,
+            'app_label': self.model._meta.app_label,
+        }
+        return render_to_response('admin/pennyblack/jobstatistic/engagement.html', context)
+
+    def get_urls(self):
+        urls = super(JobStatisticAdmin, self).get_urls()
+        info = self.model._meta.app_label, self.model._meta.module_name
+        my_urls = patterns('',
+            url(r'^engagement/$', self.admin_site.admin_view(self.engagement_view), name='%s_%s_engagement' % info),
+            url(r'^(?P<object_id>\d+)/email-list/$', self.admin_site.admin_view(self.email_list_view), name='%s_%s_email_list' % info),
+            url(r'^(?P<object_id>\d+)/email-list/csv/$', self.admin_site.admin_view(self.email_list_csv_view), name='%s_%s_email_list_csv' % info),
+            url(r'^(?P<object_id>\d+)/user-agents/$', self.admin_site.admin_view(self.user_agents_view), name='%s_%s_user_agents' % info),
+        )
+        return my_urls + urls
+
+
+#-----------------------------------------------------------------------------
+# Sender
+#-----------------------------------------------------------------------------
+class SenderAdmin(admin.ModelAdmin):
+    list_display = ('email', 'name',)
+    fields = ('email', 'name', 'imap_username', 'imap_password', 'imap_server', 'imap_port', 'imap_ssl', 'get_bounce_emails', 'spf_result',)
+    readonly_fields = ('spf_result',)
 
-from pennyblack.models.newsletter import Newsletter, NewsletterAdmin
-from pennyblack.models.job import Job, JobAdmin, JobStatistic, JobStatisticAdmin
-from pennyblack.models.sender import Sender, SenderAdmin
 
 admin.site.register(Newsletter, NewsletterAdmin)
 
@@ -0,0 +1,176 @@
+"""
+A delivery engine which keeps many smtp sessions in flight on one asyncio
+event loop. It needs the trollius package.
+
+Set PENNYBLACK_DELIVERY_ENGINE to 'pennyblack.async_delivery.AsyncDeliveryEngine'
+to use it.
+"""
+import base64
+import smtplib
+import sys
+
+from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.message import sanitize_address
+from django.core.mail.utils import DNS_NAME
+from django.utils import translation
+
+import trollius as asyncio
+from trollius import From, Return
+
+from pennyblack import settings
+from pennyblack.delivery import DeliveryEngine, Throttled, record_result
+
+
+class SMTPSession(object):
+    """
+    A minimal smtp client for the event loop. It sends any number of
+    messages over one connection.
+    """
+    def __init__(self, loop, host=None, port=None, username=None, password=None, timeout=60):
+        self.loop = loop
+        self.host = host or django_settings.EMAIL_HOST
+        self.port = port or django_settings.EMAIL_PORT
+        self.username = django_settings.EMAIL_HOST_USER if username is None else username
+        self.password = django_settings.EMAIL_HOST_PASSWORD if password is None else password
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    @asyncio.coroutine
+    def read_reply(self):
+        """
+        Reads a possibly multiline reply, returns its code and text.
+        """
+        lines = []
+        while True:
+            line = yield From(asyncio.wait_for(self.reader.readline(), self.timeout, loop=self.loop))
+            if not line:
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip())
+            if line[3:4] != '-':
+                break
+        raise Return((int(line[:3]), '\n'.join(lines)))
+
+    @asyncio.coroutine
+    def command(self, cmd, expect=(250,)):
+        self.writer.write(cmd + '\r\n')
+        code, message = yield From(self.read_reply())
+        if code not in expect:
+            raise smtplib.SMTPResponseException(code, message)
+        raise Return((code, message))
+
+    @asyncio.coroutine
+    def connect(self):
+        if django_settings.EMAIL_USE_TLS:
+            raise ImproperlyConfigured('The asynchronous delivery engine does not support EMAIL_USE_TLS.')
+        if self.username and self.password and not settings.ASYNC_DELIVERY_PLAIN_AUTH:
+            raise ImproperlyConfigured('The asynchronous delivery engine only sends credentials over an '
+                                       'unencrypted connection if PENNYBLACK_ASYNC_DELIVERY_PLAIN_AUTH is set.')
+        self.reader, self.writer = yield From(asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, loop=self.loop), self.timeout, loop=self.loop))
+        code, message = yield From(self.read_reply())
+        if code != 220:
+            raise smtplib.SMTPConnectError(code, message)
+        try:
+            yield From(self.command('EHLO %s' % DNS_NAME.get_fqdn()))
+        except smtplib.SMTPResponseException:
+            yield From(self.command('HELO %s' % DNS_NAME.get_fqdn()))
+        if self.username and self.password:
+            credentials = base64.b64encode('\0%s\0%s' % (self.username, self.password))
+            yield From(self.command('AUTH PLAIN %s' % credentials, expect=(235,)))
+
+    @asyncio.coroutine
+    def send_message(self, message):
+        """
+        Sends a django EmailMessage. Raises SMTPRecipientsRefused if every
+        recipient was refused.
+        """
+        from_email = sanitize_address(message.from_email, message.encoding)
+        recipients = [sanitize_address(addr, message.encoding) for addr in message.recipients()]
+        yield From(self.command('MAIL FROM:<%s>' % from_email))
+        refused = {}
+        for recipient in recipients:
+            self.writer.write('RCPT TO:<%s>\r\n' % recipient)
+            code, text = yield From(self.read_reply())
+            if code not in (250, 251):
+                refused[recipient] = (code, text)
+        if len(refused) == len(recipients):
+            yield From(self.command('RSET'))
+            raise smtplib.SMTPRecipientsRefused(refused)
+        yield From(self.command('DATA', expect=(354,)))
+        data = smtplib.quotedata(message.message().as_string())
+        if not data.endswith('\r\n'):
+            data += '\r\n'
+        self.writer.write(data + '.\r\n')
+        yield From(self.writer.drain())
+        code, text = yield From(self.read_reply())
+        if code != 250:
+            raise smtplib.SMTPDataError(code, text)
+
+    @asyncio.coroutine
+    def quit(self):
+        if self.writer is None:
+            return
+        try:
+            yield From(self.command('QUIT', expect=(221,)))
+        except (smtplib.SMTPException, EnvironmentError, asyncio.TimeoutError):
+            pass
+        self.writer.close()
+        self.writer = None
+
+
+class AsyncDeliveryEngine(DeliveryEngine):
+    """
+    Delivers mails over concurrency smtp sessions on one event loop in the
+    calling thread. Every session takes the next mail as soon as the smtp
+    server has accepted its last one, so the sessions wait on the server
+    concurrently while the mails are rendered one at a time.
+    """
+    session_class = SMTPSession
+    blocking = False
+
+    def deliver(self, mails):
+        """
+        Sends every mail in the iterable mails.
+        """
+        if self.language:
+            translation.activate(self.language)
+        loop = asyncio.new_event_loop()
+        mails = iter(mails)
+        try:
+            sessions = [asyncio.Task(self._run_session(loop, mails), loop=loop) for i in range(self.concurrency)]
+            try:
+                loop.run_until_complete(asyncio.gather(*sessions, loop=loop))
+            except:
+                exc_info = sys.exc_info()
+                # stop the other sessions before the loop is closed
+                for session in sessions:
+                    session.cancel()
+                loop.run_until_complete(asyncio.wait(sessions, loop=loop))
+                raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            loop.close()
+            if self.status is not None:
+                self.status.flush()
+
+    @asyncio.coroutine
+    def _run_session(self, loop, mails):
+        session = self.session_class(loop)
+        yield From(session.connect())
+        try:
+            # the sessions share the iterator, the loop runs one of them at a time
+            for newsletter_mail in mails:
+                if isinstance(newsletter_mail, Throttled):
+                    # the other sessions keep talking to their servers
+                    yield From(asyncio.sleep(newsletter_mail.seconds, loop=loop))
+                    continue
+                message = newsletter_mail.get_message(render_plan=self.render_plan)
+                try:
+                    yield From(session.send_message(message))
+                except smtplib.SMTPRecipientsRefused:
+                    record_result(newsletter_mail, refused=True, status=self.status)
+                else:
+                    record_result(newsletter_mail, status=self.status)
+        finally:
+            yield From(session.quit())
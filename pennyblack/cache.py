@@ -0,0 +1,107 @@
+"""
+Caches for lookups which are done for every workflow mail.
+"""
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import models
+
+from pennyblack import settings
+
+
+def _freeze(value):
+    """
+    Returns the field values of a model instance, other values are returned
+    unchanged.
+    """
+    if isinstance(value, models.Model):
+        return (value.__class__, value._state.db,
+                dict((field.attname, getattr(value, field.attname)) for field in value._meta.fields))
+    return value
+
+
+def _thaw(value):
+    """
+    Returns a new model instance for the field values returned by _freeze.
+    """
+    if isinstance(value, tuple) and len(value) == 3 and isinstance(value[0], type) and issubclass(value[0], models.Model):
+        model, db, values = value
+        instance = model(**values)
+        instance._state.db = db
+        instance._state.adding = False
+        return instance
+    return value
+
+
+class WorkflowCache(object):
+    """
+    Caches workflow newsletters by name and language and their jobs by group
+    in the process. All entries are dropped whenever a newsletter or a
+    workflow job is saved or deleted and every entry expires after timeout
+    seconds.
+
+    Only the field values of model instances are cached, every lookup gets
+    its own instance, so instances are never shared between threads.
+
+    Signals only reach the process which made the change. If shared is True,
+    every lookup compares a generation counter stored in the django cache,
+    so a change made in any process clears the entries of all processes.
+    """
+    generation_key = 'pennyblack_workflow_cache_generation'
+    generation_timeout = 60 * 60 * 24 * 30
+
+    def __init__(self, enabled=None, shared=None, timeout=None):
+        if enabled is None:
+            enabled = settings.WORKFLOW_CACHE
+        if shared is None:
+            shared = settings.WORKFLOW_CACHE_SHARED
+        if timeout is None:
+            timeout = settings.WORKFLOW_CACHE_TIMEOUT
+        self.enabled = enabled
+        self.shared = shared
+        self.timeout = timeout
+        self.entries = {}
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def _check_generation(self):
+        generation = cache.get(self.generation_key)
+        if generation is None:
+            cache.add(self.generation_key, int(time.time() * 1000), self.generation_timeout)
+            generation = cache.get(self.generation_key)
+        if generation != self.generation:
+            with self.lock:
+                self.entries.clear()
+                self.generation = generation
+
+    def get(self, key, load):
+        """
+        Returns the cached value for key, calls load to get it if it isn't
+        cached yet or has expired.
+        """
+        if not self.enabled:
+            return load()
+        if self.shared:
+            self._check_generation()
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > time.time():
+            return _thaw(entry[0])
+        value = load()
+        self.entries[key] = (_freeze(value), time.time() + self.timeout)
+        return value
+
+    def invalidate(self, **kwargs):
+        """
+        Drops all entries, can be connected to model signals.
+        """
+        with self.lock:
+            self.entries.clear()
+        if self.shared:
+            try:
+                cache.incr(self.generation_key)
+            except ValueError:
+                cache.set(self.generation_key, int(time.time() * 1000), self.generation_timeout)
+
+
+workflow_cache = WorkflowCache()
@@ -12,10 +12,20 @@ from feincms.module.medialibrary.models import MediaFile
 
 import re
 import os
-from PIL import Image
 import exceptions
 
 HREF_RE = re.compile(r'href\="((\{\{[^}]+\}\}|[^"><])+)"')
+LINK_STYLE = '{% get_newsletterstyle request link_style %}'
+# matches all a tags which don't have the link style yet
+LINK_STYLE_RE = re.compile(r'<a (?!style="%s")' % re.escape(LINK_STYLE))
+
+
+def add_link_style(text):
+    """
+    Inserts the link style into all a tags of text, tags which already have
+    it are left alone.
+    """
+    return LINK_STYLE_RE.sub('<a style="%s" ' % LINK_STYLE, text)
 
 
 class NewsletterSectionAdminForm(RichTextContentAdminForm):
@@ -84,8 +94,10 @@ class TextOnlyNewsletterContent(RichTextContent):
         """
         insert link_style into all a tags
         """
-        self.text = re.sub(r"<a ", "<a style=\"{% get_newsletterstyle request link_style %}\"", self.text)
-        self.save()
+        text = add_link_style(self.text)
+        if text != self.text:
+            self.text = text
+            self.save()
 
     def get_template(self):
         """
@@ -97,13 +109,21 @@ class TextOnlyNewsletterContent(RichTextContent):
         {%% block text %%}%s{%% endblock %%}
         """ % (self.baselayout, self.title, self.text,))
 
+    def compile_template(self):
+        """
+        Compiles the template once, render uses it until the instance is
+        discarded. Only call this when title and text won't change anymore.
+        """
+        self._compiled_template = self.get_template()
+
     def render(self, request, **kwargs):
         context = request.content_context
         context['request'] = request
         context.update({'content': self, 'content_width': settings.NEWSLETTER_CONTENT_WIDTH})
         if hasattr(self, 'get_extra_context'):
             context.update(self.get_extra_context())
-        return self.get_template().render(Context(context))
+        template = getattr(self, '_compiled_template', None) or self.get_template()
+        return template.render(Context(context))
 
 
 class TextWithImageNewsletterContent(TextOnlyNewsletterContent):
@@ -141,9 +161,13 @@ class TextWithImageNewsletterContent(TextOnlyNewsletterContent):
         """
         if context is None:
             return self.image_url
-        template = Template(self.image_url_replaced)
+        template = getattr(self, '_compiled_image_url', None) or Template(self.image_url_replaced)
         return template.render(context)
 
+    def compile_template(self):
+        super(TextWithImageNewsletterContent, self).compile_template()
+        self._compiled_image_url = Template(self.image_url_replaced)
+
     def replace_links(self, job):
         super(TextWithImageNewsletterContent, self).replace_links(job)
         if not is_link(self.image_url, self.image_url_replaced):
@@ -152,6 +176,7 @@ class TextWithImageNewsletterContent(TextOnlyNewsletterContent):
 
     def save(self, *args, **kwargs):
         image_width = settings.NEWSLETTER_CONTENT_WIDTH if self.position == 'top' else settings.TEXT_AND_IMAGE_CONTENT_IMAGE_WIDTH_SIDE
+        from PIL import Image
         im = Image.open(self.image_original.file.path)
         im.thumbnail((image_width, 1000), Image.ANTIALIAS)
         img_temp = files.temp.NamedTemporaryFile()
@@ -1,4 +1,5 @@
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
 TINYMCE_CONFIG_URL = getattr(settings, 'PENNYBLACK_TINYMCE_CONFIG_URL', 'admin/pennyblack/tiny_mce/init.html')
 
@@ -11,6 +12,8 @@ NEWSLETTER_TYPE_WORKFLOW = getattr(settings, 'PENNYPLACK_NEWLETTER_TYPE_WORKFLOW
 
 # hide attachments by default
 NEWSLETTER_SHOW_ATTACHMENTS = getattr(settings, 'PENNYBLACK_NEWSLETTER_SHOW_ATTACHMENTS', False)
+# attachments bigger than this (in bytes) are memory mapped while they are encoded
+ATTACHMENT_MMAP_THRESHOLD = getattr(settings, 'PENNYBLACK_ATTACHMENT_MMAP_THRESHOLD', 1024 * 1024)
 
 JOB_STATUS = getattr(settings, 'PENNYBLACK_JOB_STATUS', ((1, 'Draft'), (11, 'Pending'), (21, 'Sending'), (31, 'Finished'), (41, 'Error'), (42, 'Timeout (will retry)'), (32, 'ReadOnly')))
 
@@ -19,6 +22,83 @@ JOB_STATUS_PENDING = getattr(settings, 'PENNYBLACK_JOB_STATUS_PENDING', (11, 42)
 JOB_STATUS_CAN_EDIT = getattr(settings, 'PENNYBLACK_JOB_STATUS_CAN_EDIT', (1,))
 JOB_STATUS_CAN_VIEW_PUBLIC = getattr(settings, 'PENNYBLACK_JOB_STATUS_CAN_VIEW_PUBLIC', (11, 21, 31, 42, 32))
 JOB_MAIL_INLINE_COUNT = getattr(settings, 'PENNYBLACK_JOB_MAIL_INLINE_COUNT', 50)
+# number of mails inserted at once when a job is created
+CREATE_MAILS_BATCH_SIZE = getattr(settings, 'PENNYBLACK_CREATE_MAILS_BATCH_SIZE', 1000)
+# the engine used to send jobs
+DELIVERY_ENGINE = getattr(settings, 'PENNYBLACK_DELIVERY_ENGINE', 'pennyblack.delivery.DeliveryEngine')
+# the asynchronous engine only sends credentials over unencrypted connections if this is set
+ASYNC_DELIVERY_PLAIN_AUTH = getattr(settings, 'PENNYBLACK_ASYNC_DELIVERY_PLAIN_AUTH', False)
+# number of smtp connections or sessions used in parallel to send a job
+SEND_CONCURRENCY = getattr(settings, 'PENNYBLACK_SEND_CONCURRENCY', 1)
+# number of mails loaded at once while sending
+SEND_CHUNK_SIZE = getattr(settings, 'PENNYBLACK_SEND_CHUNK_SIZE', 500)
+# split jobs into celery tasks of this many mails, 0 sends a job in one task
+SEND_SHARD_SIZE = getattr(settings, 'PENNYBLACK_SEND_SHARD_SIZE', 0)
+# per domain rate limits as {'domain': (mails per second, burst)}
+DOMAIN_RATE_LIMITS = getattr(settings, 'PENNYBLACK_DOMAIN_RATE_LIMITS', {})
+DOMAIN_DEFAULT_RATE_LIMIT = getattr(settings, 'PENNYBLACK_DOMAIN_DEFAULT_RATE_LIMIT', None)
+for _limit in DOMAIN_RATE_LIMITS.values() + [DOMAIN_DEFAULT_RATE_LIMIT]:
+    if _limit and not _limit[0] > 0:
+        raise ImproperlyConfigured('PENNYBLACK_DOMAIN_RATE_LIMITS and PENNYBLACK_DOMAIN_DEFAULT_RATE_LIMIT '
+                                   'need rates greater than 0, got %r' % (_limit,))
+# the status of sent mails is written every STATUS_FLUSH_COUNT mails or STATUS_FLUSH_INTERVAL seconds
+STATUS_FLUSH_COUNT = getattr(settings, 'PENNYBLACK_STATUS_FLUSH_COUNT', 100)
+STATUS_FLUSH_INTERVAL = getattr(settings, 'PENNYBLACK_STATUS_FLUSH_INTERVAL', 5)
+# smtp connections kept open for workflow newsletters and how long they may be idle (seconds)
+SMTP_POOL_SIZE = getattr(settings, 'PENNYBLACK_SMTP_POOL_SIZE', 4)
+SMTP_POOL_IDLE_TIMEOUT = getattr(settings, 'PENNYBLACK_SMTP_POOL_IDLE_TIMEOUT', 30)
+# cache workflow newsletters and their jobs for WORKFLOW_CACHE_TIMEOUT seconds, shared invalidates the caches of
+# all processes through the django cache
+WORKFLOW_CACHE = getattr(settings, 'PENNYBLACK_WORKFLOW_CACHE', True)
+WORKFLOW_CACHE_SHARED = getattr(settings, 'PENNYBLACK_WORKFLOW_CACHE_SHARED', True)
+WORKFLOW_CACHE_TIMEOUT = getattr(settings, 'PENNYBLACK_WORKFLOW_CACHE_TIMEOUT', 60)
+# queue workflow mails and send them in the background
+WORKFLOW_QUEUE = getattr(settings, 'PENNYBLACK_WORKFLOW_QUEUE', False)
+WORKFLOW_QUEUE_BATCH_SIZE = getattr(settings, 'PENNYBLACK_WORKFLOW_QUEUE_BATCH_SIZE', 50)
+# seconds a worker may take to send a batch before it's given to another worker
+WORKFLOW_QUEUE_LEASE_TIME = getattr(settings, 'PENNYBLACK_WORKFLOW_QUEUE_LEASE_TIME', 300)
+WORKFLOW_QUEUE_MAX_ATTEMPTS = getattr(settings, 'PENNYBLACK_WORKFLOW_QUEUE_MAX_ATTEMPTS', 5)
+# interval of the celery task which sends queued mails in seconds
+WORKFLOW_QUEUE_INTERVAL = getattr(settings, 'PENNYBLACK_WORKFLOW_QUEUE_INTERVAL', 10)
+# render a job once and fill in the receiver specific values for every mail
+SKELETON_RENDERING = getattr(settings, 'PENNYBLACK_SKELETON_RENDERING', False)
+# use signed tokens instead of the mail hash in tracking urls
+TRACKING_TOKENS = getattr(settings, 'PENNYBLACK_TRACKING_TOKENS', False)
+# log views and clicks to files in this directory and write them to the database later
+EVENT_LOG_DIR = getattr(settings, 'PENNYBLACK_EVENT_LOG_DIR', None)
+EVENT_LOG_ROTATE = getattr(settings, 'PENNYBLACK_EVENT_LOG_ROTATE', 60)
+# number of link targets and token links kept in memory and how long (seconds) they are cached
+LINK_CACHE_SIZE = getattr(settings, 'PENNYBLACK_LINK_CACHE_SIZE', 10000)
+LINK_CACHE_TIMEOUT = getattr(settings, 'PENNYBLACK_LINK_CACHE_TIMEOUT', 300)
+# serve the header image from the tracking view instead of redirecting to it
+PING_SERVE_IMAGE = getattr(settings, 'PENNYBLACK_PING_SERVE_IMAGE', True)
+# bigger header images are redirected to (bytes)
+PING_IMAGE_MAX_SIZE = getattr(settings, 'PENNYBLACK_PING_IMAGE_MAX_SIZE', 256 * 1024)
+# total size of the header images kept in memory (bytes) and how long they are kept (seconds)
+PING_CACHE_SIZE = getattr(settings, 'PENNYBLACK_PING_CACHE_SIZE', 16 * 1024 * 1024)
+PING_CACHE_TIMEOUT = getattr(settings, 'PENNYBLACK_PING_CACHE_TIMEOUT', 300)
+# the path the pennyblack urls are included under, used by the tracking wsgi application
+TRACKING_URL_PREFIX = getattr(settings, 'PENNYBLACK_TRACKING_URL_PREFIX', 'newsletter/')
+# total size of the compressed web views kept in memory (bytes) and how long they are kept (seconds)
+WEBVIEW_CACHE_SIZE = getattr(settings, 'PENNYBLACK_WEBVIEW_CACHE_SIZE', 32 * 1024 * 1024)
+WEBVIEW_CACHE_TIMEOUT = getattr(settings, 'PENNYBLACK_WEBVIEW_CACHE_TIMEOUT', 60 * 60)
+# how long the timelines of finished jobs are cached while views are still shown (seconds) and afterwards
+TIMELINE_CACHE_TIMEOUT = getattr(settings, 'PENNYBLACK_TIMELINE_CACHE_TIMEOUT', 5 * 60)
+TIMELINE_CACHE_TIMEOUT_FINAL = getattr(settings, 'PENNYBLACK_TIMELINE_CACHE_TIMEOUT_FINAL', 60 * 60 * 24 * 30)
+# add new opens and clicks to the hourly statistics periodically, every ROLLUP_INTERVAL seconds
+ROLLUP = getattr(settings, 'PENNYBLACK_ROLLUP', False)
+ROLLUP_INTERVAL = getattr(settings, 'PENNYBLACK_ROLLUP_INTERVAL', 5 * 60)
+# number of events added in one transaction
+ROLLUP_BATCH_SIZE = getattr(settings, 'PENNYBLACK_ROLLUP_BATCH_SIZE', 10000)
+# events are added once they were inserted at least ROLLUP_LAG seconds ago
+ROLLUP_LAG = getattr(settings, 'PENNYBLACK_ROLLUP_LAG', 60)
+# number of mails shown per page of the e-mail list and loaded at once for its csv export
+EMAIL_LIST_PAGE_SIZE = getattr(settings, 'PENNYBLACK_EMAIL_LIST_PAGE_SIZE', 100)
+EMAIL_LIST_CHUNK_SIZE = getattr(settings, 'PENNYBLACK_EMAIL_LIST_CHUNK_SIZE', 1000)
+# number of user agents classified and looked up kept in memory
+USER_AGENT_CACHE_SIZE = getattr(settings, 'PENNYBLACK_USER_AGENT_CACHE_SIZE', 10000)
+# number of clients normalized at once by normalizeuseragents
+USER_AGENT_BATCH_SIZE = getattr(settings, 'PENNYBLACK_USER_AGENT_BATCH_SIZE', 1000)
 # bounce detection
 BOUNCE_DETECTION_ENABLE = getattr(settings, 'PENNYBLACK_BOUNCE_DETECTION_ENABLE', False)
 BOUNCE_DETECTION_DAYS_TO_LOOK_BACK = getattr(settings, 'PENNYBLACK_BOUNCE_DETECTION_DAYS_TO_LOOK_BACK', 5)
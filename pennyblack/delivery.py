@@ -0,0 +1,490 @@
+"""
+The delivery engine pushes the mails of a job to the smtp server.
+
+Every worker owns its own smtp connection, renders the mails it takes from a
+shared queue and records the result of each mail in a status buffer which
+writes them to the database in bulk.
+"""
+import collections
+import Queue
+import smtplib
+import sys
+import threading
+import time
+
+from django import db
+from django.core import mail
+from django.utils import translation
+from django.utils.importlib import import_module
+
+from pennyblack import settings
+
+
+class TokenBucket(object):
+    """
+    Allows rate events per second on average and bursts of up to burst
+    events.
+    """
+    def __init__(self, rate, burst=1):
+        if not rate > 0:
+            raise ValueError('the rate has to be greater than 0, got %r' % rate)
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last = time.time()
+
+    def _refill(self):
+        current = time.time()
+        self.tokens = min(self.burst, self.tokens + (current - self.last) * self.rate)
+        self.last = current
+
+    def consume(self):
+        """
+        Takes a token, returns False if there is none.
+        """
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait_time(self):
+        """
+        Returns the seconds until the next token is available.
+        """
+        self._refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class Throttled(object):
+    """
+    Yielded by DomainScheduler.schedule instead of sleeping, no mail may be
+    sent for the next seconds.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class DomainScheduler(object):
+    """
+    Reorders mails so that mails to different destination domains are
+    interleaved and each domain is sent at most at its rate limit. A slow
+    domain therefore doesn't block the mails to all other domains.
+
+    rate_limits maps a domain to a (mails per second, burst) tuple, the limit
+    also applies to all subdomains. Domains without a limit use default_limit
+    or aren't limited if it's None. At most lookahead mails are held back,
+    four times as many if all held back mails are throttled.
+    """
+    def __init__(self, rate_limits=None, default_limit=None, lookahead=None):
+        if rate_limits is None:
+            rate_limits = settings.DOMAIN_RATE_LIMITS
+        if default_limit is None:
+            default_limit = settings.DOMAIN_DEFAULT_RATE_LIMIT
+        if lookahead is None:
+            lookahead = settings.SEND_CHUNK_SIZE
+        self.rate_limits = dict((domain.lower(), limit) for domain, limit in rate_limits.items())
+        self.default_limit = default_limit
+        self.lookahead = lookahead
+        self.buckets = {}
+
+    def get_domain(self, newsletter_mail):
+        """
+        Returns the domain whose rate limit applies to newsletter_mail.
+        """
+        domain = newsletter_mail.person.get_email().rpartition('@')[2].lower()
+        parts = domain.split('.')
+        for i in range(len(parts)):
+            parent = '.'.join(parts[i:])
+            if parent in self.rate_limits:
+                return parent
+        return domain
+
+    def get_bucket(self, domain):
+        if domain not in self.buckets:
+            limit = self.rate_limits.get(domain, self.default_limit)
+            self.buckets[domain] = TokenBucket(*limit) if limit else None
+        return self.buckets[domain]
+
+    def schedule(self, mails, sleep=True):
+        """
+        Yields all mails of the iterable mails in the order they should be
+        sent, sleeps while every pending domain is throttled. If sleep is
+        False, a Throttled instance is yielded instead so the caller can wait
+        without blocking.
+        """
+        mails = iter(mails)
+        queues = {}
+        rotation = collections.deque()
+        pending = 0
+        exhausted = False
+        lookahead = self.lookahead
+        while True:
+            while not exhausted and pending < lookahead:
+                try:
+                    newsletter_mail = mails.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                domain = self.get_domain(newsletter_mail)
+                if domain not in queues:
+                    queues[domain] = collections.deque()
+                    rotation.append(domain)
+                queues[domain].append(newsletter_mail)
+                pending += 1
+            if not pending:
+                return
+            for i in range(len(rotation)):
+                domain = rotation[0]
+                rotation.rotate(-1)
+                bucket = self.get_bucket(domain)
+                if bucket is None or bucket.consume():
+                    newsletter_mail = queues[domain].popleft()
+                    if not queues[domain]:
+                        del queues[domain]
+                        rotation.remove(domain)
+                    pending -= 1
+                    lookahead = self.lookahead
+                    yield newsletter_mail
+                    break
+            else:
+                if not exhausted and lookahead < self.lookahead * 4:
+                    # look for mails to other domains first
+                    lookahead += self.lookahead
+                    continue
+                seconds = min(self.get_bucket(domain).wait_time() for domain in rotation)
+                if sleep:
+                    time.sleep(seconds)
+                else:
+                    yield Throttled(seconds)
+
+
+class StatusBuffer(object):
+    """
+    Collects sent and bounced mails and writes their status to the database
+    in bulk, every flush_count mails or after flush_interval seconds.
+
+    A mail counts as sent only after its batch is flushed. If the process
+    dies, the mails of the unflushed batch are sent again after a restart,
+    but a mail that was flushed as sent is never sent twice.
+    """
+    def __init__(self, flush_count=None, flush_interval=None):
+        if flush_count is None:
+            flush_count = settings.STATUS_FLUSH_COUNT
+        if flush_interval is None:
+            flush_interval = settings.STATUS_FLUSH_INTERVAL
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self.sent = []
+        self.bounced = []
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+
+    def mark_sent(self, newsletter_mail):
+        self._add(self.sent, newsletter_mail)
+
+    def bounce(self, newsletter_mail):
+        self._add(self.bounced, newsletter_mail)
+
+    def _add(self, mails, newsletter_mail):
+        with self.lock:
+            mails.append(newsletter_mail)
+            due = (len(self.sent) + len(self.bounced) >= self.flush_count or
+                   time.time() - self.last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the collected status of all mails, afterwards the bounce
+        handlers of the receivers are called.
+        """
+        from pennyblack.models import Mail
+        with self.lock:
+            sent, self.sent = self.sent, []
+            bounced, self.bounced = self.bounced, []
+            self.last_flush = time.time()
+        Mail.objects.update_status(sent, sent=True)
+        Mail.objects.update_status(bounced, bounced=True)
+        for newsletter_mail in bounced:
+            newsletter_mail.person.on_bounce(newsletter_mail)
+
+
+class ConnectionPool(object):
+    """
+    Keeps opened smtp connections around so that single mails don't pay for
+    the connection setup every time.
+
+    At most size connections are open at the same time, acquire blocks until
+    one is released. A connection that has been idle for more than
+    idle_timeout seconds is closed, every other connection is checked with a
+    NOOP before it is handed out.
+    """
+    def __init__(self, size=None, idle_timeout=None, get_connection=None):
+        if size is None:
+            size = settings.SMTP_POOL_SIZE
+        if idle_timeout is None:
+            idle_timeout = settings.SMTP_POOL_IDLE_TIMEOUT
+        self.size = max(1, int(size))
+        self.idle_timeout = idle_timeout
+        self.get_connection = get_connection or mail.get_connection
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.size)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _is_usable(self, connection):
+        smtp = getattr(connection, 'connection', None)
+        if smtp is None:
+            # not an smtp backend, there is nothing to check
+            return True
+        try:
+            return smtp.noop()[0] == 250
+        except (smtplib.SMTPException, EnvironmentError):
+            return False
+
+    def acquire(self):
+        """
+        Returns an opened connection, which has to be given back with
+        release.
+        """
+        self.slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    connection, last_used = self.idle.pop()
+                if time.time() - last_used <= self.idle_timeout and self._is_usable(connection):
+                    return connection
+                self._close(connection)
+            connection = self.get_connection()
+            connection.open()
+            return connection
+        except:
+            self.slots.release()
+            raise
+
+    def release(self, connection, discard=False):
+        """
+        Puts connection back into the pool, closes it if discard is True.
+        Connections idle for longer than the idle timeout are closed.
+        """
+        current = time.time()
+        expired = []
+        with self.lock:
+            if not discard:
+                self.idle.append((connection, current))
+            for item in list(self.idle):
+                if current - item[1] > self.idle_timeout:
+                    self.idle.remove(item)
+                    expired.append(item[0])
+        if discard:
+            expired.append(connection)
+        for item in expired:
+            self._close(item)
+        self.slots.release()
+
+    def send(self, message):
+        """
+        Sends a django EmailMessage over a pooled connection.
+        """
+        connection = self.acquire()
+        try:
+            connection.send_messages([message])
+        except smtplib.SMTPRecipientsRefused:
+            # the server refused the message, the connection is fine
+            self.release(connection)
+            raise
+        except:
+            self.release(connection, discard=True)
+            raise
+        self.release(connection)
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, last_used in idle:
+            self._close(connection)
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """
+    Returns the smtp connection pool of this process.
+    """
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = ConnectionPool()
+        return _connection_pool
+
+
+def record_result(newsletter_mail, refused=False, status=None):
+    """
+    Marks newsletter_mail as sent or, if the recipient was refused, as
+    bounced. The result is written by status if a status buffer is given.
+    """
+    if status is None:
+        status = newsletter_mail
+        args = ()
+    else:
+        args = (newsletter_mail,)
+    if refused:
+        status.bounce(*args)
+    else:
+        status.mark_sent(*args)
+
+
+def get_delivery_engine(*args, **kwargs):
+    """
+    Returns an instance of the delivery engine set in DELIVERY_ENGINE.
+    """
+    module_name, class_name = settings.DELIVERY_ENGINE.rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)(*args, **kwargs)
+
+
+class DeliveryWorker(object):
+    """
+    Sends mails over a single smtp connection.
+    """
+    def __init__(self, language=None, connection=None, render_plan=None, status=None):
+        self.language = language
+        self.connection = connection
+        self.render_plan = render_plan
+        self.status = status
+
+    def open(self):
+        if self.language:
+            translation.activate(self.language)
+        if self.connection is None:
+            self.connection = mail.get_connection()
+        self.connection.open()
+
+    def close(self):
+        self.connection.close()
+
+    def deliver(self, newsletter_mail):
+        """
+        Sends a single mail and marks it as sent or bounced.
+        """
+        try:
+            self.connection.send_messages([newsletter_mail.get_message(render_plan=self.render_plan)])
+        except smtplib.SMTPRecipientsRefused:
+            record_result(newsletter_mail, refused=True, status=self.status)
+        else:
+            record_result(newsletter_mail, status=self.status)
+
+
+class DeliveryEngine(object):
+    """
+    Delivers mails through a pool of workers, each with its own smtp
+    connection. With a concurrency of 1 everything happens in the calling
+    thread.
+
+    If a status buffer is given, the results are written in bulk. The buffer
+    is flushed when delivering ends, even if it ends with an error.
+    """
+    worker_class = DeliveryWorker
+    # whether mails may be taken from a scheduler which sleeps, otherwise it
+    # yields Throttled instances
+    blocking = True
+
+    def __init__(self, concurrency=None, language=None, render_plan=None, status=None):
+        if concurrency is None:
+            concurrency = settings.SEND_CONCURRENCY
+        self.concurrency = max(1, int(concurrency))
+        self.language = language
+        self.render_plan = render_plan
+        self.status = status
+
+    def get_worker(self):
+        return self.worker_class(language=self.language, render_plan=self.render_plan, status=self.status)
+
+    def deliver(self, mails):
+        """
+        Sends every mail in the iterable mails.
+        """
+        try:
+            if self.concurrency == 1:
+                worker = self.get_worker()
+                worker.open()
+                try:
+                    for newsletter_mail in mails:
+                        worker.deliver(newsletter_mail)
+                finally:
+                    worker.close()
+            else:
+                self._deliver_parallel(mails)
+        finally:
+            if self.status is not None:
+                self.status.flush()
+
+    def _deliver_parallel(self, mails):
+        queue = Queue.Queue(maxsize=self.concurrency * 2)
+        failed = threading.Event()
+        errors = []
+        threads = [threading.Thread(target=self._run_worker, args=(queue, failed, errors))
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for newsletter_mail in mails:
+                if not self._put(queue, newsletter_mail, failed):
+                    break
+        finally:
+            for thread in threads:
+                if not self._put(queue, None, failed):
+                    break
+            for thread in threads:
+                thread.join()
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+    def _put(self, queue, item, failed):
+        """
+        Puts item into the queue, gives up if a worker has failed and
+        therefore nobody might take it anymore.
+        """
+        while True:
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                if failed.is_set():
+                    return False
+
+    def _run_worker(self, queue, failed, errors):
+        worker = self.get_worker()
+        try:
+            worker.open()
+            try:
+                while not failed.is_set():
+                    try:
+                        newsletter_mail = queue.get(timeout=0.5)
+                    except Queue.Empty:
+                        continue
+                    if newsletter_mail is None:
+                        break
+                    worker.deliver(newsletter_mail)
+            finally:
+                worker.close()
+        except:
+            errors.append(sys.exc_info())
+            failed.set()
+        finally:
+            # every thread uses its own database connection
+            db.close_connection()
@@ -0,0 +1,190 @@
+"""
+Write-behind log for tracking events. The tracking views append views and
+clicks to a local file instead of writing them to the database, flush_events
+writes them in bulk.
+
+Every process appends to its own file, a new file is started every
+EVENT_LOG_ROTATE seconds. Only files of periods which ended at least one
+period ago are flushed, so the flusher never reads a file which is still
+written to. A flusher renames a file before it reads it, so concurrent
+flushers never write the same events.
+"""
+import datetime
+import errno
+import glob
+import json
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings as django_settings
+from django.db import transaction
+from django.utils.encoding import smart_unicode
+
+from pennyblack import settings
+
+try:
+    from django.utils import timezone
+except ImportError:
+    timezone = None
+
+VIEW = 'v'
+CLICK = 'c'
+
+# a view from the same client within this time creates no new EmailClient
+CLIENT_DEDUP_TIME = 60 * 60
+
+_log_file = None
+_previous_fd = None
+_log_lock = threading.Lock()
+
+
+def is_enabled():
+    return bool(settings.EVENT_LOG_DIR)
+
+
+def _get_period(timestamp):
+    return int(timestamp) // settings.EVENT_LOG_ROTATE
+
+
+def _get_file(period):
+    """
+    Returns the file descriptor of this process for period.
+    """
+    global _log_file, _previous_fd
+    path = os.path.join(settings.EVENT_LOG_DIR, 'events-%d-%s-%d.log' % (period, socket.gethostname(), os.getpid()))
+    with _log_lock:
+        if _log_file is None or _log_file[0] != path or _log_file[1] != os.getpid():
+            # another thread might still be writing to the last file
+            if _previous_fd is not None:
+                os.close(_previous_fd)
+                _previous_fd = None
+            if _log_file is not None and _log_file[1] == os.getpid():
+                _previous_fd = _log_file[2]
+            _log_file = (path, os.getpid(), os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644))
+        return _log_file[2]
+
+
+def log_event(kind, mail_id, link_id=None, request=None, contact_type=''):
+    """
+    Appends an event to the log of this process.
+    """
+    timestamp = time.time()
+    event = [kind, mail_id, link_id, timestamp]
+    if request is not None:
+        # headers are byte strings which aren't necessarily utf-8
+        event.extend((smart_unicode(request.META.get('HTTP_USER_AGENT', ''), errors='replace'),
+                      request.META.get('REMOTE_ADDR', ''),
+                      smart_unicode(request.META.get('HTTP_REFERER', ''), errors='replace'), contact_type))
+    # a single write to a file opened for appending is never interleaved
+    os.write(_get_file(_get_period(timestamp)), json.dumps(event) + '\n')
+
+
+def _to_datetime(timestamp):
+    if timezone is not None and getattr(django_settings, 'USE_TZ', False):
+        return datetime.datetime.fromtimestamp(timestamp, timezone.utc)
+    return datetime.datetime.fromtimestamp(timestamp)
+
+
+def read_events(path):
+    events = []
+    with open(path, 'rb') as log:
+        for line in log:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # the last line is incomplete if a process died while writing
+                pass
+    return events
+
+
+def write_events(events):
+    """
+    Writes the views and clicks of events to the database.
+    """
+    from pennyblack.models import EmailClient, LinkClick, Mail, UserAgent
+    viewed = {}
+    clients = []
+    clicks = []
+    for event in events:
+        kind, mail_id, link_id, timestamp = event[:4]
+        date = _to_datetime(timestamp)
+        if mail_id not in viewed or date < viewed[mail_id]:
+            viewed[mail_id] = date
+        if len(event) > 4:
+            clients.append((mail_id, date, event[4], event[5], event[6][:1023], event[7]))
+        if kind == CLICK:
+            clicks.append(LinkClick(link_id=link_id, mail_id=mail_id, date=date))
+    Mail.objects.mark_viewed(viewed)
+    if clients:
+        agent_ids = UserAgent.objects.get_ids(client[2] for client in clients)
+        clients = [client[:2] + (agent_ids[client[2]],) + client[3:] for client in clients]
+        # like Mail.mark_viewed every client is stored once per hour
+        last_visits = {}
+        existing = EmailClient.objects.filter(
+            mail__in=set(client[0] for client in clients),
+            visited__gt=min(client[1] for client in clients) - datetime.timedelta(seconds=CLIENT_DEDUP_TIME))
+        for client in existing.values_list('mail', 'visited', 'agent', 'ip_address', 'referer', 'contact_type'):
+            key = (client[0],) + client[2:]
+            last_visits[key] = max(last_visits.get(key, client[1]), client[1])
+        new_clients = []
+        for client in sorted(clients, key=lambda client: client[1]):
+            key = (client[0],) + client[2:]
+            if key in last_visits and client[1] - last_visits[key] < datetime.timedelta(seconds=CLIENT_DEDUP_TIME):
+                continue
+            last_visits[key] = client[1]
+            new_clients.append(EmailClient(mail_id=client[0], visited=client[1], agent_id=client[2],
+                                           ip_address=client[3], referer=client[4], contact_type=client[5]))
+        EmailClient.objects.bulk_create(new_clients)
+    LinkClick.objects.bulk_create(clicks)
+    Mail.objects.mark_clicked(click.mail_id for click in clicks)
+
+
+def _claim(path):
+    """
+    Renames a log file to a file of this flusher, returns the new path or
+    None if another flusher claimed it first.
+    """
+    claimed = os.path.join(os.path.dirname(path), 'flushing-%s-%d-%s' % (
+        socket.gethostname(), os.getpid(), os.path.basename(path)))
+    try:
+        os.rename(path, claimed)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    return claimed
+
+
+def flush_events():
+    """
+    Writes all events of finished periods to the database and deletes their
+    files. Returns the number of events.
+
+    The events of a file are written in one transaction. If writing them
+    fails, the file gets its old name back and is flushed again next time.
+    Only if the flusher process dies the file is left as
+    flushing-<host>-<pid>-<name>, whether its events were written depends on
+    whether the transaction was committed.
+    """
+    current = _get_period(time.time())
+    count = 0
+    for path in sorted(glob.glob(os.path.join(settings.EVENT_LOG_DIR, 'events-*.log'))):
+        period = int(os.path.basename(path).split('-')[1])
+        # events are written to the file of the last period for a moment
+        if period >= current - 1:
+            continue
+        claimed = _claim(path)
+        if claimed is None:
+            continue
+        try:
+            events = read_events(claimed)
+            with transaction.commit_on_success():
+                write_events(events)
+        except:
+            os.rename(claimed, path)
+            raise
+        os.remove(claimed)
+        count += len(events)
+    return count
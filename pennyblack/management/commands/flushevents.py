@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+from pennyblack import events
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Writes the logged views and clicks to the database'
+
+    def handle(self, *args, **options):
+        if not events.is_enabled():
+            raise CommandError('PENNYBLACK_EVENT_LOG_DIR is not set.')
+        print u"%s events written" % events.flush_events()
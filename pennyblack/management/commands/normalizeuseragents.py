@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from pennyblack.models.emailclient import normalize_user_agents
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Moves the user agent strings of the email clients to the user agent table'
+
+    def handle(self, *args, **options):
+        print u"%s email clients normalized" % normalize_user_agents()
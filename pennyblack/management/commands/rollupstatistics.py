@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from pennyblack.models.rollup import rollup_statistics
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Adds the new opens and clicks to the hourly statistics'
+
+    def handle(self, *args, **options):
+        print u"%s events added" % rollup_statistics()
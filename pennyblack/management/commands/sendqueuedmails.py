@@ -0,0 +1,24 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from pennyblack.models import QueuedMail
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Sends all queued workflow mails'
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep waiting for new mails when the queue is empty.'),
+        make_option('--interval', type='int', dest='interval', default=5,
+            help='Seconds to wait between polls of an empty queue.'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            while QueuedMail.objects.send_batch():
+                pass
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from pennyblack.models import Job
+
+
+class Command(BaseCommand):
+    args = '[job_id ...]'
+    help = 'Counts the mails of the given or all jobs again and stores the counters'
+
+    def handle(self, *args, **options):
+        jobs = Job.objects.all()
+        if args:
+            jobs = jobs.filter(pk__in=args)
+        count = 0
+        for job in jobs.iterator():
+            job.update_counters()
+            count += 1
+        print u"counters of %s jobs updated" % count
@@ -1,9 +1,11 @@
 # coding=utf-8
 from pennyblack.models.newsletter import Newsletter
-from pennyblack.models.job import Job, JobStatistic
+from pennyblack.models.job import Job, JobCounters, JobStatistic
 from pennyblack.models.link import Link, LinkClick
 from pennyblack.models.mail import Mail
+from pennyblack.models.queue import QueuedMail
+from pennyblack.models.rollup import JobHourlyStatistic, LinkHourlyStatistic, RollupWatermark
 from pennyblack.models.sender import Sender
-from pennyblack.models.emailclient import EmailClient
+from pennyblack.models.emailclient import EmailClient, UserAgent
 
-__all__ = ('Newsletter', 'Job', 'JobStatistic', 'Link', 'LinkClick', 'Mail', 'Sender', 'EmailClient')
+__all__ = ('Newsletter', 'Job', 'JobCounters', 'JobStatistic', 'Link', 'LinkClick', 'Mail', 'QueuedMail', 'JobHourlyStatistic', 'LinkHourlyStatistic', 'RollupWatermark', 'Sender', 'EmailClient', 'UserAgent')
@@ -2,9 +2,15 @@
 http://user-agent-string.info/
 """
 from django.db import models
+from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext_lazy as _
 
+from pennyblack import settings
+from pennyblack.useragents import classify
+from pennyblack.utils import LRUCache
+
 import datetime
+import hashlib
 try:
     from django.utils import timezone
 except ImportError:
@@ -12,13 +18,79 @@ except ImportError:
 else:
     now = timezone.now
 
+_user_agent_ids = LRUCache(settings.USER_AGENT_CACHE_SIZE)
+
+
+def _normalize(user_agent):
+    # headers are byte strings which aren't necessarily utf-8
+    return smart_unicode(user_agent, errors='replace')[:255]
+
+
+def _hash(user_agent):
+    return hashlib.sha1(user_agent.encode('utf-8')).hexdigest()
+
+
+class UserAgentManager(models.Manager):
+    def get_ids(self, user_agents):
+        """
+        Returns a dict mapping the user agent strings to the ids of their
+        user agents, missing user agents are created.
+        """
+        normalized = dict((user_agent, _normalize(user_agent)) for user_agent in user_agents)
+        ids = {}
+        missing = {}
+        for user_agent in set(normalized.values()):
+            user_agent_id = _user_agent_ids.get(user_agent)
+            if user_agent_id is None:
+                missing[_hash(user_agent)] = user_agent
+            else:
+                ids[user_agent] = user_agent_id
+        if missing:
+            found = dict(self.filter(user_agent_hash__in=missing.keys()).values_list('user_agent_hash', 'id'))
+            for user_agent_hash, user_agent in missing.items():
+                if user_agent_hash not in found:
+                    family, version, device = classify(user_agent)
+                    found[user_agent_hash] = self.get_or_create(user_agent_hash=user_agent_hash, defaults={
+                        'user_agent': user_agent, 'family': family, 'version': version, 'device': device})[0].id
+                ids[user_agent] = found[user_agent_hash]
+                _user_agent_ids.set(user_agent, found[user_agent_hash])
+        return dict((user_agent, ids[normalized[user_agent]]) for user_agent in normalized)
+
+    def get_id(self, user_agent):
+        return self.get_ids([user_agent])[user_agent]
+
+
+class UserAgent(models.Model):
+    """
+    A user agent string, stored once and classified by client family,
+    version and device class.
+    """
+    user_agent = models.CharField(max_length=255)
+    user_agent_hash = models.CharField(max_length=40, unique=True)
+    family = models.CharField(verbose_name=_('family'), max_length=50, db_index=True)
+    version = models.CharField(verbose_name=_('version'), max_length=20, blank=True)
+    device = models.CharField(verbose_name=_('device'), max_length=20)
+
+    objects = UserAgentManager()
+
+    class Meta:
+        verbose_name = _('user agent')
+        verbose_name_plural = _('user agents')
+        app_label = 'pennyblack'
+
+    def __unicode__(self):
+        return self.user_agent
+
 
 class EmailClient(models.Model):
     """
     Stores some information about the used email client and about the user
     """
     mail = models.ForeignKey('pennyblack.Mail', related_name='clients')
-    user_agent = models.CharField(max_length=255, db_index=True)
+    agent = models.ForeignKey(UserAgent, related_name='clients', null=True, blank=True)
+    # clients stored before the user agents were normalized, emptied by
+    # normalize_user_agents
+    user_agent = models.CharField(max_length=255, blank=True)
     referer = models.CharField(max_length=1023, blank=True)
     ip_address = models.IPAddressField()
     visited = models.DateTimeField(default=now)
@@ -30,4 +102,31 @@ class EmailClient(models.Model):
         app_label = 'pennyblack'
 
     def __unicode__(self):
+        if self.agent_id is not None:
+            return unicode(self.agent)
         return self.user_agent
+
+
+def normalize_user_agents(batch_size=None):
+    """
+    Moves the user agent strings of the clients stored before the user agents
+    were normalized to the user agent table, batch_size clients at a time.
+    Returns the number of clients.
+    """
+    if batch_size is None:
+        batch_size = settings.USER_AGENT_BATCH_SIZE
+    count = 0
+    after = 0
+    while True:
+        clients = list(EmailClient.objects.filter(pk__gt=after, agent=None).exclude(user_agent='')
+                       .order_by('pk').values_list('pk', 'user_agent')[:batch_size])
+        if not clients:
+            return count
+        ids = UserAgent.objects.get_ids(user_agent for pk, user_agent in clients)
+        by_agent = {}
+        for pk, user_agent in clients:
+            by_agent.setdefault(ids[user_agent], []).append(pk)
+        for agent_id, pks in by_agent.items():
+            EmailClient.objects.filter(pk__in=pks).update(agent=agent_id, user_agent='')
+        count += len(clients)
+        after = clients[-1][0]
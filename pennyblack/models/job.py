@@ -1,21 +1,18 @@
-from django import forms
-from django.contrib import admin
-from django.contrib.admin.util import unquote
-from django.conf.urls.defaults import patterns, url
 from django.contrib.contenttypes import generic
-from django.core import mail
-from django.core.context_processors import csrf
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.db import models
-from django.http import HttpResponseRedirect
-from django.shortcuts import render_to_response
+from django.db.models import signals
 from django.utils import translation
 from django.utils.translation import ugettext_lazy as _
-import smtplib
 
 from pennyblack import settings
+from pennyblack.cache import workflow_cache
+from pennyblack.delivery import DomainScheduler, StatusBuffer, get_delivery_engine
+from pennyblack.rendering import RenderPlan
 
+import collections
 import datetime
+import itertools
 
 try:
     from django.utils import timezone
@@ -82,13 +79,41 @@ class Job(models.Model):
         return None
 
 
+    def get_counters(self):
+        """
+        Returns the counters of the job, they are created if they don't
+        exist yet.
+        """
+        try:
+            return self.counters
+        except JobCounters.DoesNotExist:
+            self.counters = JobCounters.objects.get_or_create(job=self)[0]
+            return self.counters
+
+    def update_counters(self):
+        """
+        Counts the mails of the job again and stores the counters.
+        """
+        self.mails.filter(clicked=False, clicks__isnull=False).update(clicked=True)
+        counters = {
+            'mails_total': self.mails.count(),
+            'mails_sent': self.mails.filter(sent=True).count(),
+            'mails_bounced': self.mails.filter(bounced=True).count(),
+            'mails_viewed': self.mails.exclude(viewed=None).count(),
+            'mails_clicked': self.mails.filter(clicked=True).count(),
+        }
+        self.get_counters()
+        JobCounters.objects.filter(job=self).update(**counters)
+        for name, value in counters.items():
+            setattr(self.counters, name, value)
+
     @property
     def count_mails_total(self):
-        return self.mails.count()
+        return self.get_counters().mails_total
 
     @property
     def count_mails_sent(self):
-        return self.mails.filter(sent=True).count()
+        return self.get_counters().mails_sent
 
     @property
     def percentage_mails_sent(self):
@@ -98,7 +123,7 @@ class Job(models.Model):
 
     @property
     def count_mails_viewed(self):
-        return self.mails.exclude(viewed=None).count()
+        return self.get_counters().mails_viewed
 
     @property
     def count_mails_delivered(self):
@@ -112,11 +137,11 @@ class Job(models.Model):
 
     @property
     def count_mails_bounced(self):
-        return self.mails.filter(bounced=True).count()
+        return self.get_counters().mails_bounced
 
     @property
     def count_mails_clicked(self):
-        return self.mails.filter(clicks__isnull=False).count()
+        return self.get_counters().mails_clicked
 
     @property
     def percentage_mails_clicked(self):
@@ -164,23 +189,39 @@ class Job(models.Model):
             return False
         return True
 
-    def create_mails(self, queryset):
+    def create_mails(self, queryset, batch_size=None):
         """
-        Create mails for every NewsletterReceiverMixin in queryset.
+        Create mails for every NewsletterReceiverMixin in queryset. The mails
+        are inserted in batches of batch_size, so only one batch is held in
+        memory at a time.
         """
+        if batch_size is None:
+            batch_size = settings.CREATE_MAILS_BATCH_SIZE
         if hasattr(queryset, 'iterator') and callable(queryset.iterator):
-            for receiver in queryset.iterator():
-                self.create_mail(receiver)
+            receivers = queryset.iterator()
         else:
-            for receiver in queryset:
-                self.create_mail(receiver)
+            receivers = iter(queryset)
+        while True:
+            batch = list(itertools.islice(receivers, batch_size))
+            if not batch:
+                break
+            self._create_mail_batch(batch)
+
+    def _create_mail_batch(self, receivers):
+        from pennyblack.models.mail import Mail, make_mail_hashes
+        mail_hashes = make_mail_hashes(len(receivers))
+        Mail.objects.bulk_create([Mail(job=self, person=receiver, mail_hash=mail_hash)
+                                  for receiver, mail_hash in zip(receivers, mail_hashes)])
+        JobCounters.objects.increment(self.pk, mails_total=len(receivers))
 
     def create_mail(self, receiver):
         """
         Creates a single mail. This is also used in workflow mail send process.
         receiver has to implement all the methods from NewsletterReceiverMixin
         """
-        return self.mails.create(person=receiver)
+        mail = self.mails.create(person=receiver)
+        JobCounters.objects.increment(self.pk, mails_total=1)
+        return mail
 
     def add_link(self, link, identifier=''):
         """
@@ -198,7 +239,58 @@ class Job(models.Model):
         link.save()
         return '{{base_url}}' + reverse('pennyblack.redirect_link', kwargs={'mail_hash': '{{mail.mail_hash}}', 'link_hash': link.link_hash}).replace('%7B', '{').replace('%7D', '}')
 
+    def iter_pending_mails(self, chunk_size=None, min_id=None, max_id=None):
+        """
+        Iterates over all unsent mails in chunks of chunk_size, optionally
+        only over the mails with a primary key between min_id and max_id.
+        The receivers of a chunk are loaded with one query per content type
+        and every mail shares this job instance, so the newsletter, its
+        sender and content are only loaded once.
+        """
+        from pennyblack.models.mail import load_persons
+        if chunk_size is None:
+            chunk_size = settings.SEND_CHUNK_SIZE
+        # load everything shared by all mails before they are handed out
+        self.newsletter.sender
+        self.group_object
+        mails = self.mails.filter(sent=False)
+        if max_id is not None:
+            mails = mails.filter(pk__lte=max_id)
+        last_id = 0 if min_id is None else min_id - 1
+        while True:
+            chunk = list(mails.filter(pk__gt=last_id).order_by('pk')[:chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1].pk
+            load_persons(chunk)
+            for newsletter_mail in chunk:
+                newsletter_mail.job = self
+                yield newsletter_mail
+
+    def get_shards(self, shard_size=None):
+        """
+        Splits the unsent mails into ranges of primary keys with at most
+        shard_size mails each and returns them as list of (min_id, max_id)
+        tuples. Returns an empty list if sharding is disabled.
+        """
+        if shard_size is None:
+            shard_size = settings.SEND_SHARD_SIZE
+        if not shard_size:
+            return []
+        shards = []
+        mail_ids = self.mails.filter(sent=False).order_by('pk').values_list('pk', flat=True)
+        for index, mail_id in enumerate(mail_ids.iterator()):
+            if index % shard_size == 0:
+                shards.append([mail_id, mail_id])
+            else:
+                shards[-1][1] = mail_id
+        return [tuple(shard) for shard in shards]
+
     def start_sending(self):
+        """
+        Marks the job for delivery. If celery is available the job is sent
+        by a task, which fans out to one sub task per shard.
+        """
         self.status = 11
         self.save()
         try:
@@ -212,178 +304,103 @@ class Job(models.Model):
         """
         Sends every pending e-mail in the job.
         """
+        self.prepare_sending()
+        self.send_mails()
+        self.finish_sending()
+
+    def prepare_sending(self):
+        """
+        Replaces the newsletter with a snapshot ready to be sent and marks
+        the job as sending.
+        """
         self.newsletter = self.newsletter.create_snapshot()
         self.newsletter.replace_links(self)
         self.newsletter.prepare_to_send()
         self.status = 21
         self.date_deliver_start = now()
         self.save()
+
+    def send_mails(self, min_id=None, max_id=None):
+        """
+        Sends the pending e-mails, optionally only the ones with a primary
+        key between min_id and max_id. Marks the job as failed if sending
+        raises an error.
+        """
         try:
             translation.activate(self.newsletter.language)
-            connection = mail.get_connection()
-            connection.open()
-            for newsletter_mail in self.mails.filter(sent=False).iterator():
-                try:
-                    connection.send_messages([newsletter_mail.get_message()])
-                except smtplib.SMTPRecipientsRefused as e:
-                    newsletter_mail.bounce()
-                else:
-                    newsletter_mail.mark_sent()
-            connection.close()
+            engine = get_delivery_engine(language=self.newsletter.language, render_plan=RenderPlan(self), status=StatusBuffer())
+            mails = self.iter_pending_mails(min_id=min_id, max_id=max_id)
+            if settings.DOMAIN_RATE_LIMITS or settings.DOMAIN_DEFAULT_RATE_LIMIT:
+                mails = DomainScheduler().schedule(mails, sleep=engine.blocking)
+            engine.deliver(mails)
         except:
             self.status = 41
-            self.save()
+            # other shards could be sending at the same time
+            Job.objects.filter(pk=self.pk).update(status=41)
             raise
-        else:
-            self.status = 31
-            self.date_deliver_finished = now()
-        self.save()
 
+    def finish_sending(self):
+        """
+        Marks the job as finished unless sending has failed meanwhile.
+        """
+        self.date_deliver_finished = now()
+        if Job.objects.filter(pk=self.pk, status=21).update(status=31, date_deliver_finished=self.date_deliver_finished):
+            self.status = 31
 
-class JobStatistic(Job):
-    class Meta:
-        proxy = True
-        verbose_name = _("statistic")
-        verbose_name_plural = _("statistics")
-        app_label = 'pennyblack'
 
+def invalidate_workflow_cache(sender, instance, **kwargs):
+    """
+    Drops the cached workflow jobs if one of them is changed, the status
+    changes of mass mailings leave them alone.
+    """
+    if instance.status == 32:
+        workflow_cache.invalidate()
 
-class JobAdminForm(forms.ModelForm):
-    from pennyblack.models.newsletter import Newsletter
-    newsletter = forms.ModelChoiceField(queryset=Newsletter.objects.massmail())
+signals.post_save.connect(invalidate_workflow_cache, sender=Job, weak=False)
+signals.post_delete.connect(invalidate_workflow_cache, sender=Job, weak=False)
 
 
-class JobAdmin(admin.ModelAdmin):
-    from pennyblack.models.link import LinkInline
-    from pennyblack.models.mail import MailInline
+class JobCountersManager(models.Manager):
+    def increment(self, job_id, **counters):
+        """
+        Adds the given numbers to the counters of a job in the database.
+        """
+        values = dict((name, models.F(name) + count) for name, count in counters.items())
+        if not self.filter(job=job_id).update(**values):
+            self.get_or_create(job_id=job_id)
+            self.filter(job=job_id).update(**values)
 
-    date_hierarchy = 'date_deliver_start'
-    actions = None
-    list_display = ('newsletter', 'group_object', 'status', 'public_slug', 'field_mails_total', 'field_mails_sent', 'date_created')
-    list_filter = ('status', 'newsletter',)
-    fields = ('newsletter', 'collection', 'status', 'group_object', 'field_mails_total', 'field_mails_sent', 'date_deliver_start', 'date_deliver_finished', 'public_slug', 'utm_campaign')
-    readonly_fields = ('collection', 'status', 'group_object', 'field_mails_total', 'field_mails_sent', 'date_deliver_start', 'date_deliver_finished',)
-    inlines = (LinkInline, MailInline,)
-    massmail_form = JobAdminForm
+    def increment_by_job(self, name, job_ids):
+        """
+        Adds one to the counter name of a job for every occurence of its id
+        in job_ids.
+        """
+        for job_id, count in collections.Counter(job_ids).items():
+            self.increment(job_id, **{name: count})
 
-    def get_form(self, request, obj=None, **kwargs):
-        if obj and obj.status in settings.JOB_STATUS_CAN_EDIT:
-            kwargs['form'] = self.massmail_form
-        return super(JobAdmin, self).get_form(request, obj, **kwargs)
 
-    def get_readonly_fields(self, request, obj=None):
-        if obj and obj.status in settings.JOB_STATUS_CAN_EDIT:
-            return self.readonly_fields
-        else:
-            return self.readonly_fields + ('newsletter',)
-
-    def change_view(self, request, object_id, extra_context={}):
-        obj = self.get_object(request, unquote(object_id))
-        extra_context['can_send'] = obj.can_send()
-        request._pennyblack_job_obj = obj  # add object to request for the mail inline
-        return super(JobAdmin, self).change_view(request, object_id, extra_context=extra_context)
-
-    def send_newsletter_view(self, request, object_id):
-        obj = self.get_object(request, unquote(object_id))
-        if request.method == 'POST' and "_send" in request.POST:
-            obj.start_sending()
-            self.message_user(request, _("Newsletter has been marked for delivery."))
-        return HttpResponseRedirect(reverse('admin:%s_%s_changelist' % (self.model._meta.app_label, self.model._meta.module_name)))
-
-    def response_change(self, request, obj):
-        """
-        Determines the HttpResponse for the change_view stage.
-        """
-        if "_send_prepare" in request.POST:
-            context = {
-                'object': obj,
-                'opts': self.model._meta,
-                'app_label': self.model._meta.app_label,
-            }
-            context.update(csrf(request))
-            return render_to_response(
-                'admin/pennyblack/job/send_confirmation.html', context)
-        return super(JobAdmin, self).response_change(request, obj)
-
-    def get_urls(self):
-        urls = super(JobAdmin, self).get_urls()
-        info = self.model._meta.app_label, self.model._meta.module_name
-        my_urls = patterns('',
-            url(r'^(?P<object_id>\d+)/send/$', self.admin_site.admin_view(self.send_newsletter_view), name=('%s_%s_send' % info)),
-        )
-        return my_urls + urls
-
-    def has_add_permission(self, request):
-        return False
-
-    def has_delete_permission(self, request, obj=None):
-        return False
-
-
-class JobStatisticAdmin(admin.ModelAdmin):
-    date_hierarchy = 'date_deliver_start'
-    actions = None
-    list_display = ('newsletter', 'group_object', 'field_mails_total', 'field_mails_sent', 'field_opening_rate', 'date_created')
-    # list_filter   = ('status', 'newsletter',)
-    fields = ('newsletter', 'collection', 'group_object', 'date_deliver_start', 'date_deliver_finished', 'utm_campaign')
-    readonly_fields = ('newsletter', 'collection', 'group_object', 'date_deliver_start', 'date_deliver_finished', 'utm_campaign')
-
-    def queryset(self, request):
-        return self.model.objects.exclude(status=1)
-
-    def has_add_permission(self, request):
-        return False
-
-    def has_delete_permission(self, request, obj=None):
-        return False
-
-    def get_graph_data(self, obj):
-        date_start = obj.date_deliver_start.replace(minute=0, second=0, microsecond=0)
-        opened_serie = []
-        for i in range(336):
-            t = date_start + datetime.timedelta(hours=i)
-            count_opened = obj.mails.exclude(viewed=None).filter(viewed__lt=t).count()
-            opened_serie.append('[%s000,%s]' % (t.strftime('%s'), count_opened))
-            if t > now():
-                break
-        return {
-            'opened_serie': ','.join(opened_serie),
-        }
+class JobCounters(models.Model):
+    """
+    Counts the mails of a job, updated whenever a mail is created, sent,
+    bounced, viewed or clicked. The counters are kept out of the job, so
+    saving a job never overwrites them.
+    """
+    job = models.OneToOneField(Job, related_name='counters')
+    mails_total = models.PositiveIntegerField(default=0)
+    mails_sent = models.PositiveIntegerField(default=0)
+    mails_bounced = models.PositiveIntegerField(default=0)
+    mails_viewed = models.PositiveIntegerField(default=0)
+    mails_clicked = models.PositiveIntegerField(default=0)
 
-    def change_view(self, request, object_id, extra_context={}):
-        obj = self.get_object(request, unquote(object_id))
-        graph_data = self.get_graph_data(obj)
-        extra_context.update(graph_data)
-        return super(JobStatisticAdmin, self).change_view(request, object_id, extra_context=extra_context)
-
-    def email_list_view(self, request, object_id):
-        obj = self.get_object(request, unquote(object_id))
-        context = {
-            'object': obj,
-            'opts': self.model._meta,
-            'app_label': self.model._meta.app_label,
-        }
+    objects = JobCountersManager()
 
-        return render_to_response('admin/pennyblack/jobstatistic/email_list.html', context)
-
-    def user_agents_view(self, request, object_id):
-        from pennyblack.models import EmailClient
-        obj = self.get_object(request, unquote(object_id))
-        user_agents = EmailClient.objects.filter(mail__job__id=obj.id).values('user_agent').annotate(count=models.Count('user_agent')).order_by('-count')
-        context = {
-            'object': obj,
-            'opts': self.model._meta,
-            'app_label': self.model._meta.app_label,
-            'user_agents': user_agents
-        }
+    class Meta:
+        app_label = 'pennyblack'
 
-        return render_to_response('admin/pennyblack/jobstatistic/user_agents.html', context)
 
-    def get_urls(self):
-        urls = super(JobStatisticAdmin, self).get_urls()
-        info = self.model._meta.app_label, self.model._meta.module_name
-        my_urls = patterns('',
-            url(r'^(?P<object_id>\d+)/email-list/$', self.admin_site.admin_view(self.email_list_view), name='%s_%s_email_list' % info),
-            url(r'^(?P<object_id>\d+)/user-agents/$', self.admin_site.admin_view(self.user_agents_view), name='%s_%s_user_agents' % info),
-        )
-        return my_urls + urls
+class JobStatistic(Job):
+    class Meta:
+        proxy = True
+        verbose_name = _("statistic")
+        verbose_name_plural = _("statistics")
+        app_label = 'pennyblack'
@@ -1,12 +1,28 @@
-from django.contrib import admin
 from django.core.urlresolvers import resolve
 from django.db import models
 from django.template import Context, Template
 from django.utils.translation import ugettext_lazy as _
 
+from pennyblack import settings
+from pennyblack.utils import LRUCache
+
 import datetime
 import hashlib
 import random
+from urlparse import urlparse, urlunparse, parse_qs
+from urllib import urlencode
+
+try:
+    from django.utils import timezone
+except ImportError:
+    now = datetime.datetime.now
+else:
+    now = timezone.now
+
+# compiled templates of link targets with template code
+_target_templates = LRUCache(settings.LINK_CACHE_SIZE)
+# redirect urls of static link targets by link, job and target
+_redirect_urls = LRUCache(settings.LINK_CACHE_SIZE, settings.LINK_CACHE_TIMEOUT)
 
 
 #-----------------------------------------------------------------------------
@@ -45,6 +61,33 @@ def check_if_redirect_url(url):
     return False
 
 
+def is_static(link_target):
+    """
+    Checks if link_target contains no template code.
+    """
+    return '{{' not in link_target and '{%' not in link_target and '{#' not in link_target
+
+
+def add_tracking_parameters(target, job):
+    """
+    Adds the google analytics parameters of job to the target url if it's a
+    http url.
+    """
+    # disassemble the url
+    scheme, netloc, path, params, query, fragment = tuple(urlparse(target))
+    if scheme in ('http', 'https'):  # insert ga tracking if scheme is appropriate
+        parsed_query = parse_qs(query)
+        if job.newsletter.utm_source:
+            parsed_query['utm_source'] = job.newsletter.utm_source
+        if job.newsletter.utm_medium:
+            parsed_query['utm_medium'] = job.newsletter.utm_medium
+        if job.utm_campaign:
+            parsed_query['utm_campaign'] = job.utm_campaign
+        query = urlencode(parsed_query, True)
+    # reassemble the url
+    return urlunparse((scheme, netloc, path, params, query, fragment))
+
+
 class Link(models.Model):
     """
     Stores a link from a newsletter and generates a hash corresponding to the link.
@@ -76,10 +119,16 @@ class Link(models.Model):
 
     def click(self, mail):
         """
-        Creates a LinkClick and returns the link target
+        Creates a LinkClick and returns the url the receiver is redirected
+        to or the view function of a proxy link.
         """
-        self.clicks.create(mail=mail)
-        return self.get_target(mail)
+        from pennyblack import events
+        if events.is_enabled():
+            events.log_event(events.CLICK, mail.pk, link_id=self.pk)
+        else:
+            self.clicks.create(mail=mail)
+            mail.mark_clicked()
+        return self.get_redirect_url(mail)
 
     def get_target(self, mail):
         """
@@ -88,9 +137,31 @@ class Link(models.Model):
         from pennyblack.models import Newsletter
         if self.identifier != '':
             return Newsletter.get_view_link(self.identifier)
-        template = Template(self.link_target)
+        if is_static(self.link_target):
+            return self.link_target
+        template = _target_templates.get(self.link_target)
+        if template is None:
+            template = Template(self.link_target)
+            _target_templates.set(self.link_target, template)
         return template.render(Context(mail.get_context()))
 
+    def get_redirect_url(self, mail):
+        """
+        Returns the target with the google analytics parameters. The url of
+        a static target is built once per job and cached.
+        """
+        if self.identifier != '' or not is_static(self.link_target):
+            target = self.get_target(mail)
+            if callable(target):
+                return target
+            return add_tracking_parameters(target, mail.job)
+        key = (self.pk, mail.job_id, self.link_target)
+        url = _redirect_urls.get(key)
+        if url is None:
+            url = add_tracking_parameters(self.link_target, mail.job)
+            _redirect_urls.set(key, url)
+        return url
+
     def save(self, **kwargs):
         if self.link_hash == u'':
             self.link_hash = hashlib.md5(str(self.id) + str(random.random())).hexdigest()
@@ -103,22 +174,7 @@ class LinkClick(models.Model):
     """
     link = models.ForeignKey('pennyblack.Link', related_name='clicks')
     mail = models.ForeignKey('pennyblack.Mail', related_name='clicks')
-    date = models.DateTimeField(default=datetime.datetime.now())
+    date = models.DateTimeField(default=now)
 
     class Meta:
         app_label = 'pennyblack'
-
-
-class LinkInline(admin.TabularInline):
-    model = Link
-    max_num = 0
-    can_delete = False
-    fields = ('link_target', 'link_hash',)
-    readonly_fields = ('link_hash',)
-
-    def queryset(self, request):
-        """
-        Don't show links with identifier because they aren't changable.
-        """
-        queryset = super(LinkInline, self).queryset(request)
-        return queryset.filter(identifier='')
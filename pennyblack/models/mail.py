@@ -1,18 +1,20 @@
-import hashlib
-import random
+import binascii
+import os
 from rfc822 import dump_address_pair
 
-from django.contrib import admin
 from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
 from django.core import mail
 from django.core.urlresolvers import NoReverseMatch, reverse
 from django.core.validators import email_re
-from django.db import models
+from django.db import connection, models, transaction
 from django.http import HttpRequest
 from django.template.loader import render_to_string
 from django.template import RequestContext
 
-from pennyblack import settings
+from pennyblack import events, settings
+from pennyblack.tokens import Tokenizer, parse_token
+from pennyblack.utils import commit_on_success_unless_managed
 
 try:
     from django.utils.timezone import now
@@ -22,16 +24,169 @@ except ImportError:
 
 from datetime import timedelta
 
+# the status of this many mails is updated with one query
+STATUS_UPDATE_BATCH_SIZE = 250
+
+# whether a model has an on_landing method, see has_landing_hooks
+_landing_hooks = None
 
 #-----------------------------------------------------------------------------
 # Mail
 #-----------------------------------------------------------------------------
+def has_landing_hooks():
+    """
+    Returns True if any model besides Mail has an on_landing method, which
+    receivers and group objects can implement.
+    """
+    global _landing_hooks
+    if _landing_hooks is None:
+        _landing_hooks = any(callable(getattr(model, 'on_landing', None))
+                             for model in models.get_models() if model is not Mail)
+    return _landing_hooks
+
+
+def make_mail_hashes(count):
+    """
+    Returns count random mail hashes, generated with the cryptographically
+    strong random source of the operating system.
+    """
+    data = binascii.hexlify(os.urandom(16 * count))
+    return [data[i:i + 32] for i in range(0, len(data), 32)]
+
+
+def load_persons(mails):
+    """
+    Loads the receivers of all mails with one query per content type and
+    stores them on the mails.
+    """
+    object_ids = {}
+    for mail in mails:
+        object_ids.setdefault(mail.content_type_id, set()).add(mail.object_id)
+    persons = {}
+    for content_type_id, ids in object_ids.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        for pk, person in model._base_manager.in_bulk(list(ids)).items():
+            persons[(content_type_id, pk)] = person
+    for mail in mails:
+        person = persons.get((mail.content_type_id, mail.object_id))
+        if person is not None:
+            mail.person = person
+
+
+def iter_mail_chunks(queryset, chunk_size, after=0):
+    """
+    Yields the mails of queryset with an id bigger than after in lists of
+    chunk_size mails, ordered by id. The number of clicks of every mail is
+    stored in click_count. Only one chunk is held in memory at a time.
+    """
+    from pennyblack.models import LinkClick
+    while True:
+        chunk = list(queryset.filter(pk__gt=after).order_by('pk')[:chunk_size])
+        if not chunk:
+            return
+        click_counts = dict(LinkClick.objects.filter(mail__in=[mail.pk for mail in chunk])
+                            .values_list('mail').annotate(models.Count('pk')).order_by())
+        for mail in chunk:
+            mail.click_count = click_counts.get(mail.pk, 0)
+        yield chunk
+        after = chunk[-1].pk
+
+
 class MailManager(models.Manager):
     use_for_related_fields = True
 
     def most_clicked_first(self):
         return self.annotate(click_count=models.Count('clicks')).order_by('-click_count')
 
+    def update_status(self, mails, **values):
+        """
+        Sets the given boolean fields on all mails and stores the email
+        address every mail was sent to, with one query per batch of mails.
+        The counters of the jobs are increased by the mails which didn't have
+        a field set in the database before.
+        """
+        from pennyblack.models import JobCounters
+        if not mails:
+            return
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        assignments = ', '.join('%s = %%s' % qn(opts.get_field(name).column) for name in values.keys())
+        counted = [name for name, value in values.items() if value]
+        cursor = connection.cursor()
+        with commit_on_success_unless_managed():
+            for start in range(0, len(mails), STATUS_UPDATE_BATCH_SIZE):
+                batch = mails[start:start + STATUS_UPDATE_BATCH_SIZE]
+                if counted:
+                    # the mails are locked, so a retried or concurrent update
+                    # counts every mail only once
+                    stored = list(self.select_for_update().filter(pk__in=[mail.pk for mail in batch])
+                                  .values_list('job', *counted))
+                    for index, name in enumerate(counted):
+                        JobCounters.objects.increment_by_job('mails_%s' % name,
+                            [row[0] for row in stored if not row[index + 1]])
+                sql = 'UPDATE %s SET %s, %s = CASE %s %s END WHERE %s IN (%s)' % (
+                    qn(opts.db_table),
+                    assignments,
+                    qn(opts.get_field('email').column),
+                    qn(opts.pk.column),
+                    ' '.join(['WHEN %s THEN %s'] * len(batch)),
+                    qn(opts.pk.column),
+                    ', '.join(['%s'] * len(batch)))
+                params = values.values()
+                for mail in batch:
+                    params.extend((mail.pk, mail.email))
+                params.extend(mail.pk for mail in batch)
+                cursor.execute(sql, params)
+                for name, value in values.items():
+                    for mail in batch:
+                        setattr(mail, name, value)
+
+    def mark_viewed(self, viewed):
+        """
+        Sets the view date of all mails which haven't been viewed yet,
+        viewed maps mail ids to dates.
+        """
+        from pennyblack.models import JobCounters
+        if not viewed:
+            return
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        cursor = connection.cursor()
+        with commit_on_success_unless_managed():
+            # the mails are locked, so their views are counted only once
+            unviewed = dict(self.select_for_update().filter(pk__in=viewed.keys(), viewed=None).values_list('pk', 'job'))
+            items = [(mail_id, date) for mail_id, date in viewed.items() if mail_id in unviewed]
+            JobCounters.objects.increment_by_job('mails_viewed', unviewed.values())
+            for start in range(0, len(items), STATUS_UPDATE_BATCH_SIZE):
+                batch = items[start:start + STATUS_UPDATE_BATCH_SIZE]
+                sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s) AND %s IS NULL' % (
+                    qn(opts.db_table),
+                    qn(opts.get_field('viewed').column),
+                    qn(opts.pk.column),
+                    ' '.join(['WHEN %s THEN %s'] * len(batch)),
+                    qn(opts.pk.column),
+                    ', '.join(['%s'] * len(batch)),
+                    qn(opts.get_field('viewed').column))
+                params = []
+                for mail_id, date in batch:
+                    params.extend((mail_id, opts.get_field('viewed').get_db_prep_value(date, connection)))
+                params.extend(mail_id for mail_id, date in batch)
+                cursor.execute(sql, params)
+
+    def mark_clicked(self, mail_ids):
+        """
+        Marks all mails as clicked and counts the ones which weren't clicked
+        before.
+        """
+        from pennyblack.models import JobCounters
+        mail_ids = list(set(mail_ids))
+        with commit_on_success_unless_managed():
+            for start in range(0, len(mail_ids), STATUS_UPDATE_BATCH_SIZE):
+                batch = mail_ids[start:start + STATUS_UPDATE_BATCH_SIZE]
+                unclicked = dict(self.select_for_update().filter(pk__in=batch, clicked=False).values_list('pk', 'job'))
+                self.filter(pk__in=unclicked.keys()).update(clicked=True)
+                JobCounters.objects.increment_by_job('mails_clicked', unclicked.values())
+
 
 class Mail(models.Model):
     """
@@ -40,11 +195,12 @@ class Mail(models.Model):
     viewed = models.DateTimeField(default=None, null=True)
     bounced = models.BooleanField(default=False)
     sent = models.BooleanField(default=False)
+    clicked = models.BooleanField(default=False)
     content_type = models.ForeignKey('contenttypes.ContentType')
     object_id = models.PositiveIntegerField()
     person = generic.GenericForeignKey('content_type', 'object_id')
     job = models.ForeignKey('pennyblack.Job', related_name="mails")
-    mail_hash = models.CharField(max_length=32, blank=True)
+    mail_hash = models.CharField(max_length=32, blank=True, db_index=True)
     email = models.EmailField()  # the address is stored when the mail is sent
 
     objects = MailManager()
@@ -62,26 +218,70 @@ class Mail(models.Model):
     def __unicode__(self):
         return u'%s to %s' % (self.job, self.person,)
 
+    @classmethod
+    def from_token(cls, token):
+        """
+        Returns a mail for a tracking token without querying the database,
+        only its id and job are set until load is called. Returns None if
+        the token isn't valid.
+        """
+        ids = parse_token(token)
+        if ids is None:
+            return None
+        mail = cls(id=ids[0], job_id=ids[1])
+        mail.token = token
+        mail.token_link_id = ids[2]
+        mail.partial = True
+        return mail
+
+    def load(self):
+        """
+        Loads all fields of a mail created from a tracking token.
+        """
+        if not getattr(self, 'partial', False):
+            return
+        mail = Mail.objects.get(pk=self.pk)
+        for field in self._meta.fields:
+            setattr(self, field.attname, getattr(mail, field.attname))
+        self.partial = False
+
     def save(self, **kwargs):
         if self.mail_hash == u'':
-            self.mail_hash = hashlib.md5(str(self.id) + str(random.random())).hexdigest()
+            self.mail_hash = make_mail_hashes(1)[0]
         super(Mail, self).save(**kwargs)
 
+    def _set_flag(self, name, **fields):
+        """
+        Sets the boolean field name and the given fields in the database and
+        increases the counter of the job if it wasn't set before. Other
+        fields are left alone, they aren't loaded for mails of a token.
+        """
+        from pennyblack.models import JobCounters
+        fields[name] = True
+        if Mail.objects.filter(pk=self.pk, **{name: False}).update(**fields):
+            JobCounters.objects.increment(self.job_id, **{'mails_%s' % name: 1})
+        setattr(self, name, True)
+
     def mark_sent(self):
         """
-        Marks the email as beeing sent.
+        Marks the email as beeing sent and stores the e-mail address, which
+        is set while the message is created.
         """
-        self.sent = True
-        self.save()
+        self._set_flag('sent', email=self.email)
 
     def mark_viewed(self, request=None, contact_type='link'):
         """
         Marks the email as beeing viewed and if it's not already viewed it
-        stores the view date.
+        stores the view date. If the event log is enabled, the view is only
+        logged and written later.
         """
+        if events.is_enabled():
+            events.log_event(events.VIEW, self.pk, request=request, contact_type=contact_type)
+            return
         if request:
+            from pennyblack.models import UserAgent
             params = {
-                'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+                'agent_id': UserAgent.objects.get_id(request.META.get('HTTP_USER_AGENT', '')),
                 'ip_address': request.META.get('REMOTE_ADDR', ''),
                 'referer': request.META.get('HTTP_REFERER', ''),
                 'contact_type': contact_type,
@@ -90,16 +290,29 @@ class Mail(models.Model):
             if not self.clients.filter(**params).filter(visited__gt=t):
                 self.clients.create(**params)
         if not self.viewed:
+            from pennyblack.models import JobCounters
             self.viewed = now()
-            self.save()
+            if Mail.objects.filter(pk=self.pk, viewed=None).update(viewed=self.viewed):
+                JobCounters.objects.increment(self.job_id, mails_viewed=1)
+
+    def mark_clicked(self):
+        """
+        Marks the email as clicked.
+        """
+        if not self.clicked:
+            self._set_flag('clicked')
 
     def on_landing(self, request):
         """
         Is executed every time a user landed on the website after clicking on
         a link in this email. It tries to execute the on_landing method on the
-        person object and on the group object.
+        person object and on the group object. The mail of a token is only
+        loaded if a model has such a method.
         """
         self.mark_viewed(request, contact_type='link')
+        if not has_landing_hooks():
+            return
+        self.load()
         if hasattr(self.person, 'on_landing') and hasattr(self.person.on_landing, '__call__'):
             self.person.on_landing(request)
         if self.job.content_type is not None and \
@@ -111,8 +324,7 @@ class Mail(models.Model):
         """
         Is executed if this email is bounced.
         """
-        self.bounced = True
-        self.save()
+        self._set_flag('bounced')
         self.person.on_bounce(self)
 
     def unsubscribe(self):
@@ -137,9 +349,10 @@ class Mail(models.Model):
         return self.person.get_email()
     get_email.short_description = "E-Mail"
 
-    def get_message(self):
+    def get_message(self, render_plan=None):
         """
-        Returns a email message object
+        Returns a email message object. If a render_plan is given the content
+        is rendered with the precompiled templates of the plan.
         """
         self.email = self.person.get_email()
         job = self.job
@@ -154,34 +367,50 @@ class Mail(models.Model):
             pass
         message = mail.EmailMessage(
             job.newsletter.subject,
-            self.get_content(),
+            self.get_content(render_plan=render_plan),
             dump_address_pair((job.newsletter.sender.name, job.newsletter.sender.email)),
             [self.email],
             headers=headers,
         )
-        for attachment in job.newsletter.attachments.all():
-            message.attachments.append((attachment.name, attachment.file.read(), attachment.mimetype))
+        if render_plan is not None:
+            message.attachments.extend(render_plan.attachments)
+        else:
+            for attachment in job.newsletter.attachments.all():
+                message.attachments.append((attachment.name, attachment.file.read(), attachment.mimetype))
         for attachment in self.extra_attachments:
             message.attachments.append(attachment)
         message.content_subtype = "html"
         return message
 
-    def get_content(self, webview=False):
+    def get_content(self, webview=False, render_plan=None):
         """
         Renders the email content. If webview is True it includes also a
         html header and doesn't display the webview link.
         """
-        newsletter = self.job.newsletter
+        if render_plan is not None:
+            content = render_plan.render(self, webview=webview)
+        else:
+            context = self.get_content_context(webview=webview)
+            request = HttpRequest()
+            request.content_context = context
+            content = render_to_string(self.job.newsletter.template.path, context,
+                                       context_instance=RequestContext(request))
+        if settings.TRACKING_TOKENS:
+            tokenizer = render_plan.tokenizer if render_plan is not None else Tokenizer()
+            content = tokenizer.tokenize(content, self)
+        return content
+
+    def get_content_context(self, webview=False):
+        """
+        Returns the context used to render the email content.
+        """
         context = self.get_context()
-        context['newsletter'] = newsletter
+        context['newsletter'] = self.job.newsletter
         context['public_url'] = self.job.public_url
         context['webview'] = webview
         if isinstance(self.extra_context, dict):
             context.update(self.extra_context)
-        request = HttpRequest()
-        request.content_context = context
-        return render_to_string(newsletter.template.path, context,
-                                context_instance=RequestContext(request))
+        return context
 
     def get_context(self):
         """
@@ -205,23 +434,9 @@ class Mail(models.Model):
         if hasattr(self, '_admin_change_url'):
             return self._admin_change_url
         try:
-            self._admin_change_url = reverse('admin:%s_%s_change' % (self.content_type.app_label, self.content_type.model), args=[self.object_id])
+            # the content types are cached, self.content_type isn't
+            content_type = ContentType.objects.get_for_id(self.content_type_id)
+            self._admin_change_url = reverse('admin:%s_%s_change' % (content_type.app_label, content_type.model), args=[self.object_id])
         except NoReverseMatch:
             return None
         return self._admin_change_url
-
-
-class MailInline(admin.TabularInline):
-    model = Mail
-    max_num = 0
-    can_delete = False
-    fields = ('get_email',)
-    readonly_fields = ('get_email',)
-
-    def queryset(self, request):
-        """
-        Don't display Inlines if there are more than a certain amount
-        """
-        if request._pennyblack_job_obj.mails.count() > settings.JOB_MAIL_INLINE_COUNT:
-            return super(MailInline, self).queryset(request).filter(pk=0)
-        return super(MailInline, self).queryset(request)
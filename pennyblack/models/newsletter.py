@@ -1,24 +1,26 @@
 # coding=utf-8
+import base64
 import mimetypes
+import mmap
 import os
+from email.mime.base import MIMEBase
 
-from django.conf.urls.defaults import patterns, url
+from django.conf import settings as django_settings
 from django.core.exceptions import ImproperlyConfigured
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.contrib import admin
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.core.mail.message import SafeMIMEText
+from django.db import models, transaction
 from django.db.models import signals
-from django import forms
 from django.utils import translation
 from django.utils.translation import ugettext_lazy as _
 
-from feincms.admin import item_editor
 from feincms.management.checker import check_database_schema
 from feincms.models import Base
 from feincms.utils import copy_model_instance
 
 from pennyblack import settings
+from pennyblack.cache import workflow_cache
+from pennyblack.delivery import get_connection_pool
 
 
 #-----------------------------------------------------------------------------
@@ -49,9 +51,15 @@ class NewsletterManager(models.Manager):
         one where the language matches the active language, later it tries to
         find one with the default language and if it doesn't find one it tries
         to get any newsletter with the given name before giving up.
+        The result is cached until a newsletter is changed.
         """
+        language = translation.get_language()
+        return workflow_cache.get(('newsletter', name.lower(), language),
+                                  lambda: self._get_workflow_newsletter_by_name(name, language))
+
+    def _get_workflow_newsletter_by_name(self, name, language):
         try:
-            return self.workflow().get(name__iexact=name, language=translation.get_language())
+            return self.workflow().get(name__iexact=name, language=language)
         except models.ObjectDoesNotExist:
             pass
         try:
@@ -84,6 +92,9 @@ class Newsletter(Base):
     #ga tracking
     utm_source = models.SlugField(verbose_name=_("utm Source"), default="newsletter")
     utm_medium = models.SlugField(verbose_name=_("utm Medium"), default="cpc")
+    # workflow newsletters are only prepared again after they have been edited
+    content_version = models.PositiveIntegerField(default=1, editable=False)
+    prepared_version = models.PositiveIntegerField(default=0, editable=False)
 
     objects = NewsletterManager()
 
@@ -141,7 +152,8 @@ class Newsletter(Base):
                 content.save()
         if not is_link(self.header_url, self.header_url_replaced):
             self.header_url_replaced = default_job.add_link(self.header_url)
-            self.save()
+            # don't overwrite a content_version bumped in the meantime
+            Newsletter.objects.filter(pk=self.pk).update(header_url_replaced=self.header_url_replaced)
         if job.group_object and hasattr(job.group_object, 'get_extra_links'):
             raise DeprecationWarning("get_extra_links is deprecated and will no longer work")
 
@@ -154,6 +166,33 @@ class Newsletter(Base):
                 if hasattr(content, 'prepare_to_send'):
                     content.prepare_to_send()
 
+    def content_changed(self):
+        """
+        Marks the content as changed, a workflow newsletter is prepared again
+        before it is sent the next time.
+        """
+        self.content_version += 1
+        Newsletter.objects.filter(pk=self.pk).update(content_version=models.F('content_version') + 1)
+        workflow_cache.invalidate()
+
+    def prepare_workflow(self, job):
+        """
+        Replaces the links and prepares the content of a workflow newsletter
+        unless this version of the content has already been prepared.
+        """
+        version = self.content_version
+        if self.prepared_version == version:
+            return
+        self.replace_links(job)
+        self.prepare_to_send()
+        Newsletter.objects.filter(pk=self.pk, content_version=version).update(prepared_version=version)
+        self.prepared_version = version
+        # the cached newsletter still has the old prepared version
+        workflow_cache.invalidate()
+        # the content blocks have changed in the database
+        if hasattr(self, '_content_proxy'):
+            del self._content_proxy
+
     def get_default_job(self):
         """
         Tries to get the default job. If no default job exists it creates one.
@@ -164,47 +203,65 @@ class Newsletter(Base):
         except models.ObjectDoesNotExist:
             return self.jobs.create(status=32)
 
+    def get_workflow_job(self, group=None):
+        """
+        Returns the job of a workflow newsletter for group, creates it if it
+        doesn't exist. The job is cached until a workflow job is changed.
+        """
+        if group:
+            ctype_id, object_id = ContentType.objects.get_for_model(group).id, group.id
+            lookup = {'content_type__pk': ctype_id, 'object_id': object_id}
+        else:
+            ctype_id, object_id = None, None
+            lookup = {'content_type': None}
+
+        def load():
+            # search newsletter job wich hash the same group or create it if it doesn't exist
+            try:
+                return self.jobs.get(**lookup)
+            except models.ObjectDoesNotExist:
+                if group:
+                    kw = {'group_object': group}
+                else:
+                    kw = {}
+                return self.jobs.create(status=32, **kw)  # 32=readonly
+        job = workflow_cache.get(('job', self.pk, ctype_id, object_id), load)
+        # a cached job is a new instance, its newsletter isn't loaded again
+        job.newsletter = self
+        return job
+
     def is_workflow(self):
         """
         Returns True if it's type is a workflow newsletter.
         """
         return self.newsletter_type in settings.NEWSLETTER_TYPE_WORKFLOW
 
-    def send(self, person, group=None, extra_context=None, extra_attachments=None):
+    def send(self, person, group=None, extra_context=None, extra_attachments=None, enqueue=None):
         """
         Sends this newsletter to "person" with optional "group".
         This works only with newsletters which are workflow newsletters.
         extra_context has to be a dict of additional context data if defined
         extra_attachments has to be a list of tuples (filename, content, mimetype) if defined
+        If enqueue is True, or None and WORKFLOW_QUEUE is set, the mail is
+        only queued and sent by a background worker.
         """
+        from pennyblack.models.queue import QueuedMail
         if not self.is_workflow():
             raise AttributeError('only newsletters with type workflow can be sent')
-        # search newsletter job wich hash the same group or create it if it doesn't exist
-        try:
-            if group:
-                ctype = ContentType.objects.get_for_model(group)
-                job = self.jobs.get(content_type__pk=ctype.id, object_id=group.id)
-            else:
-                job = self.jobs.get(content_type=None)
-        except models.ObjectDoesNotExist:
-            if group:
-                kw = {'group_object': group}
-            else:
-                kw = {}
-            job = self.jobs.create(status=32, **kw)  # 32=readonly
-        self.replace_links(job)
-        self.prepare_to_send()
+        job = self.get_workflow_job(group)
+        self.prepare_workflow(job)
+        if enqueue is None:
+            enqueue = settings.WORKFLOW_QUEUE
+        if enqueue:
+            with transaction.commit_on_success():
+                QueuedMail.objects.enqueue(job.create_mail(person), extra_context, extra_attachments)
+            return
         mail = job.create_mail(person)
         mail.extra_context = extra_context
         if extra_attachments:
             mail.extra_attachments.extend(extra_attachments)
-        try:
-            message = mail.get_message()
-            message.send()
-        except:
-            raise
-        else:
-            mail.mark_sent()
+        get_connection_pool().send(mail.get_message())
+        mail.mark_sent()
 
     _view_links = {}
 
@@ -233,6 +290,8 @@ class Newsletter(Base):
 
 Newsletter.__module__ = 'pennyblack.models'
 signals.post_syncdb.connect(check_database_schema(Newsletter, __name__), weak=False)
+signals.post_save.connect(workflow_cache.invalidate, sender=Newsletter, weak=False)
+signals.post_delete.connect(workflow_cache.invalidate, sender=Newsletter, weak=False)
 
 
 class Attachment(models.Model):
@@ -245,74 +304,43 @@ class Attachment(models.Model):
     def __unicode__(self):
         return "%s (%s)" % (self.name, self.size)
 
+    def get_mime_part(self):
+        """
+        Returns the attachment as encoded mime part which can be attached to
+        any number of messages. Big binary files are memory mapped while they
+        are encoded instead of being read into memory.
+        """
+        self.file.open('rb')
+        try:
+            content = None
+            if self.file.size >= settings.ATTACHMENT_MMAP_THRESHOLD and not self.mimetype.startswith('text/'):
+                try:
+                    content = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                except (AttributeError, EnvironmentError, ValueError):
+                    # the storage doesn't provide a real file
+                    pass
+            if content is None:
+                content = self.file.read()
+            mimetype = self.mimetype or mimetypes.guess_type(self.name)[0] or 'application/octet-stream'
+            basetype, subtype = mimetype.split('/', 1)
+            if basetype == 'text':
+                part = SafeMIMEText(content, subtype, django_settings.DEFAULT_CHARSET)
+            else:
+                part = MIMEBase(basetype, subtype)
+                part.set_payload(base64.encodestring(content))
+                part['Content-Transfer-Encoding'] = 'base64'
+            if isinstance(content, mmap.mmap):
+                content.close()
+        finally:
+            self.file.close()
+        try:
+            filename = self.name.encode('ascii')
+        except UnicodeEncodeError:
+            filename = ('utf-8', '', self.name.encode('utf-8'))
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
+        return part
+
     class Meta:
         verbose_name = _(u'attachment')
         verbose_name_plural = _(u'attachments')
         app_label = 'pennyblack'
-
-
-class AttachmentAdminForm(forms.ModelForm):
-    def clean(self):
-        cleaned_data = super(AttachmentAdminForm, self).clean()
-        if 'file' in cleaned_data and isinstance(cleaned_data['file'], InMemoryUploadedFile):
-            cleaned_data['name'] = cleaned_data['name'] or cleaned_data['file'].name
-        return cleaned_data
-
-    def save(self, **kwargs):
-        filename = self.instance.name
-        mimetype, format = mimetypes.guess_type(filename)
-        if not mimetype:
-            raise forms.ValidationError(_(u'Mimetype of file could not be guessed.'))
-        self.instance.mimetype = mimetype
-        self.instance.size = self.instance.file.size
-        return super(AttachmentAdminForm, self).save(**kwargs)
-
-
-class AttachmentInline(admin.TabularInline):
-    model = Attachment
-    form = AttachmentAdminForm
-    readonly_fields = ('mimetype', 'size')
-    extra = 0
-
-
-def copy_newsletters(modeladmin, request, queryset):
-    for newsletter in queryset:
-        duplicate = copy_model_instance(newsletter, exclude=('id',))
-        duplicate.save()
-        duplicate.copy_content_from(newsletter)
-copy_newsletters.short_description = _('Duplicate selected newsletters')
-
-
-class NewsletterAdmin(item_editor.ItemEditor, admin.ModelAdmin):
-    list_display = ('name', 'subject', 'language', 'newsletter_type')
-    raw_id_fields = ('header_image',)
-    fieldsets = (
-        (None, {
-            'fields': ['name', 'subject', 'sender', 'reply_email', 'template_key'],
-        }),
-        (_('Other options'), {
-            'classes': ['collapse'],
-            'fields': ('newsletter_type', 'language', 'utm_source', 'utm_medium', 'header_image', 'header_url', 'site'),
-        }),
-        item_editor.FEINCMS_CONTENT_FIELDSET,
-    )
-    exclude = ('header_url_replaced',)
-    actions = [copy_newsletters]
-    inlines = []
-    if settings.NEWSLETTER_SHOW_ATTACHMENTS:
-        inlines.append(AttachmentInline)
-
-    def get_readonly_fields(self, request, obj=None):
-        if obj:
-            return self.readonly_fields + ('newsletter_type',)
-        return self.readonly_fields
-
-    def queryset(self, request):
-        return self.model.objects.active()
-
-    def get_urls(self):
-        urls = super(NewsletterAdmin, self).get_urls()
-        my_urls = patterns('',
-            url(r'^(?P<newsletter_id>\d+)/preview/$', 'pennyblack.views.preview'),
-        )
-        return my_urls + urls
@@ -0,0 +1,129 @@
+import base64
+import binascii
+import cPickle as pickle
+import os
+import smtplib
+import traceback
+
+from django.db import models
+from django.utils import translation
+from django.utils.translation import ugettext_lazy as _
+
+from pennyblack import settings
+from pennyblack.delivery import get_connection_pool
+from pennyblack.models.mail import load_persons
+
+try:
+    from django.utils.timezone import now
+except ImportError:
+    from datetime import datetime
+    now = datetime.now
+
+from datetime import timedelta
+
+
+#-----------------------------------------------------------------------------
+# Queued Mail
+#-----------------------------------------------------------------------------
+class QueuedMailManager(models.Manager):
+    def enqueue(self, mail, extra_context=None, extra_attachments=None):
+        """
+        Queues a workflow mail which has been created but not sent.
+        """
+        entry = self.model(mail=mail)
+        entry.set_extra(extra_context, extra_attachments)
+        entry.save()
+        return entry
+
+    def claim(self, batch_size=None, lease_time=None):
+        """
+        Leases up to batch_size entries which are neither leased nor failed
+        too often and returns them. An entry whose lease expires before it is
+        deleted is sent again, so every mail is sent at least once.
+        """
+        if batch_size is None:
+            batch_size = settings.WORKFLOW_QUEUE_BATCH_SIZE
+        if lease_time is None:
+            lease_time = settings.WORKFLOW_QUEUE_LEASE_TIME
+        current = now()
+        available = self.filter(attempts__lt=settings.WORKFLOW_QUEUE_MAX_ATTEMPTS).filter(
+            models.Q(leased_until=None) | models.Q(leased_until__lt=current))
+        ids = list(available.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return []
+        lease = binascii.hexlify(os.urandom(16))
+        # entries claimed by another worker in the meantime are not updated
+        available.filter(pk__in=ids).update(lease=lease, leased_until=current + timedelta(seconds=lease_time),
+                                            attempts=models.F('attempts') + 1)
+        return list(self.filter(lease=lease).select_related('mail', 'mail__job', 'mail__job__newsletter'))
+
+    def send_batch(self, batch_size=None):
+        """
+        Sends a batch of queued mails over pooled smtp connections and returns
+        the number of entries which were processed.
+        """
+        entries = self.claim(batch_size)
+        mails = [entry.mail for entry in entries]
+        load_persons(mails)
+        # all mails of a job use the same job and newsletter instance
+        jobs = {}
+        for mail in mails:
+            mail.job = jobs.setdefault(mail.job_id, mail.job)
+        for entry in entries:
+            entry.send()
+        return len(entries)
+
+
+class QueuedMail(models.Model):
+    """
+    A workflow mail which is sent in the background.
+    """
+    mail = models.OneToOneField('pennyblack.Mail', related_name='queue_entry')
+    extra = models.TextField(blank=True)
+    date_created = models.DateTimeField(default=now)
+    attempts = models.PositiveIntegerField(default=0)
+    lease = models.CharField(max_length=32, blank=True, db_index=True)
+    leased_until = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_error = models.TextField(blank=True)
+
+    objects = QueuedMailManager()
+
+    class Meta:
+        verbose_name = _('queued mail')
+        verbose_name_plural = _('queued mails')
+        app_label = 'pennyblack'
+
+    def __unicode__(self):
+        return unicode(self.mail)
+
+    def set_extra(self, extra_context=None, extra_attachments=None):
+        self.extra = base64.b64encode(pickle.dumps((extra_context, extra_attachments or []), pickle.HIGHEST_PROTOCOL))
+
+    def get_extra(self):
+        if not self.extra:
+            return None, []
+        return pickle.loads(base64.b64decode(self.extra))
+
+    def send(self):
+        """
+        Sends the mail and removes it from the queue. If sending fails, the
+        error is stored and the mail is sent again once its lease expires.
+        The mail is rendered in the language of its newsletter.
+        """
+        mail = self.mail
+        mail.extra_context, extra_attachments = self.get_extra()
+        mail.extra_attachments.extend(extra_attachments)
+        language = translation.get_language()
+        try:
+            translation.activate(mail.job.newsletter.language)
+            get_connection_pool().send(mail.get_message())
+        except smtplib.SMTPRecipientsRefused:
+            mail.bounce()
+        except Exception:
+            QueuedMail.objects.filter(pk=self.pk).update(last_error=traceback.format_exc())
+            return
+        else:
+            mail.mark_sent()
+        finally:
+            translation.activate(language)
+        self.delete()
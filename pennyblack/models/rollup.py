@@ -0,0 +1,187 @@
+import datetime
+
+from django.db import IntegrityError, models, transaction
+from django.utils.translation import ugettext_lazy as _
+
+from pennyblack import settings
+from pennyblack.statistics import count_by_hour
+
+try:
+    from django.utils import timezone
+except ImportError:
+    now = datetime.datetime.now
+else:
+    now = timezone.now
+
+
+#-----------------------------------------------------------------------------
+# Rollups
+#-----------------------------------------------------------------------------
+class RollupWatermark(models.Model):
+    """
+    The id of the last event of a source which was added to the rollups.
+
+    Only events up to limit_id are added. next_limit_id is the highest id of
+    the source at next_limit_date, it becomes the limit once it's ROLLUP_LAG
+    seconds old.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.PositiveIntegerField(default=0)
+    limit_id = models.PositiveIntegerField(default=0)
+    next_limit_id = models.PositiveIntegerField(default=0)
+    next_limit_date = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        app_label = 'pennyblack'
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.name, self.last_id)
+
+
+class JobHourlyStatistic(models.Model):
+    """
+    Number of opens and clicks of a job within an hour.
+    """
+    job = models.ForeignKey('pennyblack.Job', related_name='hourly_statistics')
+    hour = models.DateTimeField(db_index=True)
+    opens = models.PositiveIntegerField(default=0)
+    clicks = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = _('hourly job statistic')
+        verbose_name_plural = _('hourly job statistics')
+        app_label = 'pennyblack'
+        unique_together = (('job', 'hour'),)
+
+
+class LinkHourlyStatistic(models.Model):
+    """
+    Number of clicks on a link within an hour.
+    """
+    link = models.ForeignKey('pennyblack.Link', related_name='hourly_statistics')
+    job = models.ForeignKey('pennyblack.Job', related_name='hourly_link_statistics')
+    hour = models.DateTimeField(db_index=True)
+    clicks = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = _('hourly link statistic')
+        verbose_name_plural = _('hourly link statistics')
+        app_label = 'pennyblack'
+        unique_together = (('link', 'hour'),)
+
+
+def _add_counts(model, name, counts, defaults=None):
+    """
+    Adds the counts to the field name of the rows of model, counts maps
+    lookups given as tuples of items to numbers. Missing rows are created
+    with the values defaults maps their lookup to.
+
+    The opens and the clicks of a job are added under different watermarks,
+    if both create the same row at once the count is added to the row of
+    the other one.
+    """
+    for lookup, count in counts.items():
+        update = {name: models.F(name) + count}
+        if not model.objects.filter(**dict(lookup)).update(**update):
+            values = dict(lookup, **{name: count})
+            if defaults:
+                values.update(defaults[lookup])
+            sid = transaction.savepoint()
+            try:
+                model.objects.create(**values)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                model.objects.filter(**dict(lookup)).update(**update)
+            else:
+                transaction.savepoint_commit(sid)
+
+
+def _update_limit(watermark, queryset, lag):
+    """
+    Moves the limit of watermark to the highest id of queryset at the last
+    check if it was at least lag seconds ago and checks the highest id again.
+    """
+    current = now()
+    if watermark.next_limit_date is not None and watermark.next_limit_date > current - datetime.timedelta(seconds=lag):
+        return
+    watermark.limit_id = watermark.next_limit_id
+    watermark.next_limit_id = queryset.aggregate(models.Max('pk'))['pk__max'] or 0
+    watermark.next_limit_date = current
+    if not lag:
+        watermark.limit_id = watermark.next_limit_id
+    RollupWatermark.objects.filter(pk=watermark.pk).update(limit_id=watermark.limit_id,
+        next_limit_id=watermark.next_limit_id, next_limit_date=current)
+
+
+def _rollup_source(name, queryset, field, group_by, batch_size):
+    """
+    Counts the next batch_size events of queryset after the watermark name
+    by hour and the fields of group_by, returns the counts and the number
+    of events. Has to be called within a transaction, the watermark stays
+    locked until it ends.
+    """
+    RollupWatermark.objects.get_or_create(name=name)
+    watermark = RollupWatermark.objects.select_for_update().get(name=name)
+    _update_limit(watermark, queryset, settings.ROLLUP_LAG)
+    events = queryset.filter(pk__gt=watermark.last_id, pk__lte=watermark.limit_id)
+    ids = list(events.order_by('pk').values_list('pk', flat=True)[:batch_size])
+    if not ids:
+        return {}, 0
+    counts = count_by_hour(events.filter(pk__lte=ids[-1]), field, group_by)
+    RollupWatermark.objects.filter(pk=watermark.pk).update(last_id=ids[-1])
+    return counts, len(ids)
+
+
+def rollup_opens(batch_size=None):
+    """
+    Adds the next batch of opens to the hourly job statistics and returns the
+    number of opens.
+    """
+    from pennyblack.models import EmailClient
+    with transaction.commit_on_success():
+        counts, count = _rollup_source('opens', EmailClient.objects.all(), 'visited', ('mail__job',),
+                                       batch_size or settings.ROLLUP_BATCH_SIZE)
+        _add_counts(JobHourlyStatistic, 'opens',
+                    dict(((('hour', hour), ('job_id', job_id)), opens) for (hour, job_id), opens in counts.items()))
+    return count
+
+
+def rollup_clicks(batch_size=None):
+    """
+    Adds the next batch of clicks to the hourly job and link statistics and
+    returns the number of clicks.
+    """
+    from pennyblack.models import LinkClick
+    with transaction.commit_on_success():
+        counts, count = _rollup_source('clicks', LinkClick.objects.all(), 'date', ('link', 'link__job'),
+                                       batch_size or settings.ROLLUP_BATCH_SIZE)
+        job_counts = {}
+        link_counts = {}
+        link_jobs = {}
+        for (hour, link_id, job_id), clicks in counts.items():
+            job_key = (('hour', hour), ('job_id', job_id))
+            job_counts[job_key] = job_counts.get(job_key, 0) + clicks
+            link_key = (('hour', hour), ('link_id', link_id))
+            link_counts[link_key] = clicks
+            link_jobs[link_key] = {'job_id': job_id}
+        _add_counts(JobHourlyStatistic, 'clicks', job_counts)
+        _add_counts(LinkHourlyStatistic, 'clicks', link_counts, link_jobs)
+    return count
+
+
+def rollup_statistics(batch_size=None):
+    """
+    Adds all new opens and clicks to the hourly statistics, one batch per
+    transaction. Returns the number of events.
+
+    Events are added in the order of their ids once they are ROLLUP_LAG
+    seconds old, an event which is committed later than that is missed.
+    """
+    total = 0
+    for rollup in (rollup_opens, rollup_clicks):
+        while True:
+            count = rollup(batch_size)
+            total += count
+            if not count:
+                break
+    return total
@@ -1,25 +1,28 @@
-from django.contrib import admin
 from django.core.mail.utils import DNS_NAME
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
 from pennyblack import settings
 
-if settings.BOUNCE_DETECTION_ENABLE:
-    from Mailman.Bouncers.BouncerAPI import ScanText
-
 import imaplib
 import datetime
 import socket
-try:
-    import spf
-    ENABLE_SPF = True
-except IOError:
-    # spf fails to load on a system which is offline because of missing resolv.conf
-    ENABLE_SPF = False
-except ImportError:
-    # spf missing
-    ENABLE_SPF = False
+
+
+def get_spf():
+    """
+    Imports spf when it's needed the first time, returns None if it's not
+    available.
+    """
+    try:
+        import spf
+    except IOError:
+        # spf fails to load on a system which is offline because of missing resolv.conf
+        return None
+    except ImportError:
+        # spf missing
+        return None
+    return spf
 
 
 #-----------------------------------------------------------------------------
@@ -50,7 +53,8 @@ class Sender(models.Model):
         """
         Check if sender is authorised by sender policy framework
         """
-        if not ENABLE_SPF:
+        spf = get_spf()
+        if spf is None:
             return False
         return spf.check(i=socket.gethostbyname(DNS_NAME.get_fqdn()), s=self.email, h=DNS_NAME.get_fqdn())
 
@@ -65,6 +69,7 @@ class Sender(models.Model):
         from pennyblack.models import Mail
         if not settings.BOUNCE_DETECTION_ENABLE:
             return
+        from Mailman.Bouncers.BouncerAPI import ScanText
         oldest_date = datetime.datetime.now() - datetime.timedelta(days=settings.BOUNCE_DETECTION_DAYS_TO_LOOK_BACK)
         try:
             if self.imap_ssl:
@@ -97,9 +102,3 @@ class Sender(models.Model):
             conn.logout()
         except imaplib.IMAP4.error:
             return
-
-
-class SenderAdmin(admin.ModelAdmin):
-    list_display = ('email', 'name',)
-    fields = ('email', 'name', 'imap_username', 'imap_password', 'imap_server', 'imap_port', 'imap_ssl', 'get_bounce_emails', 'spf_result',)
-    readonly_fields = ('spf_result',)
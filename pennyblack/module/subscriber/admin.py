@@ -1,7 +1,19 @@
 from django.contrib import admin
 
-from pennyblack.module.subscriber.models import NewsletterSubscriber,\
-    NewsletterSubscriberAdmin, SubscriberGroup, SubscriberGroupAdmin
+from pennyblack.module.subscriber.models import NewsletterSubscriber, SubscriberGroup
+from pennyblack.options import JobUnitAdmin
+
+
+class NewsletterSubscriberAdmin(admin.ModelAdmin):
+    search_fields = ('email',)
+    list_filter = ('groups', 'is_active')
+    list_display = ('__unicode__', 'is_active')
+    filter_horizontal = ('groups',)
+
+
+class SubscriberGroupAdmin(JobUnitAdmin):
+    list_display = ('__unicode__', 'get_member_count')
+
 
 admin.site.register(NewsletterSubscriber, NewsletterSubscriberAdmin)
 admin.site.register(SubscriberGroup, SubscriberGroupAdmin)
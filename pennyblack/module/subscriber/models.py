@@ -1,9 +1,8 @@
-from django.contrib import admin
 from django.contrib.contenttypes import generic
 from django.db import models
 
 from pennyblack import settings
-from pennyblack.options import NewsletterReceiverMixin, JobUnitMixin, JobUnitAdmin
+from pennyblack.options import NewsletterReceiverMixin, JobUnitMixin
 
 from django.utils.timezone import now
 
@@ -78,16 +77,10 @@ class NewsletterSubscriber(models.Model, NewsletterReceiverMixin):
         if you provide a custom ModelAdmin class and want your extensions to
         be able to patch stuff in.
         """
+        from pennyblack.module.subscriber.admin import NewsletterSubscriberAdmin
         register_fn(cls, NewsletterSubscriberAdmin)
 
 
-class NewsletterSubscriberAdmin(admin.ModelAdmin):
-    search_fields = ('email',)
-    list_filter = ('groups', 'is_active')
-    list_display = ('__unicode__', 'is_active')
-    filter_horizontal = ('groups',)
-
-
 class SubscriberGroupManager(models.Manager):
     """
     Custom manager for SubscriberGroup to provide extra functionality
@@ -138,9 +131,6 @@ class SubscriberGroup(models.Model, JobUnitMixin):
         return self.subscribers.active()
 
 
-class SubscriberGroupAdmin(JobUnitAdmin):
-    list_display = ('__unicode__', 'get_member_count')
-
 # register view links
 from pennyblack.models import Newsletter
 from pennyblack.module.subscriber.views import unsubscribe
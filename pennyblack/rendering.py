@@ -0,0 +1,239 @@
+"""
+Render plans compile everything that is the same for every mail of a job
+once, so rendering a single mail only has to evaluate the compiled nodes.
+"""
+import binascii
+import os
+import re
+import sys
+import threading
+
+from django.http import HttpRequest
+from django.template import RequestContext, Variable, VariableDoesNotExist
+from django.template.base import VariableNode
+from django.template.loader import get_template
+from django.conf import settings as django_settings
+from django.utils.encoding import force_unicode
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+
+from pennyblack import settings
+from pennyblack.tokens import Tokenizer
+
+
+class RenderPlan(object):
+    """
+    Holds the compiled newsletter template, the compiled templates of all
+    content blocks of the job's newsletter and its encoded attachments.
+
+    Every mail rendered with the plan has to use the same newsletter instance,
+    otherwise the content blocks would be loaded and compiled again.
+    """
+    def __init__(self, job, skeleton=None):
+        self.job = job
+        self.newsletter = job.newsletter
+        self.template = get_template(self.newsletter.template.path)
+        for content in self.newsletter.content.all_of_type(tuple(self.newsletter._feincms_content_types)):
+            if hasattr(content, 'compile_template'):
+                content.compile_template()
+        self.attachments = [attachment.get_mime_part() for attachment in self.newsletter.attachments.all()]
+        self.tokenizer = Tokenizer() if settings.TRACKING_TOKENS else None
+        if skeleton is None:
+            skeleton = settings.SKELETON_RENDERING
+        self.skeleton = Skeleton(self.render_template, self.get_skeleton_context) if skeleton else None
+
+    def get_skeleton_context(self, skeleton):
+        """
+        Returns the context of a mail where every receiver specific value is
+        replaced by a slot.
+        """
+        return {
+            'person': skeleton.slot('person'),
+            'group_object': self.job.group_object,
+            'mail': skeleton.slot('mail', constants={'job': self.job}),
+            'base_url': self.newsletter.get_base_url(),
+            'newsletter': self.newsletter,
+            'public_url': self.job.public_url,
+            'webview': False,
+        }
+
+    def render(self, mail, webview=False):
+        """
+        Renders the content of mail.
+        """
+        if self.skeleton is not None and not webview and mail.extra_context is None:
+            content = self.skeleton.render(mail)
+            if content is not None:
+                return content
+        return self.render_template(mail.get_content_context(webview=webview))
+
+    def render_template(self, context):
+        """
+        Renders the newsletter the same way render_to_string does.
+        """
+        request = HttpRequest()
+        request.content_context = context
+        context_instance = RequestContext(request)
+        context_instance.update(context)
+        return self.template.render(context_instance)
+
+
+class SkeletonUnsupported(Exception):
+    pass
+
+
+# the functions of the template engine which turn the value of a variable
+# node into text, the debug variable node does it in its render method
+RENDER_VALUE_FUNCTIONS = ('_render_value_in_context', 'render_value_in_context')
+
+
+def _renders_value(frame):
+    return (frame.f_code.co_name in RENDER_VALUE_FUNCTIONS or
+            isinstance(frame.f_locals.get('self'), VariableNode))
+
+
+class Slot(object):
+    """
+    Stands in for a receiver specific value while the skeleton is rendered.
+
+    A slot renders to a marker, attribute and item access return nested slots
+    and calling a slot returns itself. Everything else a template could do
+    with the value (comparing, testing, iterating, passing it through a
+    filter) raises SkeletonUnsupported because the outcome would differ
+    between receivers.
+    """
+    do_not_call_in_templates = False
+    alters_data = False
+
+    def __init__(self, skeleton, path, constants=None):
+        self._skeleton = skeleton
+        self._path = path
+        self._constants = constants or {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self._constants:
+            return self._constants[name]
+        return self._skeleton.slot('%s.%s' % (self._path, name))
+
+    def __getitem__(self, key):
+        return self.__getattr__(str(key))
+
+    def __call__(self):
+        return self
+
+    def __unicode__(self):
+        # only a variable node which renders the value as it is may get the
+        # marker, filters like urlencode or truncatewords would otherwise
+        # transform the marker instead of the value
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_code.co_name == 'force_unicode':
+            frame = frame.f_back
+        if frame is None or not _renders_value(frame):
+            self._unsupported()
+        return self._skeleton.marker(self._path)
+
+    def _unsupported(self, *args, **kwargs):
+        # filters which catch the exception still disable the skeleton
+        self._skeleton.unsupported = True
+        raise SkeletonUnsupported(self._path)
+
+    __str__ = __nonzero__ = __len__ = __iter__ = __contains__ = _unsupported
+    __eq__ = __ne__ = __lt__ = __le__ = __gt__ = __ge__ = __cmp__ = _unsupported
+    __int__ = __float__ = __add__ = __radd__ = __mod__ = _unsupported
+
+
+class Skeleton(object):
+    """
+    The rendered newsletter split into literal parts and receiver specific
+    slots. A mail is built by joining the literals with the values of its
+    receiver, which is a lot cheaper than rendering the templates.
+
+    The skeleton is built on the first mail and verified against a full
+    render of that mail. If the templates use a slot in a way the skeleton
+    can't reproduce, render returns None and the caller falls back to
+    template rendering.
+
+    Markers contain a "<", so a marker which was autoescaped can be told
+    apart from one rendered with autoescaping turned off. Values are only
+    escaped where their marker was.
+    """
+    def __init__(self, render_template, get_context):
+        self._render_template = render_template
+        self._get_context = get_context
+        self.nonce = binascii.hexlify(os.urandom(8))
+        self.paths = []
+        self.literals = None
+        self.variables = None
+        self.escaped = None
+        self.unsupported = False
+        self.disabled = False
+        self.verified = False
+        self.lock = threading.Lock()
+
+    def slot(self, path, constants=None):
+        return Slot(self, path, constants)
+
+    def marker(self, path):
+        if path not in self.paths:
+            self.paths.append(path)
+        return u'PbSlot%dx%s<' % (self.paths.index(path), self.nonce)
+
+    def build(self):
+        """
+        Renders the skeleton, returns False if the templates can't be
+        rendered as a skeleton.
+        """
+        try:
+            output = self._render_template(self._get_context(self))
+        except Exception:
+            return False
+        if self.unsupported:
+            return False
+        pattern = re.compile(r'PbSlot(\d+)x%s(<|&lt;)' % self.nonce)
+        # block filters like {% filter upper %} mangle the markers
+        if len(re.findall(self.nonce, output, re.I)) != len(pattern.findall(output)):
+            return False
+        parts = pattern.split(output)
+        self.literals = parts[0::3]
+        self.variables = [Variable(self.paths[int(index)]) for index in parts[1::3]]
+        self.escaped = [end != '<' for end in parts[2::3]]
+        return True
+
+    def fill(self, mail):
+        """
+        Joins the literals with the values of mail.
+        """
+        context = mail.get_context()
+        bits = [self.literals[0]]
+        for variable, escaped, literal in zip(self.variables, self.escaped, self.literals[1:]):
+            try:
+                value = localize(variable.resolve(context))
+            except VariableDoesNotExist:
+                value = django_settings.TEMPLATE_STRING_IF_INVALID
+            bits.append(conditional_escape(value) if escaped else force_unicode(value))
+            bits.append(literal)
+        return u''.join(bits)
+
+    def render(self, mail):
+        """
+        Returns the content for mail or None if the caller has to render the
+        templates.
+        """
+        if self.verified:
+            return self.fill(mail)
+        with self.lock:
+            if self.disabled:
+                return None
+            if self.verified:
+                return self.fill(mail)
+            if not self.build():
+                self.disabled = True
+                return None
+            content = self._render_template(mail.get_content_context())
+            if self.fill(mail) != content:
+                self.disabled = True
+            else:
+                self.verified = True
+            return content
@@ -0,0 +1,110 @@
+"""
+Timelines for the job statistics, built from one grouped query per series.
+"""
+import datetime
+
+from django.conf import settings as django_settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count
+from django.db.backends.util import typecast_timestamp
+
+from pennyblack import settings
+
+try:
+    from django.utils import timezone
+except ImportError:
+    timezone = None
+    now = datetime.datetime.now
+else:
+    now = timezone.now
+
+# number of hours shown in the statistics of a job
+TIMELINE_HOURS = 14 * 24
+
+
+def _hour_sql(column):
+    if connection.vendor == 'sqlite':
+        # the date_trunc function of the sqlite backend knows no hours
+        return "strftime('%%%%Y-%%%%m-%%%%d %%%%H:00:00', %s)" % column
+    return connection.ops.date_trunc_sql('hour', column)
+
+
+def _to_datetime(value):
+    if isinstance(value, basestring):
+        value = typecast_timestamp(value)
+    if timezone is not None and getattr(django_settings, 'USE_TZ', False) and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def count_by_hour(queryset, field, group_by=()):
+    """
+    Returns a dict mapping hours to the number of objects of queryset whose
+    field lies within that hour. If group_by is given, the keys are tuples
+    of the hour and the values of these fields.
+    """
+    opts = queryset.model._meta
+    qn = connection.ops.quote_name
+    column = '%s.%s' % (qn(opts.db_table), qn(opts.get_field(field).column))
+    counts = queryset.exclude(**{field: None}).extra(select={'hour': _hour_sql(column)}) \
+        .values('hour', *group_by).annotate(count=Count(field)).order_by()
+    if not group_by:
+        return dict((_to_datetime(row['hour']), row['count']) for row in counts)
+    return dict(((_to_datetime(row['hour']),) + tuple(row[name] for name in group_by), row['count']) for row in counts)
+
+
+def get_timeline(queryset, field, date_start, hours=TIMELINE_HOURS):
+    """
+    Returns a list of (hour, count) tuples with the number of objects whose
+    field lies before the hour, one for every hour from date_start up to the
+    first hour in the future.
+    """
+    date_start = date_start.replace(minute=0, second=0, microsecond=0)
+    counts = sorted(count_by_hour(queryset, field).items())
+    current = now()
+    timeline = []
+    total = 0
+    for i in range(hours):
+        hour = date_start + datetime.timedelta(hours=i)
+        while counts and counts[0][0] < hour:
+            total += counts.pop(0)[1]
+        timeline.append((hour, total))
+        if hour > current:
+            break
+    return timeline
+
+
+def format_timeline(timeline):
+    """
+    Returns the timeline as javascript arrays of timestamps in milliseconds
+    and counts.
+    """
+    return ','.join('[%s000,%s]' % (hour.strftime('%s'), count) for hour, count in timeline)
+
+
+def get_job_timelines(job):
+    """
+    Returns the formatted open and click timelines of job. The timelines of
+    finished jobs are cached, until the shown period is over only for
+    TIMELINE_CACHE_TIMEOUT seconds since views and clicks keep coming in.
+    """
+    from pennyblack.models import LinkClick
+    if job.date_deliver_start is None:
+        return {'opened_serie': '', 'clicked_serie': ''}
+    cache_key = 'pennyblack_job_timelines_%s' % job.pk
+    if job.status == 31:
+        timelines = cache.get(cache_key)
+        if timelines is not None:
+            return timelines
+    timelines = {
+        'opened_serie': format_timeline(get_timeline(job.mails.all(), 'viewed', job.date_deliver_start)),
+        'clicked_serie': format_timeline(get_timeline(LinkClick.objects.filter(link__job=job), 'date', job.date_deliver_start)),
+    }
+    if job.status == 31:
+        if job.date_deliver_start + datetime.timedelta(hours=TIMELINE_HOURS) < now():
+            timeout = settings.TIMELINE_CACHE_TIMEOUT_FINAL
+        else:
+            timeout = settings.TIMELINE_CACHE_TIMEOUT
+        cache.set(cache_key, timelines, timeout)
+    return timelines
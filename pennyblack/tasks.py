@@ -1,7 +1,7 @@
 from datetime import timedelta
 
 from celery.decorators import periodic_task
-from celery.task import Task
+from celery.task import Task, chord
 
 from pennyblack import settings
 
@@ -15,8 +15,60 @@ def pennyblack_get_email():
         sender.get_mail()
 
 
+@periodic_task(run_every=timedelta(seconds=settings.WORKFLOW_QUEUE_INTERVAL))
+def pennyblack_send_queued_mails():
+    """send the queued workflow mails"""
+    from pennyblack.models import QueuedMail
+    # mails can be queued with enqueue=True even if WORKFLOW_QUEUE is off
+    while QueuedMail.objects.send_batch():
+        pass
+
+
+@periodic_task(run_every=timedelta(seconds=settings.EVENT_LOG_ROTATE))
+def pennyblack_flush_events():
+    """write the logged views and clicks of the host of this worker to the database"""
+    from pennyblack import events
+    if events.is_enabled():
+        events.flush_events()
+
+
+@periodic_task(run_every=timedelta(seconds=settings.ROLLUP_INTERVAL))
+def pennyblack_rollup_statistics():
+    """add the new opens and clicks to the hourly statistics"""
+    from pennyblack.models.rollup import rollup_statistics
+    if settings.ROLLUP:
+        rollup_statistics()
+
+
 class SendJobTask(Task):
+    """
+    Sends a job. If the job is split into more than one shard, it's prepared
+    here and every shard is sent by its own SendJobShardTask, the job is
+    finished by FinishJobTask once all shards are sent.
+    """
     def run(self, job_id):
         from pennyblack.models import Job
         j = Job.objects.get(id=job_id)
-        j.send()
+        # the shards are computed by the worker, the mails of a big job
+        # aren't walked within the request which started sending
+        shards = j.get_shards()
+        if len(shards) <= 1:
+            j.send()
+            return
+        j.prepare_sending()
+        header = [SendJobShardTask.subtask((job_id, min_id, max_id)) for min_id, max_id in shards]
+        chord(header)(FinishJobTask.subtask((job_id,)))
+
+
+class SendJobShardTask(Task):
+    def run(self, job_id, min_id, max_id):
+        from pennyblack.models import Job
+        j = Job.objects.get(id=job_id)
+        j.send_mails(min_id=min_id, max_id=max_id)
+
+
+class FinishJobTask(Task):
+    def run(self, results, job_id):
+        from pennyblack.models import Job
+        j = Job.objects.get(id=job_id)
+        j.finish_sending()
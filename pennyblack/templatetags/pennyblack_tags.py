@@ -105,6 +105,26 @@ def header_image(parser, token):
     return NewsletterHeaderImageNode(extra_args=extra_args)
 
 
+class TrackingPixelNode(template.Node):
+    def render(self, context):
+        from pennyblack.views import PIXEL_FILENAME
+        if context.get('webview') or 'mail' not in context:
+            return ''
+        url = context['newsletter'].get_base_url() + reverse('pennyblack.ping', kwargs={'mail_hash': context['mail'].mail_hash, 'filename': PIXEL_FILENAME})
+        return """<img src="%s" width="1" height="1" border="0" alt="" />""" % url
+
+
+@register.tag
+def tracking_pixel(parser, token):
+    """
+    Renders a transparent 1x1 image which tracks when the email is opened,
+    for templates without a header image.
+
+    {% tracking_pixel %}
+    """
+    return TrackingPixelNode()
+
+
 class NewsletterLinkUrlNode(template.Node):
     def __init__(self, identifier=None):
         self.identifier = identifier
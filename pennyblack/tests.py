@@ -1,8 +1,113 @@
-from pennyblack.models import Newsletter
-from pennyblack.content.richtext import TextOnlyNewsletterContent
-from django.core.urlresolvers import reverse
+from pennyblack import events, settings, views
+from pennyblack.admin import NewsletterAdmin
+from pennyblack.models import Newsletter, EmailClient, Job, JobCounters, JobHourlyStatistic, Link, LinkClick, LinkHourlyStatistic, Mail, QueuedMail, RollupWatermark, Sender, UserAgent
+from pennyblack.module.subscriber.models import NewsletterSubscriber
+from pennyblack.content.richtext import TextOnlyNewsletterContent, add_link_style
+from pennyblack import default_settings
+from pennyblack.delivery import ConnectionPool, DeliveryEngine, DeliveryWorker, DomainScheduler, Throttled, TokenBucket
+from pennyblack.cache import WorkflowCache, workflow_cache
+from pennyblack.rendering import RenderPlan, Skeleton
+from pennyblack.models.emailclient import normalize_user_agents
+from pennyblack.models.mail import load_persons
+from pennyblack.models.newsletter import Attachment
+from pennyblack.models.rollup import rollup_statistics
+from pennyblack.statistics import get_timeline
+from pennyblack.tokens import Tokenizer, make_token, parse_token
+from pennyblack.useragents import classify
+from pennyblack.utils import LRUCache
+from pennyblack.views import PIXEL_FILENAME, get_cached_webview, view_public
+try:
+    from pennyblack.async_delivery import AsyncDeliveryEngine, SMTPSession
+except ImportError:
+    AsyncDeliveryEngine = None
+try:
+    from pennyblack import tasks
+except ImportError:
+    tasks = None
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.http import Http404
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+from django.template import Context, Template
+from django.utils import translation
+from django.utils.html import escape
+from feincms.module.medialibrary.models import MediaFile
+from django.core.urlresolvers import resolve, reverse
+from django.db import connection, reset_queries
+import asyncore
+import datetime
+import functools
+import glob
+import os
+import shutil
+import smtpd
+import smtplib
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+try:
+    from django.utils.timezone import now
+except ImportError:
+    now = datetime.datetime.now
+
+
+def get_queries(function, *args, **kwargs):
+    """
+    Returns the sql of the queries function runs.
+    """
+    old, connection.use_debug_cursor = connection.use_debug_cursor, True
+    # the test client resets the queries when a request starts as well
+    reset_queries()
+    try:
+        function(*args, **kwargs)
+    finally:
+        connection.use_debug_cursor = old
+    return [query['sql'] for query in connection.queries]
+
+
+def get_text_content_type():
+    # the example project registers its content types through the implicit
+    # relative import example.pennyblack, so they aren't found by class
+    return dict((cls.__name__, cls) for cls in Newsletter._feincms_content_types)['TextOnlyNewsletterContent']
+
+
+def create_newsletter(newsletter_type=1, text=u'<p>Hello {{person.email}}</p>'):
+    """
+    Creates a newsletter with one text content, delete it with
+    delete_newsletter.
+    """
+    newsletter = Newsletter.objects.create(
+        name='test', newsletter_type=newsletter_type, subject='Test', language='en',
+        sender=Sender.objects.create(email='from@example.com', name='test'),
+        header_image=MediaFile.objects.create(file='header.png', type='image', file_size=0),
+        header_url='http://www.example.com/', site_id=1, template_key='base')
+    get_text_content_type().objects.create(
+        parent=newsletter, region='main', ordering=0, title=u'Title', text=text)
+    return newsletter
+
+
+def delete_newsletter(newsletter):
+    for job in newsletter.jobs.all():
+        LinkClick.objects.filter(link__job=job).delete()
+        EmailClient.objects.filter(mail__job=job).delete()
+        QueuedMail.objects.filter(mail__job=job).delete()
+        job.links.all().delete()
+        job.mails.all().delete()
+        Job.objects.filter(pk=job.pk).delete()
+    for cls in Newsletter._feincms_content_types:
+        cls.objects.filter(parent=newsletter).delete()
+    Newsletter.objects.filter(pk=newsletter.pk).delete()
+    newsletter.sender.delete()
+    newsletter.header_image.delete()
+
 
 class NewsletterTestCase(unittest.TestCase):
     # def setUp(self):
@@ -81,3 +186,1278 @@ class RichtextContentTest(unittest.TestCase):
         self.content.text = '<a >link</a><a >link</a>'
         self.content.prepare_to_send()
         self.assertEqual(self.content.text, '<a {% get_newsletterstyle request text_and_image_title %}>link</a><a {% get_newsletterstyle request text_and_image_title %}>link</a>')
+
+    def test_add_link_style_once(self):
+        text = add_link_style('<a href="http://www.test.com">link</a><a >link</a>')
+        self.assertEqual(text.count('get_newsletterstyle'), 2)
+        self.assertEqual(add_link_style(text), text)
+
+
+class DeliveryEngineTest(unittest.TestCase):
+    class Mail(object):
+        def __init__(self, number):
+            self.number = number
+            self.sent = False
+
+        def get_message(self, render_plan=None):
+            return mail.EmailMessage('subject %s' % self.number, 'body', 'from@example.com', ['to@example.com'])
+
+        def mark_sent(self):
+            self.sent = True
+
+    def setUp(self):
+        mail.outbox = []
+        self.mails = [self.Mail(i) for i in range(20)]
+
+    def test_deliver(self):
+        DeliveryEngine(concurrency=1).deliver(iter(self.mails))
+        self.assertEqual(len(mail.outbox), 20)
+        self.assertTrue(all(m.sent for m in self.mails))
+
+    def test_deliver_parallel(self):
+        DeliveryEngine(concurrency=4).deliver(iter(self.mails))
+        self.assertEqual(len(mail.outbox), 20)
+        self.assertTrue(all(m.sent for m in self.mails))
+        self.assertEqual(sorted(m.subject for m in mail.outbox), sorted('subject %s' % i for i in range(20)))
+
+    def test_worker_error_is_raised(self):
+        def broken(render_plan=None):
+            raise ValueError('broken')
+        self.mails[5].get_message = broken
+        self.assertRaises(ValueError, DeliveryEngine(concurrency=4).deliver, iter(self.mails))
+
+    def test_worker_closed_on_error(self):
+        closed = []
+
+        class Worker(DeliveryWorker):
+            def close(self):
+                closed.append(self)
+                super(Worker, self).close()
+
+        def broken(render_plan=None):
+            raise ValueError('broken')
+        self.mails[5].get_message = broken
+        for concurrency in (1, 4):
+            engine = DeliveryEngine(concurrency=concurrency)
+            engine.worker_class = Worker
+            del closed[:]
+            self.assertRaises(ValueError, engine.deliver, iter(self.mails))
+            self.assertEqual(len(closed), concurrency)
+
+
+class AttachmentTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old_threshold = settings.ATTACHMENT_MMAP_THRESHOLD
+
+    def tearDown(self):
+        settings.ATTACHMENT_MMAP_THRESHOLD = self.old_threshold
+        shutil.rmtree(self.directory)
+
+    def get_attachment(self, name, content, mimetype):
+        path = os.path.join(self.directory, 'attachment')
+        with open(path, 'wb') as f:
+            f.write(content)
+        attachment = Attachment(name=name, mimetype=mimetype)
+        attachment.file = File(open(path, 'rb'), name=path)
+        return attachment
+
+    def test_mime_part(self):
+        content = ''.join(chr(i % 256) for i in range(5000))
+        for threshold in (0, len(content) + 1):
+            settings.ATTACHMENT_MMAP_THRESHOLD = threshold
+            part = self.get_attachment('report.pdf', content, 'application/pdf').get_mime_part()
+            self.assertEqual(part.get_content_type(), 'application/pdf')
+            self.assertEqual(part.get_filename(), 'report.pdf')
+            self.assertEqual(part.get_payload(decode=True), content)
+            # the part is encoded once and attached to every mail as it is
+            messages = [mail.EmailMessage('subject', 'body', 'from@example.com', [to], attachments=[part]).message()
+                        for to in ('a@example.com', 'b@example.com')]
+            self.assertTrue(messages[0].get_payload()[-1] is messages[1].get_payload()[-1])
+            self.assertTrue(part.get_payload() in messages[0].as_string())
+            self.assertTrue(part.get_payload() in messages[1].as_string())
+
+    def test_text_part(self):
+        part = self.get_attachment(u'gr\xfc\xdfe.txt', 'Gr\xc3\xbc\xc3\x9fe', '').get_mime_part()
+        self.assertEqual(part.get_content_type(), 'text/plain')
+        self.assertEqual(part.get_payload(decode=True), 'Gr\xc3\xbc\xc3\x9fe')
+        self.assertEqual(part.get_filename(), u'gr\xfc\xdfe.txt')
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    class Connection(object):
+        def __init__(self):
+            self.opened = 0
+            self.closed = 0
+            self.sent = []
+
+        def open(self):
+            self.opened += 1
+
+        def close(self):
+            self.closed += 1
+
+        def send_messages(self, messages):
+            self.sent.extend(messages)
+
+    def setUp(self):
+        self.connections = []
+
+    def get_connection(self):
+        self.connections.append(self.Connection())
+        return self.connections[-1]
+
+    def test_reuse(self):
+        pool = ConnectionPool(size=2, idle_timeout=30, get_connection=self.get_connection)
+        for i in range(5):
+            pool.send(mail.EmailMessage('subject', 'body', 'from@example.com', ['to@example.com']))
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(len(self.connections[0].sent), 5)
+        pool.close()
+        self.assertEqual(self.connections[0].closed, 1)
+
+    def test_size(self):
+        pool = ConnectionPool(size=2, idle_timeout=30, get_connection=self.get_connection)
+        first, second = pool.acquire(), pool.acquire()
+        self.assertFalse(pool.slots.acquire(False))
+        pool.release(first)
+        self.assertTrue(pool.acquire() is first)
+        pool.release(first)
+        pool.release(second)
+
+    def test_discard_on_error(self):
+        pool = ConnectionPool(size=2, idle_timeout=30, get_connection=self.get_connection)
+        connection = pool.acquire()
+        pool.release(connection, discard=True)
+        self.assertEqual(connection.closed, 1)
+        self.assertFalse(pool.acquire() is connection)
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(size=2, idle_timeout=-1, get_connection=self.get_connection)
+        connection = pool.acquire()
+        pool.release(connection)
+        self.assertFalse(pool.acquire() is connection)
+
+
+class WorkflowCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return self.loads
+
+    def test_get(self):
+        workflow_cache = WorkflowCache(enabled=True, shared=False)
+        self.assertEqual(workflow_cache.get('key', self.load), 1)
+        self.assertEqual(workflow_cache.get('key', self.load), 1)
+        workflow_cache.invalidate()
+        self.assertEqual(workflow_cache.get('key', self.load), 2)
+
+    def test_timeout(self):
+        workflow_cache = WorkflowCache(enabled=True, shared=False, timeout=-1)
+        workflow_cache.get('key', self.load)
+        self.assertEqual(workflow_cache.get('key', self.load), 2)
+
+    def test_instances(self):
+        workflow_cache = WorkflowCache(enabled=True, shared=False)
+        job = Job(id=1, status=32)
+        self.assertTrue(workflow_cache.get('job', lambda: job) is job)
+        cached = workflow_cache.get('job', self.load)
+        self.assertFalse(cached is job)
+        self.assertEqual((cached.pk, cached.status, cached._state.adding), (1, 32, False))
+        cached.status = 31
+        self.assertEqual(workflow_cache.get('job', self.load).status, 32)
+
+    def test_disabled(self):
+        workflow_cache = WorkflowCache(enabled=False, shared=False)
+        workflow_cache.get('key', self.load)
+        self.assertEqual(workflow_cache.get('key', self.load), 2)
+
+    def test_shared(self):
+        first, second = WorkflowCache(enabled=True, shared=True), WorkflowCache(enabled=True, shared=True)
+        first.get('key', self.load)
+        self.assertEqual(second.get('key', self.load), 2)
+        first.invalidate()
+        self.assertEqual(second.get('key', self.load), 3)
+        self.assertEqual(second.get('key', self.load), 3)
+
+
+class WorkflowPrepareTest(unittest.TestCase):
+    def setUp(self):
+        self.newsletter = create_newsletter(newsletter_type=2, text=u'<a href="http://www.example.com/">link</a>')
+        self.subscriber = NewsletterSubscriber.objects.create(email='prepare@example.com')
+
+    def tearDown(self):
+        delete_newsletter(self.newsletter)
+        self.subscriber.delete()
+
+    def get_text(self):
+        return get_text_content_type().objects.get(parent=self.newsletter).text
+
+    def set_text(self, text):
+        get_text_content_type().objects.filter(parent=self.newsletter).update(text=text)
+
+    def send(self):
+        Newsletter.objects.get(pk=self.newsletter.pk).send(self.subscriber, enqueue=True)
+
+    def test_prepare_once(self):
+        self.send()
+        text = self.get_text()
+        self.assertTrue('link_style' in text)
+        self.assertFalse('http://www.example.com/' in text)
+        # the prepared version isn't prepared again
+        self.set_text(text + u'<a href="http://www.example.com/other/">other</a>')
+        self.send()
+        self.assertTrue('http://www.example.com/other/' in self.get_text())
+        # until the content is changed
+        Newsletter.objects.get(pk=self.newsletter.pk).content_changed()
+        self.send()
+        self.assertFalse('http://www.example.com/other/' in self.get_text())
+        self.assertEqual(self.get_text().count('link_style'), 2)
+        # both links and the header url
+        self.assertEqual(self.newsletter.jobs.get().links.count(), 3)
+
+    def test_cached_job(self):
+        old_enabled, workflow_cache.enabled = workflow_cache.enabled, True
+        try:
+            newsletter = Newsletter.objects.get(pk=self.newsletter.pk)
+            # the first send prepares the newsletter which drops the cache
+            newsletter.send(self.subscriber, enqueue=False)
+            newsletter.send(self.subscriber, enqueue=False)
+            # saving a job of a mass mailing keeps the cached workflow job
+            Job.objects.create(newsletter=newsletter).delete()
+            queries = get_queries(newsletter.send, self.subscriber, enqueue=False)
+        finally:
+            workflow_cache.enabled = old_enabled
+        # neither the job nor its newsletter and sender are looked up again
+        for table in ('pennyblack_job', 'pennyblack_newsletter', 'pennyblack_sender'):
+            self.assertFalse([sql for sql in queries if 'FROM "%s"' % table in sql], table)
+        self.assertEqual(len(queries), 6)
+
+    def test_admin_version(self):
+        class Form(object):
+            instance = Newsletter.objects.get(pk=self.newsletter.pk)
+
+            def save_m2m(self):
+                pass
+
+        class Formset(object):
+            saved_versions = []
+
+            def save(self):
+                self.saved_versions.append(Newsletter.objects.get(pk=self.newsletter.pk).content_version)
+        Formset.newsletter = self.newsletter
+        form, formset = Form(), Formset()
+        model_admin = NewsletterAdmin(Newsletter, admin.site)
+        model_admin.save_model(None, form.instance, form, True)
+        model_admin.save_related(None, form, [formset], True)
+        # the version is increased once the content blocks are saved
+        self.assertEqual(formset.saved_versions, [1])
+        self.assertEqual(Newsletter.objects.get(pk=self.newsletter.pk).content_version, 2)
+
+
+class SkeletonTest(unittest.TestCase):
+    class Person(object):
+        def __init__(self, email):
+            self.email = email
+
+    class Mail(object):
+        extra_context = None
+
+        def __init__(self, mail_hash, person):
+            self.mail_hash = mail_hash
+            self.person = person
+
+        def get_context(self):
+            return {'person': self.person, 'mail': self, 'base_url': 'http://example.com'}
+
+        def get_content_context(self, webview=False):
+            return self.get_context()
+
+    def get_skeleton(self, text):
+        template = Template(text)
+
+        def get_context(skeleton):
+            return {'person': skeleton.slot('person'), 'mail': skeleton.slot('mail'), 'base_url': 'http://example.com'}
+        return Skeleton(lambda context: template.render(Context(context)), get_context)
+
+    def get_mails(self):
+        return [self.Mail('hash%s' % i, self.Person('test%s@<example>.com' % i)) for i in range(3)]
+
+    def test_fill(self):
+        text = '<a href="{{base_url}}/link/{{mail.mail_hash}}/">{{person.email}}</a>'
+        skeleton = self.get_skeleton(text)
+        for m in self.get_mails():
+            self.assertEqual(skeleton.render(m), Template(text).render(Context(m.get_context())))
+        self.assertTrue(skeleton.verified)
+
+    def test_condition_falls_back(self):
+        skeleton = self.get_skeleton('{% if person.email %}{{person.email}}{% endif %}')
+        self.assertEqual(skeleton.render(self.get_mails()[0]), None)
+        self.assertTrue(skeleton.disabled)
+
+    def test_filter_falls_back(self):
+        skeleton = self.get_skeleton('{{person.email|upper}}')
+        self.assertEqual(skeleton.render(self.get_mails()[0]), None)
+        self.assertTrue(skeleton.disabled)
+
+    def test_value_dependent_filters_fall_back(self):
+        for text in ('{{person.email|urlencode}}', '{{person.email|addslashes}}', '{{person.email|cut:"@"}}',
+                     '{{person.email|truncatewords:5}}', '{{person.email|safe}}', '{{person.email|default:"x"}}'):
+            skeleton = self.get_skeleton(text)
+            self.assertEqual(skeleton.render(self.get_mails()[0]), None, text)
+            self.assertTrue(skeleton.disabled, text)
+
+    def test_autoescape_off(self):
+        text = '{% autoescape off %}{{person.email}}{% endautoescape %} {{person.email}}'
+        skeleton = self.get_skeleton(text)
+        for m in self.get_mails():
+            self.assertEqual(skeleton.render(m), Template(text).render(Context(m.get_context())))
+        self.assertTrue(skeleton.verified)
+
+
+class RenderPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.newsletter = create_newsletter(
+            text=u'<p>Gr\xfc\xdfe {{person.email}}</p><a href="{{base_url}}/link/{{mail.mail_hash}}/">link</a>')
+        get_text_content_type().objects.create(parent=self.newsletter, region='main', ordering=1,
+                                                title=u'{{newsletter.subject}}', text=u'<p>{{public_url}}</p>')
+        # saving would create the thumbnail of a real image
+        image_content_type = dict((cls.__name__, cls) for cls in Newsletter._feincms_content_types)['TextWithImageNewsletterContent']
+        image_content_type.objects.bulk_create([image_content_type(
+            parent=self.newsletter, region='main', ordering=2, title=u'Image', text=u'{{person.email}}',
+            image_original=self.newsletter.header_image, image_thumb='newsletter/images/image.jpg', image_width=100, image_height=50,
+            image_url='http://www.example.com/image/', image_url_replaced='{{base_url}}/image/{{mail.mail_hash}}/',
+            position=position) for position in ('top', 'left')])
+        self.job = Job.objects.create(newsletter=self.newsletter, public_slug='render-plan-test')
+        self.subscribers = [NewsletterSubscriber.objects.create(email='plan%d@<example>.com' % i) for i in range(3)]
+        self.job.create_mails(self.subscribers)
+
+    def tearDown(self):
+        delete_newsletter(self.newsletter)
+        for subscriber in self.subscribers:
+            subscriber.delete()
+
+    def test_same_output(self):
+        for skeleton in (False, True):
+            plan = RenderPlan(Job.objects.get(pk=self.job.pk), skeleton=skeleton)
+            for m in self.job.mails.order_by('pk'):
+                for webview in (False, True):
+                    content = m.get_content(webview=webview)
+                    self.assertTrue(escape(m.person.email) in content)
+                    self.assertEqual(plan.render(m, webview=webview), content)
+
+
+class CreateMailsTest(unittest.TestCase):
+    def setUp(self):
+        self.job = Job.objects.create()
+        self.subscribers = [NewsletterSubscriber.objects.create(email='test%s@example.com' % i) for i in range(5)]
+
+    def tearDown(self):
+        self.job.mails.all().delete()
+        Job.objects.filter(pk=self.job.pk).delete()
+        NewsletterSubscriber.objects.filter(pk__in=[s.pk for s in self.subscribers]).delete()
+
+    def test_create_mails(self):
+        self.job.create_mails(NewsletterSubscriber.objects.filter(pk__in=[s.pk for s in self.subscribers]), batch_size=2)
+        mails = list(self.job.mails.all())
+        self.assertEqual(len(mails), 5)
+        self.assertEqual(set(m.person for m in mails), set(self.subscribers))
+        self.assertEqual(len(set(m.mail_hash for m in mails)), 5)
+        self.assertTrue(all(len(m.mail_hash) == 32 for m in mails))
+
+    def test_update_status(self):
+        self.job.create_mails(NewsletterSubscriber.objects.filter(pk__in=[s.pk for s in self.subscribers]))
+        mails = list(self.job.mails.order_by('pk'))
+        for m in mails:
+            m.email = m.person.email
+        self.job.mails.update_status(mails[:3], sent=True)
+        self.job.mails.update_status(mails[3:], bounced=True)
+        self.assertEqual(self.job.mails.filter(sent=True).count(), 3)
+        self.assertEqual(self.job.mails.filter(bounced=True).count(), 2)
+        self.assertEqual(sorted(self.job.mails.values_list('email', flat=True)), sorted(s.email for s in self.subscribers))
+
+    def test_get_shards(self):
+        self.job.create_mails(NewsletterSubscriber.objects.filter(pk__in=[s.pk for s in self.subscribers]))
+        mail_ids = list(self.job.mails.order_by('pk').values_list('pk', flat=True))
+        self.assertEqual(self.job.get_shards(shard_size=0), [])
+        self.assertEqual(self.job.get_shards(shard_size=2), [(mail_ids[0], mail_ids[1]), (mail_ids[2], mail_ids[3]), (mail_ids[4], mail_ids[4])])
+
+
+class SendJobTest(unittest.TestCase):
+    def setUp(self):
+        mail.outbox = []
+        self.newsletter = create_newsletter()
+        self.job = Job.objects.create(newsletter=self.newsletter)
+        self.subscribers = [NewsletterSubscriber.objects.create(email='shard%d@example.com' % i) for i in range(5)]
+        self.job.create_mails(self.subscribers)
+        self.old_shard_size, settings.SEND_SHARD_SIZE = settings.SEND_SHARD_SIZE, 2
+
+    def tearDown(self):
+        settings.SEND_SHARD_SIZE = self.old_shard_size
+        for job in Job.objects.filter(pk=self.job.pk).select_related('newsletter'):
+            if job.newsletter != self.newsletter:
+                delete_newsletter(job.newsletter)
+        delete_newsletter(self.newsletter)
+        for subscriber in self.subscribers:
+            subscriber.delete()
+
+    def assertFinished(self, status=31):
+        job = Job.objects.get(pk=self.job.pk)
+        self.assertEqual(job.status, status)
+        self.assertEqual(job.mails.filter(sent=False).count(), 0)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), sorted(s.email for s in self.subscribers))
+
+    def test_shards(self):
+        # what the tasks do for a job with three shards
+        shards = self.job.get_shards()
+        self.assertEqual(len(shards), 3)
+        self.job.prepare_sending()
+        for min_id, max_id in shards:
+            Job.objects.get(pk=self.job.pk).send_mails(min_id=min_id, max_id=max_id)
+        Job.objects.get(pk=self.job.pk).finish_sending()
+        self.assertFinished()
+
+    def test_failed_shard(self):
+        self.job.prepare_sending()
+        # a shard failed while the others were sent
+        Job.objects.filter(pk=self.job.pk).update(status=41)
+        Job.objects.get(pk=self.job.pk).finish_sending()
+        self.assertEqual(Job.objects.get(pk=self.job.pk).status, 41)
+
+    @unittest.skipIf(tasks is None, 'celery is not installed')
+    def test_tasks(self):
+        from celery.app import app_or_default
+        conf = app_or_default().conf
+        old_eager, conf.CELERY_ALWAYS_EAGER = conf.CELERY_ALWAYS_EAGER, True
+        try:
+            self.job.start_sending()
+        finally:
+            conf.CELERY_ALWAYS_EAGER = old_eager
+        self.assertFinished()
+
+
+class QueuedMailTest(unittest.TestCase):
+    def setUp(self):
+        self.job = Job.objects.create()
+        self.subscriber = NewsletterSubscriber.objects.create(email='queued@example.com')
+        self.mails = [self.job.create_mail(self.subscriber) for i in range(3)]
+
+    def tearDown(self):
+        QueuedMail.objects.filter(mail__job=self.job).delete()
+        self.job.mails.all().delete()
+        Job.objects.filter(pk=self.job.pk).delete()
+        self.subscriber.delete()
+
+    def test_extra(self):
+        entry = QueuedMail.objects.enqueue(self.mails[0], {'code': u'1234'}, [('a.txt', 'text', 'text/plain')])
+        entry = QueuedMail.objects.get(pk=entry.pk)
+        self.assertEqual(entry.get_extra(), ({'code': u'1234'}, [('a.txt', 'text', 'text/plain')]))
+
+    def test_claim(self):
+        for m in self.mails:
+            QueuedMail.objects.enqueue(m)
+        claimed = QueuedMail.objects.claim(batch_size=2)
+        self.assertEqual([entry.mail for entry in claimed], self.mails[:2])
+        self.assertEqual([entry.mail for entry in QueuedMail.objects.claim(batch_size=2)], self.mails[2:])
+        self.assertEqual(QueuedMail.objects.claim(batch_size=2), [])
+        # expired leases are claimed again
+        QueuedMail.objects.filter(pk=claimed[0].pk).update(leased_until=None)
+        self.assertEqual([entry.mail for entry in QueuedMail.objects.claim()], self.mails[:1])
+
+    def test_send_language(self):
+        mail.outbox = []
+        languages = []
+        def get_message():
+            languages.append(translation.get_language())
+            return mail.EmailMessage('subject', 'body', 'from@example.com', ['queued@example.com'])
+        QueuedMail.objects.enqueue(self.mails[0])
+        entry = QueuedMail.objects.claim()[0]
+        entry.mail.job.newsletter = Newsletter(language='de')
+        entry.mail.get_message = get_message
+        language = translation.get_language()
+        entry.send()
+        self.assertEqual(languages, ['de'])
+        self.assertEqual(translation.get_language(), language)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(QueuedMail.objects.filter(pk=entry.pk).exists())
+
+
+class TokenTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_token(make_token(12, 3456)), (12, 3456, None))
+        self.assertEqual(parse_token(make_token(12, 3456, 789)), (12, 3456, 789))
+
+    def test_invalid(self):
+        token = make_token(12, 3456, 789)
+        self.assertEqual(parse_token(token.replace('c-', 'd-', 1)), None)
+        self.assertEqual(parse_token(token[:-1]), None)
+        self.assertEqual(parse_token('0123456789abcdef0123456789abcdef'), None)
+
+    def test_tokenize(self):
+        job = Job.objects.create()
+        subscriber = NewsletterSubscriber.objects.create(email='token@example.com')
+        try:
+            m = job.create_mail(subscriber)
+            link = job.links.create(link_target='http://www.example.com')
+            content = '<a href="http://example.com%s">link</a><img src="/ping/%s/header.jpg">' % (
+                reverse('pennyblack.redirect_link', args=(m.mail_hash, link.link_hash)), m.mail_hash)
+            content = Tokenizer().tokenize(content, m)
+            self.assertFalse(m.mail_hash in content)
+            self.assertTrue(reverse('pennyblack.redirect_link', args=(make_token(m.pk, job.pk, link.pk), link.link_hash)) in content)
+            self.assertTrue('/ping/%s/' % make_token(m.pk, job.pk) in content)
+            partial = Mail.from_token(make_token(m.pk, job.pk, link.pk))
+            self.assertEqual((partial.pk, partial.job_id, partial.token_link_id), (m.pk, job.pk, link.pk))
+            partial.load()
+            self.assertEqual(partial.mail_hash, m.mail_hash)
+        finally:
+            job.mails.all().delete()
+            job.links.all().delete()
+            Job.objects.filter(pk=job.pk).delete()
+            subscriber.delete()
+
+
+class EventLogTest(unittest.TestCase):
+    class Request(object):
+        META = {'HTTP_USER_AGENT': 'Mozilla/5.0', 'REMOTE_ADDR': '127.0.0.1'}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old_directory, settings.EVENT_LOG_DIR = settings.EVENT_LOG_DIR, self.directory
+        self.job = Job.objects.create()
+        self.subscriber = NewsletterSubscriber.objects.create(email='events@example.com')
+        self.mail = self.job.create_mail(self.subscriber)
+        self.link = self.job.links.create(link_target='http://www.example.com')
+
+    def tearDown(self):
+        settings.EVENT_LOG_DIR = self.old_directory
+        shutil.rmtree(self.directory)
+        self.mail.clients.all().delete()
+        self.link.clicks.all().delete()
+        self.job.links.all().delete()
+        self.job.mails.all().delete()
+        Job.objects.filter(pk=self.job.pk).delete()
+        self.subscriber.delete()
+
+    def test_write_events(self):
+        self.mail.mark_viewed(self.Request(), contact_type='ping')
+        self.mail.mark_viewed(self.Request(), contact_type='ping')
+        events.log_event(events.CLICK, self.mail.pk, link_id=self.link.pk)
+        self.assertEqual(Mail.objects.get(pk=self.mail.pk).viewed, None)
+        self.assertEqual(self.link.clicks.count(), 0)
+        logged = []
+        for path in glob.glob('%s/events-*.log' % self.directory):
+            logged.extend(events.read_events(path))
+        self.assertEqual(len(logged), 3)
+        events.write_events(logged)
+        self.assertNotEqual(Mail.objects.get(pk=self.mail.pk).viewed, None)
+        self.assertEqual(self.mail.clients.count(), 1)
+        self.assertEqual(self.link.clicks.count(), 1)
+
+    def test_flush_events(self):
+        for pid in (1, 2):
+            with open(os.path.join(self.directory, 'events-1-test-%d.log' % pid), 'w') as log:
+                log.write('["c", %d, %d, 0]\n' % (self.mail.pk, self.link.pk))
+        # a file claimed by another flusher is skipped
+        claimed = events._claim(os.path.join(self.directory, 'events-1-test-1.log'))
+        self.assertEqual(events._claim(os.path.join(self.directory, 'events-1-test-1.log')), None)
+        self.assertEqual(events.flush_events(), 1)
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(claimed)])
+        self.assertEqual(self.link.clicks.count(), 1)
+
+    def test_flush_failure(self):
+        with open(os.path.join(self.directory, 'events-1-test-1.log'), 'w') as log:
+            log.write('["c", %d, %d, 0]\n' % (self.mail.pk, self.link.pk))
+
+        def broken(mail_ids):
+            raise ValueError('broken')
+        Mail.objects.mark_clicked = broken
+        try:
+            self.assertRaises(ValueError, events.flush_events)
+        finally:
+            del Mail.objects.mark_clicked
+        # nothing was written and the file is flushed again
+        self.assertEqual(os.listdir(self.directory), ['events-1-test-1.log'])
+        self.assertEqual(self.link.clicks.count(), 0)
+        self.assertEqual(Mail.objects.get(pk=self.mail.pk).viewed, None)
+        self.assertEqual(events.flush_events(), 1)
+        self.assertEqual(self.link.clicks.count(), 1)
+        self.assertNotEqual(Mail.objects.get(pk=self.mail.pk).viewed, None)
+
+    def test_non_ascii_headers(self):
+        request = self.Request()
+        request.META = dict(request.META, HTTP_USER_AGENT='Mozilla \xe9', HTTP_REFERER='http://example.com/\xe9')
+        self.mail.mark_viewed(request, contact_type='ping')
+        logged = []
+        for path in glob.glob('%s/events-*.log' % self.directory):
+            logged.extend(events.read_events(path))
+        events.write_events(logged)
+        client = self.mail.clients.get()
+        self.assertEqual((client.agent.user_agent, client.referer), (u'Mozilla \ufffd', u'http://example.com/\ufffd'))
+
+
+class TimelineTest(unittest.TestCase):
+    def setUp(self):
+        self.job = Job.objects.create()
+        self.subscribers = [NewsletterSubscriber.objects.create(email='timeline%d@example.com' % i) for i in range(4)]
+        self.mails = [self.job.create_mail(subscriber) for subscriber in self.subscribers]
+        self.start = datetime.datetime(2012, 5, 1, 8, 30)
+        for mail, minutes in zip(self.mails, (10, 40, 95, None)):
+            if minutes is not None:
+                Mail.objects.filter(pk=mail.pk).update(viewed=self.start + datetime.timedelta(minutes=minutes))
+
+    def tearDown(self):
+        self.job.mails.all().delete()
+        Job.objects.filter(pk=self.job.pk).delete()
+        for subscriber in self.subscribers:
+            subscriber.delete()
+
+    def test_timeline(self):
+        timeline = get_timeline(self.job.mails.all(), 'viewed', self.start, hours=5)
+        self.assertEqual(len(timeline), 5)
+        for hour, count in timeline:
+            self.assertEqual(hour.minute, 0)
+            self.assertEqual(count, self.job.mails.exclude(viewed=None).filter(viewed__lt=hour).count())
+        self.assertEqual([count for hour, count in timeline], [0, 1, 2, 3, 3])
+
+    def test_click_timeline(self):
+        link = self.job.links.create(link_target='http://www.example.com')
+        try:
+            start = now() - datetime.timedelta(hours=3)
+            link.clicks.create(mail=self.mails[0], date=start + datetime.timedelta(hours=1))
+            before = now()
+            # clicks without a date are stored at the time of the click
+            clicks = [link.clicks.create(mail=mail) for mail in self.mails[1:3]]
+            self.assertTrue(all(click.date >= before for click in clicks))
+            timeline = get_timeline(link.clicks.all(), 'date', start)
+            self.assertEqual([count for hour, count in timeline], [0, 0, 1, 1, 3])
+        finally:
+            link.clicks.all().delete()
+            link.delete()
+
+
+class PendingMailsTest(unittest.TestCase):
+    def setUp(self):
+        self.job = Job.objects.create()
+        self.job.newsletter = Newsletter(sender=Sender(email='from@example.com', name='pending'))
+        self.subscribers = [NewsletterSubscriber.objects.create(email='pending%d@example.com' % i) for i in range(3)]
+        self.users = [User.objects.create(username='pending%d' % i, email='pending%d@example.com' % i) for i in range(2)]
+        # the receivers of both content types alternate
+        receivers = [self.subscribers[0], self.users[0], self.subscribers[1], self.users[1], self.subscribers[2]]
+        self.mails = [self.job.create_mail(receiver) for receiver in receivers]
+        self.receivers = dict((mail.pk, receiver) for mail, receiver in zip(self.mails, receivers))
+
+    def tearDown(self):
+        self.job.mails.all().delete()
+        Job.objects.filter(pk=self.job.pk).delete()
+        for receiver in self.subscribers + self.users:
+            receiver.delete()
+
+    def assertPersons(self, mails):
+        for mail in mails:
+            # the receiver was loaded with the others and isn't queried again
+            self.assertTrue('_person_cache' in mail.__dict__)
+            self.assertEqual(mail.person, self.receivers[mail.pk])
+            self.assertEqual(type(mail.person), type(self.receivers[mail.pk]))
+
+    def test_load_persons(self):
+        mails = list(self.job.mails.order_by('pk'))
+        load_persons(mails)
+        self.assertPersons(mails)
+
+    def test_deleted_person(self):
+        User.objects.filter(pk=self.users[0].pk).delete()
+        mails = list(self.job.mails.order_by('pk'))
+        load_persons(mails)
+        self.assertFalse('_person_cache' in mails[1].__dict__)
+        self.assertEqual(mails[1].person, None)
+        self.assertPersons(mails[:1] + mails[2:])
+
+    def test_chunks(self):
+        Mail.objects.filter(pk=self.mails[2].pk).update(sent=True)
+        for chunk_size in (1, 2, 4, 5, 10):
+            mails = list(self.job.iter_pending_mails(chunk_size=chunk_size))
+            self.assertEqual([mail.pk for mail in mails], [mail.pk for mail in self.mails if mail != self.mails[2]])
+            self.assertPersons(mails)
+            self.assertTrue(all(mail.job is self.job for mail in mails))
+
+    def test_range(self):
+        mails = self.job.iter_pending_mails(chunk_size=2, min_id=self.mails[1].pk, max_id=self.mails[3].pk)
+        self.assertEqual([mail.pk for mail in mails], [mail.pk for mail in self.mails[1:4]])
+
+
+class JobCountersTest(unittest.TestCase):
+    def setUp(self):
+        self.job = Job.objects.create()
+        self.subscribers = [NewsletterSubscriber.objects.create(email='counter%d@example.com' % i) for i in range(3)]
+        self.job.create_mails(self.subscribers)
+        self.mails = list(self.job.mails.order_by('pk'))
+        self.link = self.job.links.create(link_target='http://www.example.com')
+
+    def tearDown(self):
+        LinkClick.objects.filter(link=self.link).delete()
+        self.job.links.all().delete()
+        self.job.mails.all().delete()
+        Job.objects.filter(pk=self.job.pk).delete()
+        for subscriber in self.subscribers:
+            subscriber.delete()
+
+    def get_counters(self):
+        counters = JobCounters.objects.get(job=self.job)
+        return (counters.mails_total, counters.mails_sent, counters.mails_bounced,
+                counters.mails_viewed, counters.mails_clicked)
+
+    def test_counters(self):
+        Mail.objects.update_status(self.mails[:2], sent=True)
+        Mail.objects.update_status(self.mails[:2], sent=True)
+        self.mails[2].person = self.subscribers[2]
+        self.mails[2].bounce()
+        self.mails[2].bounce()
+        self.mails[0].mark_viewed()
+        Mail.objects.mark_viewed({self.mails[0].pk: now(), self.mails[1].pk: now()})
+        self.link.clicks.create(mail=self.mails[0])
+        self.mails[0].mark_clicked()
+        Mail.objects.mark_clicked([self.mails[0].pk])
+        self.assertEqual(self.get_counters(), (3, 2, 1, 2, 1))
+        JobCounters.objects.filter(job=self.job).update(mails_total=0, mails_viewed=0)
+        self.job.update_counters()
+        self.assertEqual(self.get_counters(), (3, 2, 1, 2, 1))
+        self.assertEqual(Job.objects.get(pk=self.job.pk).percentage_mails_sent, 66.7)
+
+    def test_retried_status(self):
+        # a retry or another worker has instances whose flags aren't set yet
+        stale = list(self.job.mails.order_by('pk'))
+        Mail.objects.update_status(self.mails[:2], sent=True)
+        Mail.objects.update_status(stale, sent=True, bounced=False)
+        self.assertEqual(self.get_counters(), (3, 3, 0, 0, 0))
+
+    def test_mark_sent(self):
+        # a view stored meanwhile isn't overwritten by the stale instance
+        Mail.objects.filter(pk=self.mails[0].pk).update(viewed=now())
+        self.mails[0].email = 'counter0@example.com'
+        self.mails[0].mark_sent()
+        m = Mail.objects.get(pk=self.mails[0].pk)
+        self.assertEqual((m.sent, m.email), (True, 'counter0@example.com'))
+        self.assertNotEqual(m.viewed, None)
+
+
+class RollupTest(unittest.TestCase):
+    def setUp(self):
+        self.job = Job.objects.create()
+        self.subscriber = NewsletterSubscriber.objects.create(email='rollup@example.com')
+        self.mail = self.job.create_mail(self.subscriber)
+        self.link = self.job.links.create(link_target='http://www.example.com')
+        self.hour = datetime.datetime(2012, 5, 1, 8)
+        self.old_lag, settings.ROLLUP_LAG = settings.ROLLUP_LAG, 0
+        # sqlite reuses the ids of deleted rows
+        RollupWatermark.objects.all().delete()
+        rollup_statistics()
+
+    def tearDown(self):
+        settings.ROLLUP_LAG = self.old_lag
+        JobHourlyStatistic.objects.filter(job=self.job).delete()
+        LinkHourlyStatistic.objects.filter(job=self.job).delete()
+        self.mail.clients.all().delete()
+        self.link.clicks.all().delete()
+        self.job.links.all().delete()
+        self.job.mails.all().delete()
+        Job.objects.filter(pk=self.job.pk).delete()
+        self.subscriber.delete()
+
+    def add_events(self, minutes):
+        for minute in minutes:
+            date = self.hour + datetime.timedelta(minutes=minute)
+            self.mail.clients.create(user_agent='Mozilla/5.0', ip_address='127.0.0.1', visited=date)
+            self.link.clicks.create(mail=self.mail, date=date)
+
+    def get_statistics(self):
+        return sorted(self.job.hourly_statistics.values_list('hour', 'opens', 'clicks'))
+
+    def test_rollup(self):
+        self.add_events((10, 20, 70))
+        self.assertEqual(rollup_statistics(batch_size=2), 6)
+        self.assertEqual(self.get_statistics(), [
+            (self.hour, 2, 2), (self.hour + datetime.timedelta(hours=1), 1, 1)])
+        # only new events are added
+        self.add_events((30,))
+        self.assertEqual(rollup_statistics(), 2)
+        self.assertEqual(self.get_statistics()[0], (self.hour, 3, 3))
+        self.assertEqual(sorted(self.link.hourly_statistics.values_list('clicks', flat=True)), [1, 3])
+
+    def test_click_dates(self):
+        self.link.clicks.create(mail=self.mail, date=self.hour)
+        before = now()
+        self.link.clicks.create(mail=self.mail)
+        self.link.clicks.create(mail=self.mail)
+        self.assertEqual(rollup_statistics(), 3)
+        self.assertEqual(self.get_statistics(), [
+            (self.hour, 0, 1), (before.replace(minute=0, second=0, microsecond=0), 0, 2)])
+
+    def test_lag(self):
+        settings.ROLLUP_LAG = 60
+        self.add_events((10,))
+        self.assertEqual(rollup_statistics(), 0)
+        # the events are added once their ids were seen ROLLUP_LAG seconds ago
+        RollupWatermark.objects.update(next_limit_date=now() - datetime.timedelta(seconds=60))
+        self.assertEqual(rollup_statistics(), 0)
+        self.add_events((20,))
+        RollupWatermark.objects.update(next_limit_date=now() - datetime.timedelta(seconds=60))
+        self.assertEqual(rollup_statistics(), 2)
+        self.assertEqual(self.get_statistics(), [(self.hour, 1, 1)])
+
+    def test_engagement_view(self):
+        self.add_events((10,))
+        rollup_statistics()
+        user = User.objects.create_superuser('rollup', 'rollup@example.com', 'secret')
+        client = Client()
+        client.login(username='rollup', password='secret')
+        response = client.get(reverse('admin:pennyblack_jobstatistic_engagement'), {'days': 10000})
+        user.delete()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('http://www.example.com' in response.content)
+
+
+class EmailListTest(unittest.TestCase):
+    def setUp(self):
+        self.job = Job.objects.create(status=31)
+        self.subscribers = [NewsletterSubscriber.objects.create(email='list%d@example.com' % i) for i in range(3)]
+        self.job.create_mails(self.subscribers)
+        for mail in self.job.mails.all():
+            Mail.objects.filter(pk=mail.pk).update(email=mail.person.email, sent=True)
+        self.mail = self.job.mails.order_by('pk')[0]
+        self.link = self.job.links.create(link_target='http://www.example.com')
+        self.link.clicks.create(mail=self.mail)
+        self.mail.mark_clicked()
+        self.user = User.objects.create_superuser('emaillist', 'emaillist@example.com', 'secret')
+        self.client = Client()
+        self.client.login(username='emaillist', password='secret')
+        self.old_sizes = settings.EMAIL_LIST_PAGE_SIZE, settings.EMAIL_LIST_CHUNK_SIZE
+        settings.EMAIL_LIST_PAGE_SIZE, settings.EMAIL_LIST_CHUNK_SIZE = 2, 2
+
+    def tearDown(self):
+        settings.EMAIL_LIST_PAGE_SIZE, settings.EMAIL_LIST_CHUNK_SIZE = self.old_sizes
+        self.user.delete()
+        self.link.clicks.all().delete()
+        self.job.links.all().delete()
+        self.job.mails.all().delete()
+        Job.objects.filter(pk=self.job.pk).delete()
+        for subscriber in self.subscribers:
+            subscriber.delete()
+
+    def test_pages(self):
+        url = reverse('admin:pennyblack_jobstatistic_email_list', args=[self.job.pk])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('list0@example.com' in response.content)
+        self.assertFalse('list2@example.com' in response.content)
+        response = self.client.get(url, {'after': response.context['next_after']})
+        self.assertTrue('list2@example.com' in response.content)
+        self.assertEqual(response.context['next_after'], None)
+
+    def test_user_agents(self):
+        self.mail.clients.create(agent_id=UserAgent.objects.get_id('Mozilla/5.0 Thunderbird/17.0.2'), ip_address='127.0.0.1')
+        url = reverse('admin:pennyblack_jobstatistic_user_agents', args=[self.job.pk])
+        response = self.client.get(url, {'versions': 1})
+        self.mail.clients.all().delete()
+        self.assertEqual(list(response.context['user_agents']),
+                         [{'agent__family': 'Thunderbird', 'agent__version': '17.0', 'agent__device': 'desktop', 'count': 1}])
+
+    def test_csv(self):
+        url = reverse('admin:pennyblack_jobstatistic_email_list_csv', args=[self.job.pk])
+        lines = ''.join(self.client.get(url)).splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[1], 'list0@example.com,1,0,,1')
+        lines = ''.join(self.client.get(url, {'clicked': 1})).splitlines()
+        self.assertEqual(len(lines), 2)
+
+
+class UserAgentTest(unittest.TestCase):
+    def test_classify(self):
+        self.assertEqual(classify('Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 6.1; Microsoft Outlook 14.0.7113; ms-office)'),
+                         ('Outlook', '14.0', 'desktop'))
+        self.assertEqual(classify('Mozilla/5.0 (iPhone; CPU iPhone OS 6_0 like Mac OS X) AppleWebKit/536.26 (KHTML, like Gecko) Mobile/10A403'),
+                         ('Apple Mail', '', 'mobile'))
+        self.assertEqual(classify('Mozilla/5.0 (Windows NT 5.1; rv:11.0) Gecko Firefox/11.0 (via ggpht.com GoogleImageProxy)'),
+                         ('Gmail', '', 'proxy'))
+        self.assertEqual(classify('Mozilla/5.0 (iPad; CPU OS 6_0 like Mac OS X) AppleWebKit/536.26 (KHTML, like Gecko) Version/6.0 Mobile/10A5355d Safari/8536.25'),
+                         ('Safari', '6.0', 'tablet'))
+        self.assertEqual(classify(''), ('Other', '', 'unknown'))
+
+    def test_normalize(self):
+        job = Job.objects.create()
+        subscriber = NewsletterSubscriber.objects.create(email='useragent@example.com')
+        mail = job.create_mail(subscriber)
+        for user_agent in ('Thunderbird test/1', 'Thunderbird test/1', 'Mozilla/5.0 Thunderbird/17.0.2'):
+            mail.clients.create(user_agent=user_agent, ip_address='127.0.0.1')
+        self.assertEqual(normalize_user_agents(batch_size=2), 3)
+        self.assertEqual(mail.clients.filter(agent=None).count(), 0)
+        self.assertEqual(mail.clients.exclude(user_agent='').count(), 0)
+        self.assertEqual(mail.clients.values('agent').distinct().count(), 2)
+        self.assertEqual(UserAgent.objects.get(user_agent='Mozilla/5.0 Thunderbird/17.0.2').version, '17.0')
+        mail.clients.all().delete()
+        job.mails.all().delete()
+        Job.objects.filter(pk=job.pk).delete()
+        subscriber.delete()
+
+    def test_non_ascii(self):
+        # a latin-1 header and the same header longer than the column
+        user_agents = ['Mozilla/5.0 Gr\xfc\xdfe/1.0', 'Mozilla/5.0 Gr\xfc\xdfe/1.0' + 'x' * 300]
+        ids = UserAgent.objects.get_ids(user_agents)
+        self.assertEqual(ids[user_agents[0]], UserAgent.objects.get_id(user_agents[0]))
+        user_agent = UserAgent.objects.get(pk=ids[user_agents[0]])
+        self.assertEqual(user_agent.user_agent, u'Mozilla/5.0 Gr\ufffd\ufffde/1.0')
+        self.assertEqual(len(UserAgent.objects.get(pk=ids[user_agents[1]]).user_agent), 255)
+        UserAgent.objects.filter(pk__in=ids.values()).delete()
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evict(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+    def test_sizeof(self):
+        cache = LRUCache(10, sizeof=len)
+        cache.set('a', 'x' * 6)
+        cache.set('b', 'x' * 6)
+        cache.set('c', 'x' * 20)
+        self.assertEqual((cache.get('a'), cache.get('c'), cache.size), (None, None, 6))
+
+    def test_timeout(self):
+        cache = LRUCache(2, timeout=-1)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a', 'expired'), 'expired')
+
+
+class LinkTargetTest(unittest.TestCase):
+    class Newsletter(object):
+        utm_source = 'newsletter'
+        utm_medium = 'email'
+
+    class Job(object):
+        newsletter = None
+        utm_campaign = 'spring'
+
+    class Mail(object):
+        def __init__(self, job):
+            self.job = job
+            self.job_id = 1
+
+        def get_context(self):
+            return {'mail': self, 'base_url': 'http://example.com'}
+
+    def setUp(self):
+        job = self.Job()
+        job.newsletter = self.Newsletter()
+        self.mail = self.Mail(job)
+
+    def test_static(self):
+        link = Link(id=1, link_target='http://www.example.com/?page=1')
+        url = link.get_redirect_url(self.mail)
+        self.assertTrue(url.startswith('http://www.example.com/?'))
+        for parameter in ('page=1', 'utm_source=newsletter', 'utm_medium=email', 'utm_campaign=spring'):
+            self.assertTrue(parameter in url)
+        # the url is cached for the job
+        self.mail.job.utm_campaign = 'summer'
+        self.assertEqual(link.get_redirect_url(self.mail), url)
+
+    def test_dynamic(self):
+        link = Link(id=2, link_target='{{base_url}}/welcome/')
+        self.assertEqual(link.get_target(self.mail), 'http://example.com/welcome/')
+        self.assertTrue(link.get_redirect_url(self.mail).startswith('http://example.com/welcome/?'))
+
+    def test_mailto(self):
+        link = Link(id=3, link_target='mailto:info@example.com')
+        self.assertEqual(link.get_redirect_url(self.mail), 'mailto:info@example.com')
+
+
+class PingTest(unittest.TestCase):
+    def setUp(self):
+        self.job = Job.objects.create()
+        self.subscriber = NewsletterSubscriber.objects.create(email='ping@example.com')
+        self.mail = self.job.create_mail(self.subscriber)
+
+    def tearDown(self):
+        self.mail.clients.all().delete()
+        self.job.mails.all().delete()
+        Job.objects.filter(pk=self.job.pk).delete()
+        self.subscriber.delete()
+
+    def test_pixel(self):
+        url = reverse('pennyblack.ping', kwargs={'mail_hash': self.mail.mail_hash, 'filename': PIXEL_FILENAME})
+        response = Client().get(url, HTTP_USER_AGENT='Mozilla/5.0')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/gif')
+        self.assertTrue('no-cache' in response['Cache-Control'])
+        self.assertNotEqual(Mail.objects.get(pk=self.mail.pk).viewed, None)
+
+
+class WebviewCacheTest(unittest.TestCase):
+    def test_render_once(self):
+        calls = []
+
+        def render():
+            calls.append(1)
+            return u'<p>Gr\xfc\xdfe</p>'
+        self.assertEqual(get_cached_webview(('test', 1), render), u'<p>Gr\xfc\xdfe</p>')
+        self.assertEqual(get_cached_webview(('test', 1), render), u'<p>Gr\xfc\xdfe</p>')
+        self.assertEqual(len(calls), 1)
+
+
+class WebviewTest(unittest.TestCase):
+    def setUp(self):
+        # sqlite reuses the ids of deleted rows
+        views._webviews.clear()
+        self.newsletter = create_newsletter(newsletter_type=2)
+        self.job = Job.objects.create(newsletter=self.newsletter, status=32, public_slug='webview-test')
+        self.subscriber = NewsletterSubscriber.objects.create(email='webview@example.com')
+        self.mail = self.job.create_mail(self.subscriber)
+        self.content = get_text_content_type().objects.get(parent=self.newsletter)
+
+    def tearDown(self):
+        delete_newsletter(self.newsletter)
+        self.subscriber.delete()
+
+    def edit(self, text):
+        self.content.text = text
+        self.content.save()
+        Newsletter.objects.get(pk=self.newsletter.pk).content_changed()
+
+    def test_edited_newsletter(self):
+        url = reverse('pennyblack.view', args=(self.mail.mail_hash,))
+        self.assertTrue('Hello webview@example.com' in Client().get(url).content)
+        self.edit(u'<p>Goodbye {{person.email}}</p>')
+        self.assertTrue('Goodbye webview@example.com' in Client().get(url).content)
+
+    def test_public_view(self):
+        url = reverse('pennyblack.view_public', args=('webview-test',))
+        self.assertTrue('Hello' in Client().get(url).content)
+        self.edit(u'<p>Goodbye</p>')
+        self.assertTrue('Goodbye' in Client().get(url).content)
+        # a cached view isn't served once the job can't be viewed anymore
+        Job.objects.filter(pk=self.job.pk).update(status=1)
+        self.assertRaises(Http404, view_public, RequestFactory().get(url), 'webview-test')
+        Job.objects.filter(pk=self.job.pk).update(status=32, public_slug='webview-other')
+        self.assertRaises(Http404, view_public, RequestFactory().get(url), 'webview-test')
+
+
+class TrackingQueriesTest(unittest.TestCase):
+    def setUp(self):
+        # sqlite reuses the ids of deleted rows
+        views._webviews.clear()
+        self.directory = tempfile.mkdtemp()
+        self.old_directory, settings.EVENT_LOG_DIR = settings.EVENT_LOG_DIR, self.directory
+        self.newsletter = create_newsletter()
+        self.job = Job.objects.create(newsletter=self.newsletter, status=31)
+        self.subscriber = NewsletterSubscriber.objects.create(email='queries@example.com')
+        self.mail = self.job.create_mail(self.subscriber)
+        Mail.objects.filter(pk=self.mail.pk).update(email='queries@example.com')
+        self.link = self.job.links.create(link_target='http://www.example.com/')
+
+    def tearDown(self):
+        settings.EVENT_LOG_DIR = self.old_directory
+        shutil.rmtree(self.directory)
+        delete_newsletter(self.newsletter)
+        self.subscriber.delete()
+
+    def assertQueries(self, url, num):
+        client = Client()
+        # the first request fills the caches
+        client.get(url)
+        self.assertEqual(len(get_queries(client.get, url)), num)
+
+    def test_routes(self):
+        self.assertQueries(reverse('pennyblack.ping', args=(make_token(self.mail.pk, self.job.pk), PIXEL_FILENAME)), 0)
+        self.assertQueries(reverse('pennyblack.redirect_link', args=(
+            make_token(self.mail.pk, self.job.pk, self.link.pk), self.link.link_hash)), 0)
+        # only the content version of the cached web view is looked up
+        self.assertQueries(reverse('pennyblack.view', args=(make_token(self.mail.pk, self.job.pk),)), 1)
+
+    def test_flag_of_token(self):
+        mail = Mail.from_token(make_token(self.mail.pk, self.job.pk))
+        mail.mark_clicked()
+        m = Mail.objects.get(pk=self.mail.pk)
+        self.assertEqual((m.clicked, m.email), (True, 'queries@example.com'))
+
+
+class TrackingUrlsTest(unittest.TestCase):
+    def test_urls(self):
+        for name, args in (('pennyblack.redirect_link', ('mailhash', 'abc')), ('pennyblack.view', ('mailhash',)),
+                           ('pennyblack.ping', ('mailhash', PIXEL_FILENAME))):
+            url = reverse(name, args=args)
+            self.assertEqual(reverse(name, args=args, urlconf='pennyblack.tracking_urls'), url)
+            self.assertEqual(resolve(url, urlconf='pennyblack.tracking_urls').url_name, name)
+
+    def test_no_admin(self):
+        # the admin of this process is loaded already, so a fresh one loads
+        # the models and the tracking urls and lists the modules of the
+        # pennyblack admin classes, only the base class for receiver admins
+        # may be loaded
+        script = ('from django.contrib.admin.options import BaseModelAdmin\n'
+                  'from django.db.models.loading import get_models\n'
+                  'from django.core.urlresolvers import resolve\n'
+                  'get_models()\n'
+                  'resolve(%r, urlconf="pennyblack.tracking_urls")\n'
+                  'classes, modules = [BaseModelAdmin], set()\n'
+                  'while classes:\n'
+                  '    cls = classes.pop()\n'
+                  '    classes.extend(cls.__subclasses__())\n'
+                  '    if cls.__module__.startswith("pennyblack"):\n'
+                  '        modules.add(cls.__module__)\n'
+                  'print(" ".join(sorted(modules)))\n' % reverse('pennyblack.view', args=('mailhash',)))
+        # manage.py adds the directory of the project to the path only while
+        # it imports the settings
+        project = sys.modules[os.environ['DJANGO_SETTINGS_MODULE'].split('.')[0]]
+        path = [os.path.dirname(os.path.dirname(os.path.abspath(project.__file__)))] + sys.path
+        process = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE,
+                                   env=dict(os.environ, PYTHONPATH=os.pathsep.join(path)))
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(output.strip(), 'pennyblack.options')
+
+
+class DomainSchedulerTest(unittest.TestCase):
+    class Person(object):
+        def __init__(self, email):
+            self.email = email
+
+        def get_email(self):
+            return self.email
+
+    class Mail(object):
+        def __init__(self, email):
+            self.person = DomainSchedulerTest.Person(email)
+
+    def test_interleave(self):
+        mails = [self.Mail('%s@slow.com' % i) for i in range(3)] + [self.Mail('%s@fast.com' % i) for i in range(3)]
+        scheduler = DomainScheduler(rate_limits={'slow.com': (1000, 1)}, default_limit=None, lookahead=10)
+        ordered = list(scheduler.schedule(mails))
+        self.assertEqual(sorted(ordered), sorted(mails))
+        self.assertEqual([m.person.email.split('@')[1] for m in ordered[:2]], ['slow.com', 'fast.com'])
+
+    def test_subdomain_limit(self):
+        scheduler = DomainScheduler(rate_limits={'Example.com': (1, 1)}, default_limit=None)
+        self.assertEqual(scheduler.get_domain(self.Mail('a@mx.example.com')), 'example.com')
+        self.assertEqual(scheduler.get_domain(self.Mail('a@other.com')), 'other.com')
+
+    def test_rate_limit(self):
+        bucket = TokenBucket(1000, 2)
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        self.assertTrue(0 < bucket.wait_time() <= 0.001)
+
+    def test_throttled(self):
+        mails = [self.Mail('%s@slow.com' % i) for i in range(2)]
+        schedule = DomainScheduler(rate_limits={'slow.com': (10, 1)}, default_limit=None).schedule(mails, sleep=False)
+        self.assertTrue(schedule.next() is mails[0])
+        throttled = schedule.next()
+        self.assertTrue(isinstance(throttled, Throttled))
+        self.assertTrue(0 < throttled.seconds <= 0.1)
+        time.sleep(throttled.seconds)
+        self.assertEqual([m for m in schedule if not isinstance(m, Throttled)], mails[1:])
+
+    def test_zero_rate(self):
+        self.assertRaises(ValueError, TokenBucket, 0)
+        try:
+            for name, value in (('PENNYBLACK_DOMAIN_RATE_LIMITS', {'example.com': (0, 1)}),
+                                ('PENNYBLACK_DOMAIN_DEFAULT_RATE_LIMIT', (0, 1))):
+                with override_settings(**{name: value}):
+                    self.assertRaises(ImproperlyConfigured, reload, default_settings)
+        finally:
+            reload(default_settings)
+
+
+class TestSMTPServer(smtpd.SMTPServer):
+    """
+    Accepts every message except the ones to refused@example.com.
+    """
+    class Channel(smtpd.SMTPChannel):
+        def smtp_RCPT(self, arg):
+            if 'refused@' in arg:
+                self.push('550 No such user')
+                return
+            smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.messages = []
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.Channel(self, *pair)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+
+@unittest.skipIf(AsyncDeliveryEngine is None, 'trollius is not installed')
+class AsyncDeliveryEngineTest(unittest.TestCase):
+    class Mail(object):
+        def __init__(self, email):
+            self.email = email
+            self.person = DomainSchedulerTest.Person(email)
+            self.sent = False
+            self.bounced = False
+
+        def get_message(self, render_plan=None):
+            return mail.EmailMessage('subject', 'body', 'from@example.com', [self.email])
+
+        def mark_sent(self):
+            self.sent = True
+
+        def bounce(self):
+            self.bounced = True
+
+    def setUp(self):
+        self.server = TestSMTPServer()
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.close()
+        self.thread.join(1)
+
+    def test_deliver(self):
+        mails = [self.Mail('test%s@example.com' % i) for i in range(10)] + [self.Mail('refused@example.com')]
+        engine = AsyncDeliveryEngine(concurrency=3)
+        engine.session_class = functools.partial(SMTPSession, host='127.0.0.1', port=self.server.socket.getsockname()[1], username='')
+        engine.deliver(mails)
+        self.assertEqual(len(self.server.messages), 10)
+        self.assertTrue(all(m.sent for m in mails[:10]))
+        self.assertTrue(mails[10].bounced)
+        self.assertFalse(mails[10].sent)
+
+    def test_throttled_domain(self):
+        mails = [self.Mail('test%s@example.com' % i) for i in range(3)] + [self.Mail('test%s@slow.com' % i) for i in range(3)]
+        engine = AsyncDeliveryEngine(concurrency=2)
+        engine.session_class = functools.partial(SMTPSession, host='127.0.0.1', port=self.server.socket.getsockname()[1], username='')
+        scheduler = DomainScheduler(rate_limits={'slow.com': (20, 1)}, default_limit=None)
+        self.assertFalse(engine.blocking)
+        engine.deliver(scheduler.schedule(mails, sleep=engine.blocking))
+        self.assertEqual(len(self.server.messages), 6)
+        self.assertTrue(all(m.sent for m in mails))
+
+    def test_plain_auth(self):
+        import trollius
+        loop = trollius.new_event_loop()
+        session = SMTPSession(loop, host='127.0.0.1', port=self.server.socket.getsockname()[1],
+                              username='user', password='secret')
+        old_plain_auth = settings.ASYNC_DELIVERY_PLAIN_AUTH
+        try:
+            self.assertRaises(ImproperlyConfigured, loop.run_until_complete, session.connect())
+            self.assertEqual(session.writer, None)
+            settings.ASYNC_DELIVERY_PLAIN_AUTH = True
+            # the test server doesn't know AUTH
+            self.assertRaises(smtplib.SMTPResponseException, loop.run_until_complete, session.connect())
+        finally:
+            settings.ASYNC_DELIVERY_PLAIN_AUTH = old_plain_auth
+            if session.writer is not None:
+                session.writer.close()
+            loop.close()
@@ -0,0 +1,82 @@
+"""
+Signed tracking tokens. A token encodes the ids of a mail, its job and
+optionally a link, so the tracking views know which mail and link a request
+is about without looking up the hashes.
+"""
+import re
+
+from django.core.urlresolvers import reverse
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import base36_to_int, int_to_base36
+
+SIGNATURE_LENGTH = 16
+
+
+def _sign(value):
+    return salted_hmac('pennyblack.tokens', value).hexdigest()[:SIGNATURE_LENGTH]
+
+
+def make_token(mail_id, job_id, link_id=None):
+    """
+    Returns the token for a mail and optionally one of its links.
+    """
+    ids = [mail_id, job_id] if link_id is None else [mail_id, job_id, link_id]
+    value = '-'.join(int_to_base36(i) for i in ids)
+    return '%s-%s' % (value, _sign(value))
+
+
+def parse_token(token):
+    """
+    Returns the (mail id, job id, link id) tuple of a token, the link id is
+    None if the token has no link. Returns None if token isn't a valid token,
+    e.g. a mail hash.
+    """
+    value, sep, signature = token.rpartition('-')
+    if not sep or not constant_time_compare(signature, _sign(value)):
+        return None
+    try:
+        ids = [base36_to_int(i) for i in value.split('-')]
+    except ValueError:
+        return None
+    if len(ids) == 2:
+        return ids[0], ids[1], None
+    if len(ids) == 3:
+        return tuple(ids)
+    return None
+
+
+class Tokenizer(object):
+    """
+    Replaces the mail hash in the tracking urls of a rendered mail with
+    tokens. Link urls get a token which contains the link id.
+    """
+    def __init__(self):
+        self.link_ids = {}
+        self.link_url = reverse('pennyblack.redirect_link', kwargs={'mail_hash': 'mailhash', 'link_hash': 'linkhash'})
+
+    def get_link_ids(self, link_hashes):
+        """
+        Returns a dict mapping the link hashes to the link ids, links are
+        looked up only once.
+        """
+        from pennyblack.models import Link
+        missing = [link_hash for link_hash in link_hashes if link_hash not in self.link_ids]
+        if missing:
+            self.link_ids.update(Link.objects.filter(link_hash__in=missing).values_list('link_hash', 'id'))
+        return self.link_ids
+
+    def tokenize(self, content, mail):
+        """
+        Returns content with tokens instead of the hash of mail.
+        """
+        pattern = re.compile(re.escape(self.link_url).replace('mailhash', re.escape(mail.mail_hash)).replace('linkhash', '([a-z0-9]+)'))
+        link_ids = self.get_link_ids(set(pattern.findall(content)))
+
+        def replace(match):
+            link_hash = match.group(1)
+            if link_hash not in link_ids:
+                return match.group(0)
+            token = make_token(mail.pk, mail.job_id, link_ids[link_hash])
+            return self.link_url.replace('mailhash', token).replace('linkhash', link_hash)
+        content = pattern.sub(replace, content)
+        return content.replace(mail.mail_hash, make_token(mail.pk, mail.job_id))
@@ -0,0 +1,11 @@
+"""
+The url configuration of the tracking application, it contains only the
+pennyblack urls under TRACKING_URL_PREFIX.
+"""
+from django.conf.urls.defaults import *
+
+from pennyblack import settings
+
+urlpatterns = patterns('',
+    url(r'^%s' % settings.TRACKING_URL_PREFIX, include('pennyblack.urls')),
+)
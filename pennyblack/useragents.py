@@ -0,0 +1,75 @@
+"""
+Classifies user agent strings by client family, version and device class.
+"""
+import re
+
+from pennyblack import settings
+from pennyblack.utils import LRUCache
+
+# the first matching family wins, mail clients come before the browsers
+# they are built on
+FAMILIES = (
+    ('Outlook', re.compile(r'Microsoft Outlook[ /]?([\d.]+)|MSOffice (\d+)|Outlook-Express/([\d.]+)')),
+    ('Windows Live Mail', re.compile(r'Windows Live Mail ([\d.]+)')),
+    ('Thunderbird', re.compile(r'Thunderbird/([\d.]+)')),
+    ('Lotus Notes', re.compile(r'Lotus-Notes/([\d.]+)')),
+    ('Gmail', re.compile(r'GoogleImageProxy')),
+    ('Yahoo Mail', re.compile(r'YahooMailProxy')),
+    ('Apple Mail', re.compile(r'AppleWebKit/[\d.]+ \(KHTML, like Gecko\)(?: Mobile/\w+)?$')),
+    ('Edge', re.compile(r'Edge?/([\d.]+)')),
+    ('Opera', re.compile(r'Opera[/ ]([\d.]+)|OPR/([\d.]+)')),
+    ('Chrome', re.compile(r'(?:Chrome|CriOS)/([\d.]+)')),
+    ('Firefox', re.compile(r'Firefox/([\d.]+)')),
+    ('Safari', re.compile(r'Version/([\d.]+).*Safari/')),
+    ('Internet Explorer', re.compile(r'MSIE ([\d.]+)|Trident/.*rv:([\d.]+)')),
+)
+OTHER = 'Other'
+
+DESKTOP = 'desktop'
+MOBILE = 'mobile'
+TABLET = 'tablet'
+PROXY = 'proxy'
+UNKNOWN = 'unknown'
+
+TABLET_RE = re.compile(r'iPad|Tablet|Android(?!.*Mobile)')
+MOBILE_RE = re.compile(r'Mobile|iPhone|iPod|Android|Windows Phone|BlackBerry')
+PROXY_RE = re.compile(r'GoogleImageProxy|YahooMailProxy')
+
+_classifications = LRUCache(settings.USER_AGENT_CACHE_SIZE)
+
+
+def _get_version(match):
+    version = next((group for group in match.groups() if group), '')
+    return '.'.join(version.split('.')[:2])
+
+
+def _classify(user_agent):
+    if not user_agent:
+        return OTHER, '', UNKNOWN
+    family, version = OTHER, ''
+    for name, pattern in FAMILIES:
+        match = pattern.search(user_agent)
+        if match is not None:
+            family, version = name, _get_version(match)
+            break
+    if PROXY_RE.search(user_agent):
+        device = PROXY
+    elif TABLET_RE.search(user_agent):
+        device = TABLET
+    elif MOBILE_RE.search(user_agent):
+        device = MOBILE
+    else:
+        device = DESKTOP
+    return family, version, device
+
+
+def classify(user_agent):
+    """
+    Returns the (client family, version, device class) tuple of a user agent
+    string.
+    """
+    classification = _classifications.get(user_agent)
+    if classification is None:
+        classification = _classify(user_agent)
+        _classifications.set(user_agent, classification)
+    return classification
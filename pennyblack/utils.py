@@ -0,0 +1,76 @@
+import collections
+import contextlib
+import threading
+import time
+
+from django.db import transaction
+
+
+@contextlib.contextmanager
+def commit_on_success_unless_managed():
+    """
+    Like transaction.commit_on_success, but joins the transaction of the
+    caller if there is one instead of committing it halfway.
+    """
+    if transaction.is_managed():
+        yield
+    else:
+        with transaction.commit_on_success():
+            yield
+
+
+class LRUCache(object):
+    """
+    A thread safe in-process cache which holds at most maxsize entries and
+    drops the least recently used one first. If timeout is given, entries
+    expire that many seconds after they were set. If sizeof is given, the
+    sum of sizeof(value) of all entries is limited to maxsize instead of
+    their number.
+    """
+    def __init__(self, maxsize, timeout=None, sizeof=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.entries.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                self.size -= self.sizeof(value)
+                return default
+            self.entries[key] = (value, expires)
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.timeout if self.timeout is not None else None
+        size = self.sizeof(value)
+        with self.lock:
+            self._delete(key)
+            if size > self.maxsize:
+                return
+            self.entries[key] = (value, expires)
+            self.size += size
+            while self.size > self.maxsize:
+                self.size -= self.sizeof(self.entries.popitem(last=False)[1][0])
+
+    def _delete(self, key):
+        if key in self.entries:
+            self.size -= self.sizeof(self.entries.pop(key)[0])
+
+    def delete(self, key):
+        with self.lock:
+            self._delete(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
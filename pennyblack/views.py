@@ -1,17 +1,46 @@
+import base64
+import mimetypes
 import types
-from urlparse import urlparse, urlunparse, parse_qs
-from urllib import urlencode
+import zlib
 
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render_to_response, get_object_or_404
+from django.template.loader import render_to_string
 from django.template import RequestContext
 from django.utils.functional import wraps
 
 from pennyblack.models import Newsletter, Link, Mail, Job
 from pennyblack import settings
+from pennyblack.utils import LRUCache
+
+# a transparent 1x1 gif
+TRANSPARENT_PIXEL = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+PIXEL_FILENAME = 'pennyblack-pixel.gif'
+
+# header images by job as (content type, data, url) tuples
+_header_images = LRUCache(settings.PING_CACHE_SIZE, settings.PING_CACHE_TIMEOUT,
+                          sizeof=lambda image: len(image[1] or ''))
+# links of tokens by (link id, link hash)
+_links = LRUCache(settings.LINK_CACHE_SIZE, settings.LINK_CACHE_TIMEOUT)
+# compressed web views by mail and public views by job, both keyed with the
+# content version of the newsletter since workflow newsletters are edited
+_webviews = LRUCache(settings.WEBVIEW_CACHE_SIZE, settings.WEBVIEW_CACHE_TIMEOUT, sizeof=len)
+
+
+def get_cached_webview(key, render):
+    """
+    Returns the cached web view for key, calls render to get it if it isn't
+    cached yet.
+    """
+    content = _webviews.get(key)
+    if content is not None:
+        return zlib.decompress(content).decode('utf-8')
+    content = render()
+    _webviews.set(key, zlib.compress(content.encode('utf-8')))
+    return content
 
 
 class HttpResponseRedirectWithMailto(HttpResponseRedirect):
@@ -24,26 +53,37 @@ class HttpResponseRedirectWithMailto(HttpResponseRedirect):
 
 def needs_mail(function):
     """
-    Decorator to get the mail object
+    Decorator to get the mail object. If the url contains a tracking token
+    instead of the mail hash, the mail is not loaded from the database.
     """
     @wraps(function)
     def wrapper(request, mail_hash=None, *args, **kwargs):
-        try:
-            mail = Mail.objects.get(mail_hash=mail_hash)
-        except ObjectDoesNotExist:
-            return HttpResponseRedirect('/')
+        mail = Mail.from_token(mail_hash) if '-' in mail_hash else None
+        if mail is None:
+            try:
+                mail = Mail.objects.get(mail_hash=mail_hash)
+            except ObjectDoesNotExist:
+                return HttpResponseRedirect('/')
         return function(request, mail=mail, *args, **kwargs)
     return wrapper
 
 
 def needs_link(function):
     """
-    Decorator to get the link object
+    Decorator to get the link object. The links of tracking tokens are
+    cached.
     """
     @wraps(function)
     def wrapper(request, link_hash=None, *args, **kwargs):
+        link_id = getattr(kwargs.get('mail'), 'token_link_id', None)
         try:
-            link = Link.objects.get(link_hash=link_hash)
+            if link_id is not None:
+                link = _links.get((link_id, link_hash))
+                if link is None:
+                    link = Link.objects.get(pk=link_id, link_hash=link_hash)
+                    _links.set((link_id, link_hash), link)
+            else:
+                link = Link.objects.get(link_hash=link_hash)
         except ObjectDoesNotExist:
             return HttpResponseRedirect('/')
         return function(request, link=link, *args, **kwargs)
@@ -75,14 +115,21 @@ def view_public(request, job_slug):
     """
     View a job by public slug.
     """
-    job = get_object_or_404(Job, public_slug=job_slug, status__in=settings.JOB_STATUS_CAN_VIEW_PUBLIC)
-    newsletter = job.newsletter
-    request.content_context = {
-        'newsletter': newsletter,
-        'public_url': job.public_url,
-        'webview': True,
-    }
-    return render_to_response(newsletter.template.path, request.content_context, context_instance=RequestContext(request))
+    # the slug and status are checked on every request, only the rendering
+    # is cached
+    job_id, version = get_object_or_404(Job.objects.values_list('pk', 'newsletter__content_version'),
+                                        public_slug=job_slug, status__in=settings.JOB_STATUS_CAN_VIEW_PUBLIC)
+
+    def render():
+        job = Job.objects.select_related('newsletter').get(pk=job_id)
+        newsletter = job.newsletter
+        request.content_context = {
+            'newsletter': newsletter,
+            'public_url': job.public_url,
+            'webview': True,
+        }
+        return render_to_string(newsletter.template.path, request.content_context, context_instance=RequestContext(request))
+    return HttpResponse(get_cached_webview(('public', job_id, version), render))
 
 @needs_mail
 @needs_link
@@ -94,20 +141,7 @@ def redirect_link(request, mail, link):
     mail.on_landing(request)
     target = link.click(mail)
     if isinstance(target, types.FunctionType):
-        return HttpResponseRedirect(reverse('pennyblack.proxy', args=(mail.mail_hash, link.link_hash)))
-    # disassemble the url
-    scheme, netloc, path, params, query, fragment = tuple(urlparse(target))
-    if scheme in ('http', 'https'):  # insert ga tracking if scheme is appropriate
-        parsed_query = parse_qs(query)
-        if mail.job.newsletter.utm_source:
-            parsed_query['utm_source'] = mail.job.newsletter.utm_source
-        if mail.job.newsletter.utm_medium:
-            parsed_query['utm_medium'] = mail.job.newsletter.utm_medium
-        if mail.job.utm_campaign:
-            parsed_query['utm_campaign'] = mail.job.utm_campaign
-        query = urlencode(parsed_query, True)
-    # reassemble the url
-    target = urlunparse((scheme, netloc, path, params, query, fragment))
+        return HttpResponseRedirect(reverse('pennyblack.proxy', args=(getattr(mail, 'token', mail.mail_hash), link.link_hash)))
     response = HttpResponseRedirectWithMailto(target)
     try:
         response.allowed_schemes = response.allowed_schemes + ['mailto']
@@ -116,19 +150,67 @@ def redirect_link(request, mail, link):
     return response
 
 
+def get_header_image(job_id):
+    """
+    Returns the header image of a job as (content type, data, url) tuple,
+    data is None if the image is too big to be served from memory.
+    """
+    image = _header_images.get(job_id)
+    if image is None:
+        header_image = Job.objects.select_related('newsletter__header_image').get(pk=job_id).newsletter.header_image
+        content_type, data = None, None
+        try:
+            if header_image.file.size <= settings.PING_IMAGE_MAX_SIZE:
+                content_type = mimetypes.guess_type(header_image.file.name)[0] or 'application/octet-stream'
+                header_image.file.open('rb')
+                try:
+                    data = header_image.file.read()
+                finally:
+                    header_image.file.close()
+        except EnvironmentError:
+            pass
+        image = (content_type, data, header_image.get_absolute_url())
+        _header_images.set(job_id, image)
+    return image
+
+
+def never_cache_image(data, content_type):
+    """
+    Returns an image response which is fetched again on every open.
+    """
+    response = HttpResponse(data, content_type=content_type)
+    response['Cache-Control'] = 'no-cache, no-store, must-revalidate, private'
+    response['Pragma'] = 'no-cache'
+    response['Expires'] = 'Thu, 01 Jan 1970 00:00:00 GMT'
+    return response
+
+
 @needs_mail
 def ping(request, mail, filename):
     mail.mark_viewed(request, contact_type='ping')
-    return HttpResponseRedirect(mail.job.newsletter.header_image.get_absolute_url())
+    if filename == PIXEL_FILENAME:
+        return never_cache_image(TRANSPARENT_PIXEL, 'image/gif')
+    if not settings.PING_SERVE_IMAGE:
+        return HttpResponseRedirect(mail.job.newsletter.header_image.get_absolute_url())
+    content_type, data, url = get_header_image(mail.job_id)
+    if data is None:
+        return HttpResponseRedirect(url)
+    return never_cache_image(data, content_type)
 
 
 @needs_mail
 def view(request, mail):
     mail.mark_viewed(request, contact_type='webview')
-    return HttpResponse(mail.get_content(webview=True))
+
+    def render():
+        mail.load()
+        return mail.get_content(webview=True)
+    version = Job.objects.values_list('newsletter__content_version', flat=True).get(pk=mail.job_id)
+    return HttpResponse(get_cached_webview(('mail', mail.pk, version), render))
 
 
 @needs_mail
 @needs_link
 def proxy(request, mail, link):
+    mail.load()
     return link.get_target(mail)(request, mail.person, mail.job.group_object)
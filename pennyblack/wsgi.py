@@ -0,0 +1,26 @@
+"""
+A WSGI application which serves only the tracking views (links, tracking
+images, web views and proxy views), for workers which don't serve the rest
+of the project::
+
+    DJANGO_SETTINGS_MODULE=tracking_settings gunicorn pennyblack.wsgi:application
+
+The settings module should list only the apps the tracking views need, see
+the documentation.
+"""
+from django.core.handlers.wsgi import WSGIHandler
+
+
+class TrackingHandler(WSGIHandler):
+    """
+    Resolves every request with pennyblack.tracking_urls instead of the
+    ROOT_URLCONF of the project.
+    """
+    urlconf = 'pennyblack.tracking_urls'
+
+    def get_response(self, request):
+        request.urlconf = self.urlconf
+        return super(TrackingHandler, self).get_response(request)
+
+
+application = TrackingHandler()
@@ -37,10 +37,13 @@ setup(
     ],
     requires=[
         'FeinCMS(>=1.3.0)',
-        'Django(>=1.3)',
+        'Django(>=1.4)',
         'pydns',
         'pyspf',
         'pil',
     ],
+    extras_require={
+        'async': ['trollius'],
+    },
     include_package_data=True,
 )